@@ -1,14 +1,48 @@
+"""Lightweight tier of the ML service: heuristic-only quality scoring without torch, transformers or rembg.
+
+The server falls back to it when the full service (main.py) is unavailable. /infer answers with
+main.py's JSON schema: the foreground comes from heuristics.estimate_foreground instead of rembg,
+the decay ratio from the same HSV rules, and heuristic_quality labels it with the decay cutoffs
+evaluate.py --mode simple uses (HEURISTIC_PARAMS, a QUALITY_CONFIG "heuristic" section), so
+vit_class has no label or scores and the response is marked "degraded", like main.py's answers
+while CLIP is still loading.
+"""
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import urllib.request
+from typing import List, Optional
 
-
+import numpy as np
 from fastapi import FastAPI
-from pydantic import BaseModel
-from typing import List, Optional
-import hashlib
 from fastapi import UploadFile, File
 from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from heuristics import (apply_quality_config, estimate_decay_ratio, estimate_foreground, heuristic_quality,
+                        mask_to_png_base64, mask_to_rle, parse_projection, upsample_mask)
+from image_io import MAX_UPLOAD_BYTES, ImageDecodeError, ImageTooLargeError, decode_image, fit_to_max_side, to_numpy
 
 app = FastAPI(title="Agri-Connect ML Service", version="0.1.0")
 
+# Longest side (pixels) the heuristics work at. The decay ratio is an area fraction, so it
+# barely moves with resolution, and JPEGs are decoded straight to about this size.
+LIGHT_MAX_SIDE = int(os.environ.get("LIGHT_MAX_SIDE", "512"))
+
+# /analyze scores the listing images the server refers to: paths resolved under ANALYZE_IMAGE_ROOT
+# (the server directory holding uploads/), and paths or URLs under ANALYZE_IMAGE_BASE_URL
+# (e.g. http://localhost:5000, which serves /uploads). data: URLs are always accepted.
+ANALYZE_IMAGE_ROOT = os.environ.get("ANALYZE_IMAGE_ROOT") or None
+ANALYZE_IMAGE_BASE_URL = os.environ.get("ANALYZE_IMAGE_BASE_URL") or None
+ANALYZE_MAX_IMAGES = int(os.environ.get("ANALYZE_MAX_IMAGES", "5"))
+
+# The same HSV cutoffs as main.py, and the decay cutoffs of its "heuristic" section
+if os.environ.get("QUALITY_CONFIG"):
+    with open(os.environ["QUALITY_CONFIG"], "r", encoding="utf-8") as f:
+        apply_quality_config(json.load(f))
+
 
 class AnalyzeRequest(BaseModel):
     cropType: str
@@ -18,6 +52,7 @@ class AnalyzeRequest(BaseModel):
 class AnalyzeResponse(BaseModel):
     qualityScore: float
     suggestedPrice: Optional[float]
+    imagesScored: int = 0
 
 
 def stable_score(key: str) -> float:
@@ -27,52 +62,138 @@ def stable_score(key: str) -> float:
     return 0.6 + 0.35 * val
 
 
+def heuristic_inference(data: bytes, projection: Optional[dict] = None) -> dict:
+    """main.py's /infer response for one uploaded image, from the decay heuristic alone."""
+    projection = projection or parse_projection()
+    work, upload_size = decode_image(data, LIGHT_MAX_SIDE)
+    img_rgb = to_numpy(work)
+    mask = estimate_foreground(img_rgb)
+    decay_ratio = estimate_decay_ratio(img_rgb * mask[:, :, None], mask)
+    final_quality, final_scores = heuristic_quality(decay_ratio)
+    resp = {
+        "decayed_area_ratio": decay_ratio,
+        "vit_class": {"label": None, "scores": {}},
+        "final_quality": final_quality,
+        "final_scores": final_scores,
+    }
+    if projection["mask"] != "none":
+        out_mask = upsample_mask(mask, fit_to_max_side(upload_size, projection["mask_max_side"]))
+        if projection["mask"] == "png":
+            resp["mask_png_base64"] = mask_to_png_base64(out_mask)
+        else:
+            resp["mask_rle"] = mask_to_rle(out_mask)
+    resp["degraded"] = True
+    return resp
+
+
+def _read_file(path: str) -> Optional[bytes]:
+    try:
+        with open(path, "rb") as f:
+            return f.read(MAX_UPLOAD_BYTES + 1)
+    except OSError:
+        return None
+
+
+def _fetch(url: str) -> Optional[bytes]:
+    try:
+        with urllib.request.urlopen(url, timeout=5) as r:
+            return r.read(MAX_UPLOAD_BYTES + 1)
+    except (OSError, ValueError):
+        return None
+
+
+def read_image_ref(ref: str) -> Optional[bytes]:
+    """Bytes of an image the server refers to (see ANALYZE_IMAGE_ROOT); None when it cannot be read."""
+    if ref.startswith("data:"):
+        try:
+            return base64.b64decode(ref.partition(",")[2])
+        except ValueError:
+            return None
+    is_url = "://" in ref
+    if ANALYZE_IMAGE_ROOT and not is_url:
+        root = os.path.realpath(ANALYZE_IMAGE_ROOT)
+        path = os.path.realpath(os.path.join(root, ref.lstrip("/\\")))
+        # Never read outside the root
+        if os.path.commonpath([root, path]) == root:
+            data = _read_file(path)
+            if data is not None:
+                return data
+    if ANALYZE_IMAGE_BASE_URL:
+        base = ANALYZE_IMAGE_BASE_URL.rstrip("/")
+        if is_url and ref.startswith(base + "/"):
+            return _fetch(ref)
+        if not is_url:
+            return _fetch(base + "/" + ref.lstrip("/\\"))
+    return None
+
+
 @app.get("/")
 def root():
     return {"status": "ml-ok"}
 
 
+@app.get("/healthz")
+def healthz():
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+def readyz():
+    # Nothing to load: ready as soon as the process is up
+    return {"ready": True}
+
+
 @app.post("/analyze", response_model=AnalyzeResponse)
 def analyze(payload: AnalyzeRequest):
-    base = stable_score(payload.cropType.lower())
-    # very naive adjustment: more images → more confidence → slightly higher
-    adj = min(len(payload.images), 5) * 0.015
-    quality = min(base + adj, 0.98)
+    """Listing quality: the mean Good/Fresh score of the images that can be read.
+
+    When none can be (no ANALYZE_IMAGE_ROOT / ANALYZE_IMAGE_BASE_URL, or missing files), falls back
+    to a stable per-crop placeholder score.
+    """
+    goods = []
+    for ref in payload.images[:ANALYZE_MAX_IMAGES]:
+        data = read_image_ref(ref)
+        if data is None:
+            continue
+        try:
+            goods.append(heuristic_inference(data)["final_scores"]["Good/Fresh"])
+        except ImageDecodeError:
+            continue
+
+    if goods:
+        quality = float(np.mean(goods))
+    else:
+        base = stable_score(payload.cropType.lower())
+        # very naive adjustment: more images → more confidence → slightly higher
+        adj = min(len(payload.images), 5) * 0.015
+        quality = min(base + adj, 0.98)
 
     # Suggest price as a function of quality if market snapshot is not provided by server.
     # The server may override this using today's market price if present.
     # Example: base price band (for demo) 20–80 currency units per kg
     suggested = round(20 + (80 - 20) * quality, 2)
-    return {"qualityScore": round(quality, 3), "suggestedPrice": suggested}
+    return {"qualityScore": round(quality, 3), "suggestedPrice": suggested, "imagesScored": len(goods)}
 
 
-# Lightweight fallback endpoint compatible with server expectations
-# Accepts an uploaded image and returns fields similar to the heavy /infer
+# Lightweight fallback with the heavy /infer contract (query parameters, schema and error codes).
+# crop_type is accepted for compatibility; without CLIP there are no per-crop prompts to use.
 @app.post("/infer")
-async def infer(file: UploadFile = File(...)):
-    # We don't perform real inference here. Provide deterministic, harmless values.
-    name = file.filename or "image"
-    base = stable_score(name)
-    # Map base to a rough class
-    if base > 0.85:
-        label = "Good/Fresh"
-    elif base > 0.7:
-        label = "Rotten/Spoiled"  # mid bucket
-    else:
-        label = "Completely Bad/Decomposed"
-
-    scores = {
-        "Good/Fresh": round(1.0 if label == "Good/Fresh" else 0.1, 3),
-        "Rotten/Spoiled": round(1.0 if label == "Rotten/Spoiled" else 0.1, 3),
-        "Completely Bad/Decomposed": round(1.0 if label == "Completely Bad/Decomposed" else 0.1, 3),
-    }
-
-    resp = {
-        "decayed_area_ratio": round(1 - base, 3),
-        "vit_class": {"label": label, "scores": scores},
-        "final_quality": label,
-        "mask_png_base64": "",  # no segmentation in lightweight stub
-    }
+async def infer(file: UploadFile = File(...), detail: str = "minimal", mask: Optional[str] = None,
+                mask_max_side: int = 0, crop_type: Optional[str] = None):
+    try:
+        projection = parse_projection(detail, mask, mask_max_side)
+    except ValueError as e:
+        return JSONResponse({"detail": str(e)}, status_code=400)
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        return JSONResponse({"detail": f"upload exceeds {MAX_UPLOAD_BYTES} bytes"}, status_code=413)
+    data = await file.read()
+    try:
+        # OpenCV releases the GIL, so concurrent requests use several cores
+        resp = await asyncio.to_thread(heuristic_inference, data, projection)
+    except ImageTooLargeError as e:
+        return JSONResponse({"detail": str(e)}, status_code=413)
+    except ImageDecodeError as e:
+        return JSONResponse({"detail": str(e)}, status_code=400)
     return JSONResponse(resp)
 
 
@@ -0,0 +1,103 @@
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Any, Callable, Optional
+
+
+class MicroBatcher:
+    """Coalesce items submitted from concurrent threads into batched calls of `fn`.
+
+    A dispatcher thread takes the first waiting item, keeps collecting until `max_batch` items
+    are queued or `window_ms` has passed since that first item arrived, then calls
+    `fn(items)` once and hands each caller the result at its position. `fn` must return one
+    result per item, in order.
+    """
+
+    def __init__(self, fn: Callable[[list], list], max_batch: int = 8, window_ms: float = 10.0):
+        self.fn = fn
+        self.max_batch = max(1, max_batch)
+        self.window_s = max(0.0, window_ms) / 1000.0
+        self._queue: "queue.Queue[Optional[tuple[Any, Future, float]]]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self._batch_sizes: Counter = Counter()
+        self._wait_total_s = 0.0
+        self._wait_max_s = 0.0
+
+    def start(self) -> None:
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name="clip-batcher", daemon=True)
+            self._thread.start()
+
+    def shutdown(self) -> None:
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, item: Any) -> Any:
+        """Queue `item` for the next batch and block until its result is ready."""
+        if self._thread is None:
+            raise RuntimeError("MicroBatcher.start() has not been called")
+        fut: Future = Future()
+        self._queue.put((item, fut, time.perf_counter()))
+        return fut.result()
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        with self._lock:
+            batches = sum(self._batch_sizes.values())
+            items = sum(size * n for size, n in self._batch_sizes.items())
+            return {
+                "batches": batches,
+                "items": items,
+                "batch_size_histogram": {str(k): v for k, v in sorted(self._batch_sizes.items())},
+                "mean_batch_size": items / batches if batches else 0.0,
+                "queue_wait_ms_mean": 1000.0 * self._wait_total_s / items if items else 0.0,
+                "queue_wait_ms_max": 1000.0 * self._wait_max_s,
+            }
+
+    def _loop(self) -> None:
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = [first]
+            deadline = first[2] + self.window_s
+            stop = False
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                try:
+                    entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stop = True
+                    break
+                batch.append(entry)
+            self._run(batch)
+            if stop:
+                return
+
+    def _run(self, batch: list) -> None:
+        started = time.perf_counter()
+        waits = [started - enqueued for _, _, enqueued in batch]
+        with self._lock:
+            self._batch_sizes[len(batch)] += 1
+            self._wait_total_s += sum(waits)
+            self._wait_max_s = max(self._wait_max_s, max(waits))
+        try:
+            results = self.fn([item for item, _, _ in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(f"batch function returned {len(results)} results for {len(batch)} items")
+        except BaseException as e:
+            for _, fut, _ in batch:
+                fut.set_exception(e)
+            return
+        for (_, fut, _), result in zip(batch, results):
+            fut.set_result(result)
@@ -0,0 +1,84 @@
+import argparse
+import time
+
+import cv2
+import numpy as np
+
+from main import estimate_decay_ratio
+
+
+def estimate_decay_ratio_reference(img_rgb: np.ndarray, fg_mask: np.ndarray) -> float:
+    """The original int64/boolean-mask implementation, kept as the parity and speed baseline."""
+    fg_mask = (fg_mask > 0).astype(np.uint8)
+    mask_u8 = (fg_mask * 255).astype(np.uint8)
+    try:
+        mask_u8 = cv2.medianBlur(mask_u8, 5)
+    except Exception:
+        pass
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+    mask_u8 = cv2.morphologyEx(mask_u8, cv2.MORPH_OPEN, kernel)
+    mask_u8 = cv2.morphologyEx(mask_u8, cv2.MORPH_CLOSE, kernel)
+    fg_mask = (mask_u8 > 0).astype(np.uint8)
+
+    hsv = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2HSV)
+    v = hsv[:, :, 2].astype(int)
+    s = hsv[:, :, 1].astype(int)
+    h = hsv[:, :, 0].astype(int)
+    dark = (v < 40)
+    brown_like = ((h > 8) & (h < 28) & (s > 100) & (v < 100))
+    mold_green = ((h > 40) & (h < 80) & (s > 80) & (v < 140))
+    spoiled = (brown_like | mold_green) | (dark & (s > 40))
+
+    spoiled_fg = spoiled * fg_mask
+    num_fg = int(np.sum(fg_mask > 0))
+    num_spoiled = int(np.sum(spoiled_fg > 0))
+    if num_fg < 50:
+        return 0.0
+    return float(num_spoiled) / float(num_fg)
+
+
+def synthetic_sample(width: int, height: int, seed: int = 0) -> tuple[np.ndarray, np.ndarray]:
+    """Random smooth-ish produce-like image plus an elliptical, speckled foreground mask."""
+    rng = np.random.default_rng(seed)
+    small = rng.integers(0, 256, size=(max(1, height // 16), max(1, width // 16), 3), dtype=np.uint8)
+    img = cv2.resize(small, (width, height), interpolation=cv2.INTER_LINEAR)
+    img = cv2.add(img, rng.integers(0, 24, size=img.shape, dtype=np.uint8))
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.ellipse(mask, (width // 2, height // 2), (width // 3, height // 3), 0, 0, 360, 1, -1)
+    mask[rng.random(mask.shape) < 0.01] ^= 1
+    return img, mask
+
+
+def time_call(fn, *args, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check parity and time estimate_decay_ratio against the reference implementation")
+    parser.add_argument("--sizes", nargs="*", default=["1000x1000", "4000x3000"], help="Image sizes as WIDTHxHEIGHT (default: 1 MP and 12 MP)")
+    parser.add_argument("--repeat", type=int, default=5, help="Timing repetitions; the best run is reported")
+    parser.add_argument("--seeds", type=int, default=5, help="Random images per size used for the parity check")
+    args = parser.parse_args()
+
+    for size in args.sizes:
+        width, height = (int(x) for x in size.lower().split("x"))
+        for seed in range(args.seeds):
+            img, mask = synthetic_sample(width, height, seed)
+            fast = estimate_decay_ratio(img, mask)
+            ref = estimate_decay_ratio_reference(img, mask)
+            if fast != ref:
+                raise SystemExit(f"Mismatch at {size} seed {seed}: fast={fast!r} reference={ref!r}")
+
+        img, mask = synthetic_sample(width, height)
+        t_ref = time_call(estimate_decay_ratio_reference, img, mask, repeat=args.repeat)
+        t_fast = time_call(estimate_decay_ratio, img, mask, repeat=args.repeat)
+        print(f"{size:>10}: reference {t_ref * 1000:8.1f} ms  fast {t_fast * 1000:8.1f} ms  speedup {t_ref / t_fast:5.1f}x  (bit-identical over {args.seeds} seeds)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,339 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+import main as pipeline
+from bench_decay import synthetic_sample
+
+STAGES = ("decay", "combine", "clip", "clip_tta", "segment", "infer")
+
+
+def parse_size(size: str) -> tuple[int, int]:
+    width, height = (int(x) for x in size.lower().split("x"))
+    return width, height
+
+
+def synthetic_jpeg(width: int, height: int, seed: int = 0) -> bytes:
+    img, _ = synthetic_sample(width, height, seed)
+    buf = io.BytesIO()
+    Image.fromarray(img).save(buf, format="JPEG", quality=90)
+    return buf.getvalue()
+
+
+def summarize(samples_s: list[float]) -> dict:
+    """Latency summary in milliseconds."""
+    ms = np.asarray(samples_s, dtype=float) * 1000.0
+    return {
+        "n": int(ms.size),
+        "min_ms": round(float(ms.min()), 4),
+        "mean_ms": round(float(ms.mean()), 4),
+        "p50_ms": round(float(np.percentile(ms, 50)), 4),
+        "p95_ms": round(float(np.percentile(ms, 95)), 4),
+        "p99_ms": round(float(np.percentile(ms, 99)), 4),
+    }
+
+
+def time_calls(fn, *args, repeat: int, warmup: int, number: int = 1) -> dict:
+    """Time fn(*args) `repeat` times after `warmup` untimed calls; each sample is the mean of `number` calls."""
+    for _ in range(warmup):
+        fn(*args)
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            fn(*args)
+        samples.append((time.perf_counter() - started) / number)
+    return summarize(samples)
+
+
+def clip_with_augmentations(names: list[str]):
+    """clip_classify with `names` as the test-time augmentations."""
+    def run(image: Image.Image) -> dict:
+        return pipeline.clip_classify(image, augmentations=names)
+    return run
+
+
+def run_stages(sizes: list[str], stages: list[str], repeat: int, warmup: int) -> dict:
+    """Benchmark each pipeline stage in isolation on one synthetic image per size."""
+    if {"clip", "clip_tta"} & set(stages):
+        pipeline.ensure_models()
+    if "segment" in stages:
+        pipeline.segmentation_engine.load()
+    # With TTA: the configured augmentations, or all of them when CLIP_TTA is a single one
+    tta = pipeline.TTA_AUGMENTATIONS if len(pipeline.TTA_AUGMENTATIONS) > 1 else list(pipeline.TTA_TRANSFORMS)
+    scores = {label: 1.0 / len(pipeline.labels) for label in pipeline.labels}
+
+    results = {}
+    for size in sizes:
+        width, height = parse_size(size)
+        img, mask = synthetic_sample(width, height)
+        image = Image.fromarray(img)
+        for name in stages:
+            if name == "decay":
+                result = time_calls(pipeline.estimate_decay_ratio, img, mask, repeat=repeat, warmup=warmup)
+            elif name == "combine":
+                result = time_calls(pipeline.combine_quality, 0.1, scores, repeat=repeat, warmup=warmup, number=1000)
+            elif name == "clip":
+                result = time_calls(clip_with_augmentations(["original"]), image, repeat=repeat, warmup=warmup)
+            elif name == "clip_tta":
+                result = time_calls(clip_with_augmentations(tta), image, repeat=repeat, warmup=warmup)
+                result["augmentations"] = list(tta)
+            elif name == "segment":
+                result = time_calls(pipeline.segment_foreground, image, repeat=repeat, warmup=warmup)
+            else:
+                continue
+            results[f"{name}@{size}"] = result
+            print(f"{name + '@' + size:>24}: p50 {result['p50_ms']:9.3f} ms  p95 {result['p95_ms']:9.3f} ms")
+    return results
+
+
+async def run_load(client, uploads: list[bytes], concurrency: int, warmup: int, query: str) -> dict:
+    """POST the first `warmup` uploads one by one, then the rest from `concurrency` concurrent clients."""
+    for data in uploads[:warmup]:
+        await client.post(f"/infer{query}", files={"file": ("bench.jpg", data, "image/jpeg")})
+
+    pending = iter(uploads[warmup:])
+    latencies: list[float] = []
+    statuses: dict[str, int] = {}
+    paths: dict[str, int] = {}
+
+    async def worker():
+        for data in pending:
+            started = time.perf_counter()
+            r = await client.post(f"/infer{query}", files={"file": ("bench.jpg", data, "image/jpeg")})
+            latencies.append(time.perf_counter() - started)
+            statuses[str(r.status_code)] = statuses.get(str(r.status_code), 0) + 1
+            if r.status_code == 200 and r.headers.get("x-cache") == "NEAR":
+                paths["near_duplicate"] = paths.get("near_duplicate", 0) + 1
+            elif r.status_code == 200 and pipeline.CASCADE_ENABLED:
+                # Which cascade path answered, so throughput is read against the share of CLIP runs
+                path = r.json().get("path", "none")
+                paths[path] = paths.get(path, 0) + 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    result = {**summarize(latencies), "concurrency": concurrency,
+              "throughput_rps": round(len(latencies) / elapsed, 3), "statuses": statuses}
+    if paths:
+        result["paths"] = paths
+    return result
+
+
+def print_load(key: str, result: dict) -> None:
+    print(f"{key:>24}: p50 {result['p50_ms']:9.2f} ms  p95 {result['p95_ms']:9.2f} ms  "
+          f"p99 {result['p99_ms']:9.2f} ms  {result['throughput_rps']:7.2f} req/s  {result['statuses']}"
+          + (f"  paths {result['paths']}" if "paths" in result else ""))
+
+
+async def load_test(sizes: list[str], concurrency: int, requests: int, warmup: int, query: str) -> dict:
+    """Concurrent end-to-end /infer requests through an in-process ASGI client, per image size.
+
+    Every request uploads a different image so the result cache never answers.
+    """
+    import httpx
+
+    results = {}
+    async with pipeline.lifespan(pipeline.app):
+        transport = httpx.ASGITransport(app=pipeline.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+            for size in sizes:
+                width, height = parse_size(size)
+                uploads = [synthetic_jpeg(width, height, seed) for seed in range(warmup + requests)]
+                result = await run_load(client, uploads, concurrency, warmup, query)
+                results[f"infer@{size}"] = result
+                print_load(f"infer@{size}", result)
+    return results
+
+
+def process_memory(pid: int) -> dict:
+    """Resident memory of a process in MB: RSS, and PSS, which splits shared pages between their sharers."""
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup", "r", encoding="utf-8") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("Rss", "Pss"):
+                    memory[f"{key.lower()}_mb"] = round(int(value.split()[0]) / 1024, 1)
+    except OSError:
+        # Not Linux, or the process is gone
+        pass
+    return memory
+
+
+def child_pids(pid: int) -> list[int]:
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children", "r", encoding="utf-8") as f:
+            return [int(p) for p in f.read().split()]
+    except OSError:
+        return []
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_ready(base_url: str, workers: int, timeout_s: float = 600.0) -> None:
+    """Poll /readyz on fresh connections until it answers 200 often enough in a row to cover every worker."""
+    import httpx
+
+    deadline = time.monotonic() + timeout_s
+    in_a_row = 0
+    while in_a_row < 4 * workers:
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"serve.py with {workers} workers was not ready after {timeout_s:.0f}s")
+        try:
+            async with httpx.AsyncClient(base_url=base_url) as client:
+                ready = (await client.get("/readyz")).status_code == 200
+        except httpx.TransportError:
+            ready = False
+        in_a_row = in_a_row + 1 if ready else 0
+        if not ready:
+            await asyncio.sleep(0.5)
+
+
+async def scaling_test(worker_counts: list[int], size: str, concurrency: int, requests: int, warmup: int,
+                       query: str) -> dict:
+    """/infer throughput and per-process memory of serve.py for each worker count, over real HTTP.
+
+    Connections are not kept alive, so the kernel spreads requests across the workers. Scaling
+    efficiency is the throughput relative to the first worker count, divided by the worker ratio.
+    """
+    import httpx
+
+    results = {}
+    base = None
+    width, height = parse_size(size)
+    for run, workers in enumerate(worker_counts):
+        port = free_port()
+        env = {**os.environ, "SERVE_WORKERS": str(workers), "HOST": "127.0.0.1", "PORT": str(port)}
+        server = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "serve.py")],
+                                  env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            base_url = f"http://127.0.0.1:{port}"
+            await wait_ready(base_url, workers)
+            # Fresh images per run so a persistent INFER_CACHE_DB cannot answer
+            seeds = range(run * (warmup + requests), (run + 1) * (warmup + requests))
+            uploads = [synthetic_jpeg(width, height, seed) for seed in seeds]
+            limits = httpx.Limits(max_keepalive_connections=0)
+            async with httpx.AsyncClient(base_url=base_url, timeout=None, limits=limits) as client:
+                result = await run_load(client, uploads, concurrency, warmup, query)
+            worker_memory = [process_memory(pid) for pid in child_pids(server.pid)]
+            result.update(workers=workers, parent_memory=process_memory(server.pid), worker_memory=worker_memory)
+            if worker_memory and all("pss_mb" in m for m in worker_memory):
+                result["pss_mb_per_worker"] = round(float(np.mean([m["pss_mb"] for m in worker_memory])), 1)
+                result["rss_mb_per_worker"] = round(float(np.mean([m["rss_mb"] for m in worker_memory])), 1)
+        finally:
+            server.terminate()
+            server.wait(timeout=60)
+        if base is None:
+            base = result
+        result["scaling_efficiency"] = round(
+            result["throughput_rps"] / (base["throughput_rps"] * workers / base["workers"]), 3)
+        key = f"serve@{workers}w@{size}"
+        results[key] = result
+        print_load(key, result)
+        print(f"{'':>24}  efficiency {result['scaling_efficiency']:.2f}  "
+              f"RSS/worker {result.get('rss_mb_per_worker', '?')} MB  PSS/worker {result.get('pss_mb_per_worker', '?')} MB")
+    return results
+
+
+def environment() -> dict:
+    """Settings that change the numbers, recorded so runs are only compared like for like."""
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "clip_backend": pipeline.CLIP_BACKEND,
+        "clip_tta": pipeline.TTA_AUGMENTATIONS,
+        "work_max_side": pipeline.WORK_MAX_SIDE,
+        "segmentation": pipeline.segmentation_engine.stats()["model"],
+        "infer_workers": pipeline.inference_executor.workers,
+        "clip_batch_window_ms": pipeline.CLIP_BATCH_WINDOW_MS,
+        "serve_threads": os.environ.get("SERVE_THREADS"),
+        "cascade": pipeline.CASCADE_PARAMS if pipeline.CASCADE_ENABLED else None,
+        "embed_index": pipeline.embedding_index.capacity if pipeline.embedding_index is not None else 0,
+    }
+
+
+def compare(current: dict, baseline: dict, threshold: float) -> list[str]:
+    """Benchmarks whose p50/p95 latency grew, or whose throughput fell, by more than `threshold`."""
+    regressions = []
+    print(f"\n{'benchmark':>24}  {'metric':>14}  {'baseline':>10}  {'current':>10}  change")
+    for key, cur in current["results"].items():
+        base = baseline.get("results", {}).get(key)
+        if base is None:
+            continue
+        for metric, higher_is_worse in (("p50_ms", True), ("p95_ms", True), ("throughput_rps", False)):
+            if metric not in cur or metric not in base or not base[metric]:
+                continue
+            change = cur[metric] / base[metric] - 1.0
+            worse = change > threshold if higher_is_worse else change < -threshold
+            print(f"{key:>24}  {metric:>14}  {base[metric]:10.3f}  {cur[metric]:10.3f}  {change:+7.1%}"
+                  f"{'  REGRESSION' if worse else ''}")
+            if worse:
+                regressions.append(f"{key} {metric}: {base[metric]} -> {cur[metric]} ({change:+.1%})")
+    if baseline.get("environment") != current["environment"]:
+        print("warning: the baseline was recorded with different settings:", baseline.get("environment"))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the inference pipeline stages and end-to-end /infer on synthetic images")
+    parser.add_argument("--sizes", nargs="*", default=["640x480", "1920x1080", "4000x3000"], help="Image sizes as WIDTHxHEIGHT")
+    parser.add_argument("--stages", default=",".join(STAGES), help=f"Comma-separated benchmarks to run ({', '.join(STAGES)})")
+    parser.add_argument("--repeat", type=int, default=10, help="Timed calls per stage benchmark")
+    parser.add_argument("--warmup", type=int, default=2, help="Untimed calls (or requests) before measuring")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent clients of the /infer load test")
+    parser.add_argument("--requests", type=int, default=64, help="Requests per size in the /infer load test")
+    parser.add_argument("--query", default="", help="Query string for the /infer load test, e.g. '?mask=rle'")
+    parser.add_argument("--serve-workers", default="", help="Comma-separated SERVE_WORKERS counts; runs serve.py with each and "
+                        "reports /infer throughput, scaling efficiency and memory per worker at the first --sizes entry")
+    parser.add_argument("--out", default="benchmark_out/benchmark.json", help="Where to write the results")
+    parser.add_argument("--baseline", default=None, help="Earlier results to compare against; exits non-zero on a regression")
+    parser.add_argument("--threshold", type=float, default=0.15, help="Relative slowdown counted as a regression")
+    args = parser.parse_args()
+
+    stages = [s.strip() for s in args.stages.split(",") if s.strip()]
+    unknown = set(stages) - set(STAGES)
+    if unknown:
+        parser.error(f"unknown stages {sorted(unknown)}; choose from {', '.join(STAGES)}")
+
+    results = run_stages(args.sizes, stages, args.repeat, args.warmup)
+    if "infer" in stages:
+        results.update(asyncio.run(load_test(args.sizes, args.concurrency, args.requests, args.warmup, args.query)))
+    if args.serve_workers:
+        counts = [int(n) for n in args.serve_workers.split(",") if n.strip()]
+        results.update(asyncio.run(scaling_test(counts, args.sizes[0], args.concurrency, args.requests, args.warmup,
+                                                args.query)))
+
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "environment": environment(), "results": results}
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved results to {args.out}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        regressions = compare(report, baseline, args.threshold)
+        if regressions:
+            print("\nRegressions:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("\nNo regressions.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import copy
+import os
+
+import numpy as np
+import torch
+
+BACKENDS = ("torch", "torch-int8", "onnx", "onnx-int8")
+
+
+def pooled_output(output) -> torch.Tensor:
+    # get_*_features returns a tensor on transformers 4.x and a pooled model output on 5.x
+    return output if isinstance(output, torch.Tensor) else output.pooler_output
+
+
+class _ImageTower(torch.nn.Module):
+    """pixel_values -> unnormalized CLIP image embeddings; the part of CLIPModel requests run."""
+
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        return pooled_output(self.model.get_image_features(pixel_values=pixel_values))
+
+
+class TorchImageEncoder:
+    """Eager PyTorch image tower, optionally with int8 dynamically quantized Linear layers."""
+
+    def __init__(self, model, quantize: bool = False):
+        self.tower = _ImageTower(model).eval()
+        if quantize:
+            self.tower = torch.ao.quantization.quantize_dynamic(self.tower, {torch.nn.Linear}, dtype=torch.qint8)
+
+    def __call__(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        with torch.no_grad():
+            return self.tower(pixel_values)
+
+    def for_worker(self) -> "TorchImageEncoder":
+        """A private copy for one inference worker thread (INFER_PER_WORKER_MODELS)."""
+        clone = copy.copy(self)
+        clone.tower = copy.deepcopy(self.tower)
+        return clone
+
+
+class OnnxImageEncoder:
+    """Image tower exported to ONNX and run by onnxruntime (already a rembg dependency)."""
+
+    def __init__(self, onnx_path: str, threads: int = 0):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(onnx_path, options, providers=["CPUExecutionProvider"])
+
+    def __call__(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        pixels = np.ascontiguousarray(pixel_values.numpy(), dtype=np.float32)
+        (embeds,) = self.session.run(None, {"pixel_values": pixels})
+        return torch.from_numpy(embeds)
+
+    def for_worker(self) -> "OnnxImageEncoder":
+        # InferenceSession.run is thread-safe; one session serves every worker
+        return self
+
+
+def export_onnx(model, onnx_path: str, image_size: int, quantize: bool = False) -> str:
+    """Export the image tower to `onnx_path` (and int8-quantize it) unless the file already exists."""
+    if os.path.exists(onnx_path):
+        return onnx_path
+    os.makedirs(os.path.dirname(os.path.abspath(onnx_path)), exist_ok=True)
+    fp32_path = onnx_path.replace("-int8.onnx", ".onnx") if quantize else onnx_path
+    if not os.path.exists(fp32_path):
+        dummy = torch.zeros(1, 3, image_size, image_size)
+        tmp_path = fp32_path + ".tmp"
+        torch.onnx.export(_ImageTower(model).eval(), (dummy,), tmp_path, input_names=["pixel_values"],
+                          output_names=["image_embeds"], opset_version=17, dynamo=False,
+                          dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}})
+        os.replace(tmp_path, fp32_path)
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        tmp_path = onnx_path + ".tmp"
+        quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, onnx_path)
+    return onnx_path
+
+
+def build_image_encoder(backend: str, model, model_name: str, cache_dir: str, threads: int = 0):
+    """Image encoder for CLIP_BACKEND: a callable mapping pixel_values [N,3,H,W] to embeddings [N,D]."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Invalid CLIP_BACKEND={backend!r}; choose from {', '.join(BACKENDS)}")
+    if backend.startswith("torch"):
+        return TorchImageEncoder(model, quantize=backend == "torch-int8")
+    quantize = backend == "onnx-int8"
+    stem = model_name.strip("/").replace("/", "--") + "-image" + ("-int8" if quantize else "")
+    onnx_path = export_onnx(model, os.path.join(cache_dir, stem + ".onnx"),
+                            model.config.vision_config.image_size, quantize=quantize)
+    return OnnxImageEncoder(onnx_path, threads)
@@ -0,0 +1,198 @@
+import json
+import os
+import threading
+import time
+from typing import Optional
+
+import numpy as np
+
+# Rows are scored in float32 blocks of this many: numpy has no BLAS path for float16 matmuls
+_SEARCH_BLOCK = 8192
+# Vectors used to train the IVF centroids, at most
+_IVF_TRAIN_SAMPLE = 50000
+_IVF_TRAIN_ITERS = 10
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def train_centroids(vectors: np.ndarray, n_lists: int, seed: int = 0, iters: int = _IVF_TRAIN_ITERS) -> np.ndarray:
+    """Spherical k-means over normalized float32 `vectors`; returns normalized centroids [n_lists, D]."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), size=n_lists, replace=False)].copy()
+    for _ in range(iters):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        empty = ~sums.any(axis=1)
+        # Re-seed empty lists with random vectors so every list stays in use
+        sums[empty] = vectors[rng.choice(len(vectors), size=int(empty.sum()))]
+        centroids = _normalize(sums)
+    return centroids
+
+
+class EmbeddingIndex:
+    """Fixed-capacity cosine-similarity index of L2-normalized image embeddings.
+
+    Vectors are kept as float16 rows of one [capacity, D] matrix (a .npy memmap under `path` when
+    given, so the index survives restarts) next to the id (image content hash) and insertion time
+    of each row. Once full, the oldest rows are overwritten.
+
+    search() scores every row with blocked float32 matmuls until the index holds `ivf_min` rows.
+    From then on it is IVF-partitioned: rows are assigned to the nearest of ~sqrt(N) k-means
+    centroids and a query only scores the rows of its `nprobe` closest lists. Centroids are
+    retrained whenever the index has doubled since the last training.
+    """
+
+    def __init__(self, capacity: int, path: Optional[str] = None, ivf_min: int = 20000, nprobe: int = 8):
+        self.capacity = capacity
+        self.path = path
+        self.ivf_min = ivf_min
+        self.nprobe = max(1, nprobe)
+        self._lock = threading.Lock()
+        self.vectors: Optional[np.ndarray] = None
+        self.ids: Optional[np.ndarray] = None
+        self.added: Optional[np.ndarray] = None
+        self.size = 0
+        self._next = 0
+        self._rows: dict[str, int] = {}
+        self._unflushed = 0
+        self.centroids: Optional[np.ndarray] = None
+        self._assign: Optional[np.ndarray] = None
+        self._trained_at = 0
+        if path and os.path.exists(os.path.join(path, "state.json")):
+            self._open(path)
+
+    def _files(self, path: str) -> dict[str, str]:
+        return {name: os.path.join(path, f"{name}.npy") for name in ("vectors", "ids", "added")}
+
+    def _open(self, path: str) -> None:
+        with open(os.path.join(path, "state.json"), "r", encoding="utf-8") as f:
+            state = json.load(f)
+        files = self._files(path)
+        vectors = np.load(files["vectors"], mmap_mode="r+")
+        if len(vectors) != self.capacity:
+            # Capacity changed: start over rather than silently dropping or misplacing rows
+            return
+        self.vectors = vectors
+        self.ids = np.load(files["ids"], mmap_mode="r+")
+        self.added = np.load(files["added"], mmap_mode="r+")
+        self.size, self._next = state["size"], state["next"]
+        self._rows = {self.ids[i].decode("ascii"): i for i in range(self.size)}
+        if self.size >= self.ivf_min:
+            self._train()
+
+    def _allocate(self, dim: int) -> None:
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+            files = self._files(self.path)
+            open_memmap = np.lib.format.open_memmap
+            self.vectors = open_memmap(files["vectors"], mode="w+", dtype=np.float16, shape=(self.capacity, dim))
+            self.ids = open_memmap(files["ids"], mode="w+", dtype="S64", shape=(self.capacity,))
+            self.added = open_memmap(files["added"], mode="w+", dtype=np.float64, shape=(self.capacity,))
+        else:
+            self.vectors = np.zeros((self.capacity, dim), dtype=np.float16)
+            self.ids = np.zeros(self.capacity, dtype="S64")
+            self.added = np.zeros(self.capacity, dtype=np.float64)
+
+    def add(self, vector: np.ndarray, item_id: str) -> None:
+        """Insert one embedding under `item_id`; ids already in the index are left as they are."""
+        vector = _normalize(vector).reshape(-1)
+        with self._lock:
+            if item_id in self._rows:
+                return
+            if self.vectors is None:
+                self._allocate(len(vector))
+            row = self._next
+            if self.size == self.capacity:
+                self._rows.pop(self.ids[row].decode("ascii"), None)
+            self.vectors[row] = vector
+            self.ids[row] = item_id.encode("ascii")
+            self.added[row] = time.time()
+            self._rows[item_id] = row
+            self._next = (row + 1) % self.capacity
+            self.size = min(self.size + 1, self.capacity)
+            if self.centroids is not None:
+                self._assign[row] = int(np.argmax(self.centroids @ vector))
+            if self.size >= self.ivf_min and self.size >= 2 * self._trained_at:
+                self._train()
+            self._unflushed += 1
+            if self.path and self._unflushed >= 256:
+                self._flush()
+
+    def _train(self) -> None:
+        rows = np.arange(self.size)
+        if self.size > _IVF_TRAIN_SAMPLE:
+            rows = np.random.default_rng(self.size).choice(self.size, size=_IVF_TRAIN_SAMPLE, replace=False)
+        n_lists = max(1, int(np.sqrt(self.size)))
+        self.centroids = train_centroids(self.vectors[np.sort(rows)].astype(np.float32), n_lists)
+        self._assign = np.full(self.capacity, -1, dtype=np.int32)
+        for start in range(0, self.size, _SEARCH_BLOCK):
+            block = self.vectors[start:start + _SEARCH_BLOCK].astype(np.float32)
+            self._assign[start:start + len(block)] = np.argmax(block @ self.centroids.T, axis=1)
+        self._trained_at = self.size
+
+    def search(self, vector: np.ndarray, k: int = 10) -> list[dict]:
+        """Top-k entries by cosine similarity: [{"id", "similarity", "added_at"}], best first."""
+        query = _normalize(vector).reshape(-1)
+        with self._lock:
+            if self.size == 0:
+                return []
+            if self.centroids is not None:
+                probes = np.argsort(self.centroids @ query)[::-1][:self.nprobe]
+                candidates = np.flatnonzero(np.isin(self._assign[:self.size], probes))
+            else:
+                candidates = np.arange(self.size)
+            if len(candidates) == 0:
+                return []
+            sims = np.empty(len(candidates), dtype=np.float32)
+            for start in range(0, len(candidates), _SEARCH_BLOCK):
+                rows = candidates[start:start + _SEARCH_BLOCK]
+                sims[start:start + len(rows)] = self.vectors[rows].astype(np.float32) @ query
+            k = min(k, len(candidates))
+            top = np.argpartition(-sims, k - 1)[:k] if k < len(candidates) else np.arange(len(candidates))
+            top = top[np.argsort(-sims[top])]
+            return [{"id": self.ids[candidates[i]].decode("ascii"), "similarity": float(sims[i]),
+                     "added_at": float(self.added[candidates[i]])} for i in top]
+
+    def _flush(self) -> None:
+        if self.vectors is None:
+            return
+        for array in (self.vectors, self.ids, self.added):
+            array.flush()
+        tmp_path = os.path.join(self.path, "state.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"size": self.size, "next": self._next}, f)
+        os.replace(tmp_path, os.path.join(self.path, "state.json"))
+        self._unflushed = 0
+
+    def flush(self) -> None:
+        """Write the memory-mapped rows and the fill state to disk (no-op without `path`)."""
+        if self.path:
+            with self._lock:
+                self._flush()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "size": self.size,
+                "capacity": self.capacity,
+                "ivf_lists": 0 if self.centroids is None else len(self.centroids),
+                "persistent": bool(self.path),
+            }
+
+
+def index_from_env() -> Optional[EmbeddingIndex]:
+    """Build the near-duplicate index from EMBED_INDEX_* settings; None when EMBED_INDEX_SIZE is 0."""
+    capacity = int(os.environ.get("EMBED_INDEX_SIZE", "0"))
+    if capacity <= 0:
+        return None
+    return EmbeddingIndex(
+        capacity,
+        path=os.environ.get("EMBED_INDEX_PATH") or None,
+        ivf_min=int(os.environ.get("EMBED_INDEX_IVF_MIN", "20000")),
+        nprobe=int(os.environ.get("EMBED_INDEX_NPROBE", "8")),
+    )
@@ -1,15 +1,31 @@
 import argparse
 import json
+import multiprocessing
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from typing import List
 
+import cv2
 import numpy as np
 from sklearn.metrics import accuracy_score, precision_recall_fscore_support, classification_report, confusion_matrix
 import matplotlib.pyplot as plt
 import pandas as pd
+import torch
 
 # Import the inference helpers from the existing service
-from main import ensure_models, segment_foreground, estimate_decay_ratio, clip_classify, combine_quality
+from main import (ensure_models, segment_foreground, estimate_decay_ratio, clip_classify, clip_classify_batch,
+                  combine_quality, build_augmentations,
+                  clip_image_embeddings, embeddings_to_logits, summarize_logits, CLIP_MODEL_NAME, label_prompts,
+                  TTA_AUGMENTATIONS, FUSION_PARAMS, DECAY_HSV_RANGES)
+import feature_store
+import main as pipeline
+from app import heuristic_inference
+from clip_backends import build_image_encoder
+from heuristics import HEURISTIC_PARAMS, clean_foreground_mask, label_from_decay
+from image_io import load_image, to_numpy
+from make_labels_csv import file_sha256
+from segmentation import parse_engine_spec
 from PIL import Image
 
 CLASSES: List[str] = [
@@ -19,26 +35,394 @@ CLASSES: List[str] = [
 ]
 
 
-def predict_label_full(image_path: str) -> str:
-    img = Image.open(image_path).convert("RGB")
-    cutout, mask = segment_foreground(img)
-    decay_ratio = estimate_decay_ratio(np.array(cutout), mask)
+def segment_and_score(image_path: str, work_max_side: int = 0) -> tuple[Image.Image, float]:
+    """Load an image, segment it and return the cutout with its decayed-area ratio."""
+    cutout, mask = segment_foreground(load_image(image_path, work_max_side))
+    return cutout, estimate_decay_ratio(to_numpy(cutout), mask)
+
+
+def predict_batch(image_paths: List[str], mode: str, work_max_side: int = 0) -> List[dict]:
+    """Predict a batch of images; returns one record per path (with an "error" key on failure).
+
+    In full mode all cutouts of the batch are scored by CLIP in a single batched pass. Light mode
+    scores each image exactly as the lightweight tier (app.py) would, at its LIGHT_MAX_SIDE.
+    """
+    records: List[dict] = [{} for _ in image_paths]
+    if mode == "light":
+        for i, image_path in enumerate(image_paths):
+            try:
+                with open(image_path, "rb") as f:
+                    resp = heuristic_inference(f.read())
+            except Exception as e:
+                records[i] = {"error": str(e)}
+                continue
+            records[i] = {"pred": resp["final_quality"], "decay_ratio": resp["decayed_area_ratio"],
+                          "final_scores": resp["final_scores"]}
+        return records
+    prepared = []
+    for i, image_path in enumerate(image_paths):
+        try:
+            cutout, decay_ratio = segment_and_score(image_path, work_max_side)
+        except Exception as e:
+            records[i] = {"error": str(e)}
+            continue
+        prepared.append((i, cutout, decay_ratio))
+
+    if mode == "full" and prepared:
+        results = clip_classify_batch([cutout for _, cutout, _ in prepared])
+        for (i, _, decay_ratio), cls in zip(prepared, results):
+            final_quality, final_scores = combine_quality(decay_ratio, cls["scores"])
+            records[i] = {"pred": final_quality, "decay_ratio": decay_ratio,
+                          "clip_scores": cls["scores"], "final_scores": final_scores}
+    else:
+        for i, _, decay_ratio in prepared:
+            records[i] = {"pred": label_from_decay(decay_ratio), "decay_ratio": decay_ratio}
+    return records
+
+
+def predict_label_full(image_path: str, work_max_side: int = 0) -> str:
+    cutout, decay_ratio = segment_and_score(image_path, work_max_side)
     cls = clip_classify(cutout)
-    final_quality = combine_quality(decay_ratio, cls["label"])
+    final_quality, _ = combine_quality(decay_ratio, cls["scores"])
     return final_quality
 
 
-def predict_label_simple(image_path: str) -> str:
+def predict_label_simple(image_path: str, work_max_side: int = 0) -> str:
     """Predict using only segmentation + HSV heuristic thresholds (no CLIP)."""
-    img = Image.open(image_path).convert("RGB")
-    cutout, mask = segment_foreground(img)
-    decay_ratio = estimate_decay_ratio(np.array(cutout), mask)
-    # Map decay to class without CLIP
-    if decay_ratio >= 0.5:
-        return "Completely Bad/Decomposed"
-    if decay_ratio >= 0.15:
-        return "Rotten/Spoiled"
-    return "Good/Fresh"
+    _, decay_ratio = segment_and_score(image_path, work_max_side)
+    return label_from_decay(decay_ratio)
+
+
+def init_worker(load_models: bool, threads: int) -> None:
+    """Process-pool initializer: split CPU threads between workers and load models once."""
+    torch.set_num_threads(threads)
+    if load_models:
+        ensure_models()
+
+
+def map_chunks(fn, chunks: List[list], workers: int, load_models: bool, *fn_args):
+    """Yield fn(chunk, *fn_args) for every chunk, in-process or on a worker pool (completion order)."""
+    if workers <= 1:
+        if load_models and chunks:
+            # Ensure models are loaded once
+            ensure_models()
+        for chunk in chunks:
+            yield fn(chunk, *fn_args)
+        return
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    # Spawned (not forked) workers: torch/onnxruntime thread pools do not survive fork()
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=init_worker,
+                             initargs=(load_models, threads)) as pool:
+        futures = [pool.submit(fn, chunk, *fn_args) for chunk in chunks]
+        for fut in as_completed(futures):
+            yield fut.result()
+
+
+def extract_chunk(chunk: List[dict], work_max_side: int, hsv_bins) -> List[dict]:
+    """Compute feature-store artifacts for a chunk of rows; CLIP runs once over the whole chunk."""
+    records: List[dict] = []
+    cutouts = []
+    for row in chunk:
+        try:
+            cutout, mask = segment_foreground(load_image(row["resolved_path"], work_max_side))
+            img_rgb = to_numpy(cutout)
+            mask_u8 = clean_foreground_mask(mask)
+            records.append({
+                "index": row["index"],
+                "decay": estimate_decay_ratio(img_rgb, mask),
+                "num_fg": cv2.countNonZero(mask_u8),
+                "hist": feature_store.hsv_histogram(img_rgb, mask_u8, hsv_bins),
+                "mask": feature_store.mask_thumbnail(mask_u8),
+            })
+            cutouts.append(cutout)
+        except Exception as e:
+            records.append({"index": row["index"], "image_path": row["image_path"], "error": str(e)})
+
+    ok = [rec for rec in records if "error" not in rec]
+    if ok:
+        augs = [build_augmentations(cutout) for cutout in cutouts]
+        embeddings = clip_image_embeddings([img for a in augs for img in a])
+        logits = embeddings_to_logits(embeddings)
+        embeddings = embeddings.cpu().numpy()
+        n_aug = len(augs[0])
+        for i, rec in enumerate(ok):
+            rec["embeddings"] = embeddings[i * n_aug:(i + 1) * n_aug]
+            rec["logits"] = logits[i * n_aug:(i + 1) * n_aug]
+    return records
+
+
+def run_extract(args, rows: List[dict]) -> None:
+    store_path = args.store or os.path.join(args.out_dir, "feature_store")
+    hsv_bins = tuple(int(x) for x in args.hsv_bins.split(","))
+    feature_store.bin_widths(hsv_bins)
+    for i, row in enumerate(rows):
+        row["index"] = i
+    meta = feature_store.store_meta(
+        [r["image_path"] for r in rows], [r["label"] for r in rows], hsv_bins,
+        {"clip_model": CLIP_MODEL_NAME, "label_prompts": list(label_prompts),
+         "tta": list(TTA_AUGMENTATIONS), "work_max_side": args.work_max_side,
+         "sha256": [r["sha256"] for r in rows]})
+    reuse = {}
+    if args.resume and os.path.exists(os.path.join(store_path, "meta.json")):
+        old_meta, old_arrays = feature_store.open_store(store_path)
+        reuse = feature_store.reusable_rows(old_meta, old_arrays["valid"], meta)
+    # With rows to copy, the new store is written next to the old one and replaces it at the end
+    writer = feature_store.FeatureStoreWriter(f"{store_path}.tmp" if reuse else store_path, meta)
+    for i, old_i in reuse.items():
+        writer.write(i, {name: old_arrays[name][old_i] for name in feature_store.ROW_FIELDS})
+    if args.resume:
+        print(f"Resuming: {len(reuse)} of {len(rows)} images already in {store_path}")
+    todo = [r for r in rows if r["index"] not in reuse]
+    batch_size = max(1, args.batch_size)
+    chunks = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+    done = len(reuse)
+    for records in map_chunks(extract_chunk, chunks, args.workers, True, args.work_max_side, hsv_bins):
+        for rec in records:
+            if "error" in rec:
+                print(f"[ERROR] Failed on {rec['image_path']}: {rec['error']}")
+                continue
+            writer.write(rec["index"], rec)
+            done += 1
+    if not writer.arrays:
+        raise RuntimeError("No valid samples extracted. Check CSV paths and labels.")
+    writer.close()
+    if reuse:
+        del old_arrays
+        feature_store.replace_store(writer.path, store_path)
+    print(f"Extracted features for {done} of {len(rows)} images into {store_path}")
+
+
+_parity_reference = None
+
+
+def parity_chunk(chunk: List[dict], work_max_side: int) -> List[dict]:
+    """Score a chunk with the CLIP_BACKEND encoder and the eager torch reference on identical inputs."""
+    global _parity_reference
+    ensure_models()
+    if _parity_reference is None:
+        _parity_reference = build_image_encoder("torch", pipeline.clip_model, CLIP_MODEL_NAME, pipeline.CLIP_ONNX_DIR)
+    records: List[dict] = []
+    for row in chunk:
+        try:
+            cutout, _ = segment_and_score(row["resolved_path"], work_max_side)
+            augs = build_augmentations(cutout)
+            results = {}
+            for name, encoder in (("reference", _parity_reference), ("backend", None)):
+                start = time.perf_counter()
+                logits = embeddings_to_logits(clip_image_embeddings(augs, encoder=encoder))
+                results[name] = (summarize_logits(logits), time.perf_counter() - start)
+            ref, ref_s = results["reference"]
+            out, out_s = results["backend"]
+            records.append({
+                "image_path": row["image_path"],
+                "label": row["label"],
+                "reference_pred": ref["label"],
+                "backend_pred": out["label"],
+                "max_abs_score_diff": max(abs(ref["scores"][k] - out["scores"][k]) for k in ref["scores"]),
+                "reference_s": ref_s,
+                "backend_s": out_s,
+            })
+        except Exception as e:
+            records.append({"image_path": row["image_path"], "error": str(e)})
+    return records
+
+
+def run_parity(args, rows: List[dict]) -> None:
+    batch_size = max(1, args.batch_size)
+    chunks = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+    records = []
+    for chunk_records in map_chunks(parity_chunk, chunks, args.workers, True, args.work_max_side):
+        for rec in chunk_records:
+            if "error" in rec:
+                print(f"[ERROR] Failed on {rec['image_path']}: {rec['error']}")
+            else:
+                records.append(rec)
+    if not records:
+        raise RuntimeError("No valid samples to compare. Check CSV paths and labels.")
+
+    diffs = np.array([r["max_abs_score_diff"] for r in records])
+    report = {
+        "backend": pipeline.CLIP_BACKEND,
+        "num_samples": len(records),
+        "tolerance": args.tolerance,
+        "max_abs_score_diff": float(diffs.max()),
+        "mean_abs_score_diff": float(diffs.mean()),
+        "label_agreement": float(np.mean([r["reference_pred"] == r["backend_pred"] for r in records])),
+        "reference_accuracy": float(np.mean([r["reference_pred"] == r["label"] for r in records])),
+        "backend_accuracy": float(np.mean([r["backend_pred"] == r["label"] for r in records])),
+        "reference_ms_per_image": 1000.0 * float(np.mean([r["reference_s"] for r in records])),
+        "backend_ms_per_image": 1000.0 * float(np.mean([r["backend_s"] for r in records])),
+        "passed": bool(diffs.max() <= args.tolerance),
+        "worst": sorted(records, key=lambda r: -r["max_abs_score_diff"])[:10],
+    }
+    with open(os.path.join(args.out_dir, "parity_report.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps({k: v for k, v in report.items() if k != "worst"}, indent=2))
+    if not report["passed"]:
+        raise SystemExit(f"CLIP_BACKEND={pipeline.CLIP_BACKEND} exceeds the score tolerance {args.tolerance}")
+
+
+_seg_engines: dict = {}
+
+
+def segmentation_chunk(chunk: List[dict], work_max_side: int, specs: List[str], threads: int) -> List[dict]:
+    """Run the full pipeline on a chunk once per segmentation engine spec, timing segmentation."""
+    ensure_models()
+    records: List[dict] = []
+    for row in chunk:
+        try:
+            img = load_image(row["resolved_path"], work_max_side)
+            results = {}
+            for spec in specs:
+                engine = _seg_engines.get(spec)
+                if engine is None:
+                    engine = _seg_engines[spec] = parse_engine_spec(spec, threads)
+                    engine.load()
+                start = time.perf_counter()
+                cutout, mask, method = engine.segment(img)
+                seg_s = time.perf_counter() - start
+                decay = estimate_decay_ratio(to_numpy(cutout), mask)
+                pred, _ = combine_quality(decay, clip_classify(cutout).get("scores", {}))
+                results[spec] = {"pred": pred, "seg_s": seg_s, "method": method}
+            records.append({"image_path": row["image_path"], "label": row["label"], "results": results})
+        except Exception as e:
+            records.append({"image_path": row["image_path"], "error": str(e)})
+    return records
+
+
+def run_segmentation(args, rows: List[dict]) -> None:
+    specs = [s.strip() for s in args.seg_models.split(",") if s.strip()]
+    for spec in specs:
+        parse_engine_spec(spec)
+    batch_size = max(1, args.batch_size)
+    chunks = [rows[i:i + batch_size] for i in range(0, len(rows), batch_size)]
+    records = []
+    for chunk_records in map_chunks(segmentation_chunk, chunks, args.workers, True, args.work_max_side,
+                                    specs, args.seg_threads):
+        for rec in chunk_records:
+            if "error" in rec:
+                print(f"[ERROR] Failed on {rec['image_path']}: {rec['error']}")
+            else:
+                records.append(rec)
+    if not records:
+        raise RuntimeError("No valid samples evaluated. Check CSV paths and labels.")
+
+    y_true = [r["label"] for r in records]
+    report = {"num_samples": len(records), "work_max_side": args.work_max_side, "models": {}}
+    for spec in specs:
+        y_pred = [r["results"][spec]["pred"] for r in records]
+        seg_ms = 1000.0 * np.array([r["results"][spec]["seg_s"] for r in records])
+        _, _, f1, _ = precision_recall_fscore_support(y_true, y_pred, labels=CLASSES, average="macro", zero_division=0)
+        methods: dict = {}
+        for r in records:
+            method = r["results"][spec]["method"]
+            methods[method] = methods.get(method, 0) + 1
+        report["models"][spec] = {
+            "accuracy": float(accuracy_score(y_true, y_pred)),
+            "f1_macro": float(f1),
+            "seg_ms_mean": float(seg_ms.mean()),
+            "seg_ms_p50": float(np.percentile(seg_ms, 50)),
+            "seg_ms_p95": float(np.percentile(seg_ms, 95)),
+            "methods": methods,
+        }
+    with open(os.path.join(args.out_dir, "segmentation_report.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+def run_sweep(args) -> None:
+    store_path = args.store or os.path.join(args.out_dir, "feature_store")
+    report = feature_store.sweep(
+        store_path, FUSION_PARAMS, [(lo.tolist(), hi.tolist()) for lo, hi in DECAY_HSV_RANGES],
+        trials=args.trials, seed=args.seed, objective=args.objective, search=args.search)
+    config_path = os.path.join(args.out_dir, "best_quality_config.json")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(feature_store.quality_config(report["best"]), f, indent=2)
+    with open(os.path.join(args.out_dir, "sweep_metrics.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps({"baseline": report["baseline"],
+                      "best": {k: report["best"][k] for k in ("accuracy", "f1_macro")}}, indent=2))
+    print("Saved:", config_path, "(load it with QUALITY_CONFIG=<path>)")
+
+
+def run_cascade(args) -> None:
+    """Calibrate the INFER_CASCADE thresholds on a feature store and report the accuracy/compute trade-off."""
+    store_path = args.store or os.path.join(args.out_dir, "feature_store")
+    report = feature_store.cascade_tradeoff(store_path, FUSION_PARAMS, HEURISTIC_PARAMS,
+                                            max_accuracy_drop=args.max_accuracy_drop)
+    best = report["best"]
+    config = {
+        "fusion": dict(FUSION_PARAMS),
+        "decay_hsv_ranges": [[lo.tolist(), hi.tolist()] for lo, hi in DECAY_HSV_RANGES],
+        "heuristic": dict(HEURISTIC_PARAMS),
+        "cascade": {k: best[k] for k in ("good_below", "bad_above", "tta")},
+    }
+    config_path = os.path.join(args.out_dir, "cascade_quality_config.json")
+    with open(config_path, "w", encoding="utf-8") as f:
+        json.dump(config, f, indent=2)
+    with open(os.path.join(args.out_dir, "cascade_metrics.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps({k: report[k] for k in ("always_clip", "always_clip_single_view", "heuristic_only", "best")},
+                     indent=2))
+    print(f"{'good_below':>10}  {'bad_above':>9}  {'tta':>5}  {'accuracy':>8}  {'f1_macro':>8}  {'clip_share':>10}  views/img")
+    for c in report["frontier"]:
+        print(f"{c['good_below']:10.4f}  {c['bad_above']:9.4f}  {str(c['tta']):>5}  {c['accuracy']:8.4f}  "
+              f"{c['f1_macro']:8.4f}  {c['clip_fraction']:10.1%}  {c['clip_views_per_image']:.2f}")
+    print("Saved:", config_path, "(serve it with INFER_CASCADE=1 QUALITY_CONFIG=<path>)")
+
+
+def evaluate_chunk(chunk: List[dict], mode: str, work_max_side: int, compare: bool) -> List[dict]:
+    """Predict one chunk of CSV rows and return checkpoint records in the same order."""
+    paths = [row["resolved_path"] for row in chunk]
+    records = predict_batch(paths, mode, work_max_side)
+    if compare:
+        full_res = predict_batch(paths, mode)
+        for rec, rec_full in zip(records, full_res):
+            if "error" not in rec:
+                if "error" in rec_full:
+                    rec["error"] = rec_full["error"]
+                else:
+                    rec["pred_full_res"] = rec_full["pred"]
+    out = []
+    for row, rec in zip(chunk, records):
+        out.append({"image_path": row["image_path"], "label": row["label"], "mode": mode,
+                    "work_max_side": work_max_side, "sha256": row["sha256"], **rec})
+    return out
+
+
+def checkpoint_key(image_path: str, mode: str, work_max_side: int, sha256: str | None = None) -> tuple:
+    # With a manifest CSV the content hash is part of the key, so changed images are redone
+    return (image_path, mode, work_max_side, sha256)
+
+
+def drop_partial_line(path: str) -> None:
+    """Truncate a half-written last line left by a crash so appended records start cleanly."""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        data = f.read()
+        if data and not data.endswith(b"\n"):
+            f.truncate(data.rfind(b"\n") + 1)
+
+
+def load_checkpoint(path: str) -> dict:
+    """Read a predictions JSONL checkpoint into {checkpoint_key: record}; later lines win."""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                # A crash mid-write can leave a truncated line; that image is simply redone
+                continue
+            done[checkpoint_key(rec["image_path"], rec["mode"], rec["work_max_side"], rec.get("sha256"))] = rec
+    return done
 
 
 def plot_confusion_matrix(cm: np.ndarray, classes: List[str], out_path: str) -> None:
@@ -68,49 +452,133 @@ def plot_confusion_matrix(cm: np.ndarray, classes: List[str], out_path: str) ->
     plt.close(fig)
 
 
+def load_rows(args) -> List[dict]:
+    """Read the labels CSV into rows with resolved image paths, skipping missing files.
+
+    A make_labels_csv.py --manifest CSV may list an image several times; its latest row wins, and
+    rows carry the content hash so --resume only redoes new or changed images. Rows without a hash
+    (a plain CSV, or an empty or NaN sha256 cell) are hashed here, so a checkpoint or feature store
+    row is only ever reused for the same content.
+    """
+    df = pd.read_csv(args.csv, dtype=str)
+    if args.image_col not in df.columns or args.label_col not in df.columns:
+        raise ValueError(f"CSV must contain '{args.image_col}' and '{args.label_col}' columns")
+    manifest = "sha256" in df.columns
+    if manifest:
+        df = df.drop_duplicates(args.image_col, keep="last")
+
+    hashes = df["sha256"] if manifest else [None] * len(df)
+    rows = []
+    for img_path, label, sha256 in zip(df[args.image_col], df[args.label_col], hashes):
+        img_path = str(img_path)
+        # CSVs written on Windows use backslashes
+        resolved = img_path.replace("\\", "/")
+        if not os.path.isabs(resolved):
+            resolved = os.path.join(os.path.dirname(args.csv), resolved)
+        if not os.path.exists(resolved):
+            print(f"[WARN] Image not found, skipping: {resolved}")
+            continue
+        # pandas reads an empty cell as NaN even with dtype=str
+        if pd.isna(sha256) or str(sha256).strip().lower() in ("", "nan"):
+            sha256 = file_sha256(resolved)
+        rows.append({"image_path": img_path, "resolved_path": resolved, "label": str(label),
+                     "sha256": sha256})
+    return rows
+
+
 def main():
     parser = argparse.ArgumentParser(description="Evaluate CLIP-based quality classifier on a labeled dataset CSV")
-    parser.add_argument("--csv", required=True, help="Path to CSV with columns: image_path,label")
+    parser.add_argument("--csv", help="Path to CSV with columns: image_path,label (not needed for --mode sweep/cascade)")
     parser.add_argument("--image-col", default="image_path", help="CSV column for image paths")
     parser.add_argument("--label-col", default="label", help="CSV column for ground-truth labels")
     parser.add_argument("--out-dir", default="evaluation_out", help="Directory to write metrics and confusion matrix")
-    parser.add_argument("--mode", choices=["full", "simple"], default="full", help="Evaluation mode: 'full' uses CLIP+heuristic; 'simple' uses heuristic only (no transformers)")
+    parser.add_argument("--mode", choices=["full", "simple", "light", "extract", "sweep", "cascade", "parity", "segmentation"], default="full", help="Evaluation mode: 'full' uses CLIP+heuristic; 'simple' uses heuristic only (no transformers); 'light' runs the lightweight tier (app.py: OpenCV foreground, no rembg); 'extract' stores per-image features for 'sweep', which searches fusion weights and HSV cutoffs over them, and 'cascade', which calibrates the INFER_CASCADE early exit against always running CLIP; 'parity' compares CLIP_BACKEND scores with the torch reference; 'segmentation' compares accuracy and latency of --seg-models")
+    parser.add_argument("--work-max-side", type=int, default=0, help="Downscale images so the longest side is at most this many pixels before segmentation (0 = full resolution)")
+    parser.add_argument("--compare-full-res", action="store_true", help="With --work-max-side, also predict at full resolution and report the accuracy delta")
+    parser.add_argument("--workers", type=int, default=1, help="Worker processes; each loads the models once")
+    parser.add_argument("--batch-size", type=int, default=1, help="Images per task; in full mode their cutouts share one batched CLIP pass")
+    parser.add_argument("--checkpoint", default=None, help="Per-image predictions JSONL (default: <out-dir>/predictions.jsonl)")
+    parser.add_argument("--resume", action="store_true", help="Keep the existing checkpoint and skip images already predicted with the same settings and content (hashed from the manifest, or from the file for a plain CSV); for --mode extract, copy the rows of unchanged images from the existing --store")
+    parser.add_argument("--tolerance", type=float, default=0.02, help="Largest per-class score difference --mode parity accepts")
+    parser.add_argument("--seg-models", default="u2net,u2netp,silueta", help="Comma-separated rembg models for --mode segmentation; append +saturation or +grabcut to enable the OpenCV fallback")
+    parser.add_argument("--seg-threads", type=int, default=0, help="onnxruntime intra-op threads per segmentation session (0 = default)")
+    parser.add_argument("--store", default=None, help="Feature store directory for extract/sweep/cascade (default: <out-dir>/feature_store)")
+    parser.add_argument("--hsv-bins", default=",".join(str(b) for b in feature_store.DEFAULT_HSV_BINS), help="H,S,V histogram bins stored by extract; must divide 180,256,256")
+    parser.add_argument("--trials", type=int, default=2000, help="Random candidates evaluated by sweep (candidate 0 is the current config)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for sweep")
+    parser.add_argument("--objective", choices=["accuracy", "f1_macro"], default="accuracy", help="Metric sweep maximizes")
+    parser.add_argument("--search", choices=["both", "fusion", "hsv"], default="both", help="Parameters sweep varies")
+    parser.add_argument("--max-accuracy-drop", type=float, default=0.01, help="Accuracy cascade may give up against always running CLIP")
     args = parser.parse_args()
 
     os.makedirs(args.out_dir, exist_ok=True)
-
-    # In full mode ensure models are loaded once
-    if args.mode == "full":
-        ensure_models()
-
-    df = pd.read_csv(args.csv)
-    if args.image_col not in df.columns or args.label_col not in df.columns:
-        raise ValueError(f"CSV must contain '{args.image_col}' and '{args.label_col}' columns")
-
+    if args.mode == "sweep":
+        run_sweep(args)
+        return
+    if args.mode == "cascade":
+        run_cascade(args)
+        return
+    if not args.csv:
+        parser.error(f"--csv is required for --mode {args.mode}")
+
+    rows = load_rows(args)
+    if args.mode == "extract":
+        run_extract(args, rows)
+        return
+    if args.mode == "parity":
+        run_parity(args, rows)
+        return
+    if args.mode == "segmentation":
+        run_segmentation(args, rows)
+        return
+
+    checkpoint_path = args.checkpoint or os.path.join(args.out_dir, "predictions.jsonl")
+    compare = args.compare_full_res and args.work_max_side > 0
+
+    def finished(done: dict, row: dict) -> dict | None:
+        rec = done.get(checkpoint_key(row["image_path"], args.mode, args.work_max_side, row["sha256"]))
+        if rec is None or (compare and "pred_full_res" not in rec):
+            return None
+        return rec
+
+    if args.resume:
+        drop_partial_line(checkpoint_path)
+    done = load_checkpoint(checkpoint_path) if args.resume else {}
+    todo = [r for r in rows if finished(done, r) is None]
+    if args.resume:
+        print(f"Resuming: {len(rows) - len(todo)} of {len(rows)} images already in {checkpoint_path}")
+
+    batch_size = max(1, args.batch_size)
+    chunks = [todo[i:i + batch_size] for i in range(0, len(todo), batch_size)]
+    workers = max(1, args.workers)
+
+    def write_records(f, records: List[dict]) -> None:
+        for rec in records:
+            if "error" in rec:
+                print(f"[ERROR] Failed on {rec['image_path']}: {rec['error']}")
+                continue
+            f.write(json.dumps(rec) + "\n")
+        # Flush per chunk so a crash loses at most the chunk in flight
+        f.flush()
+
+    with open(checkpoint_path, "a" if args.resume else "w", encoding="utf-8") as f:
+        for records in map_chunks(evaluate_chunk, chunks, workers, args.mode == "full",
+                                  args.mode, args.work_max_side, compare):
+            write_records(f, records)
+
+    # Metrics always come from the checkpoint so resumed and fresh runs report the same way
+    done = load_checkpoint(checkpoint_path)
     y_true: List[str] = []
     y_pred: List[str] = []
-
-    for idx, row in df.iterrows():
-        img_path = row[args.image_col]
-        label = str(row[args.label_col])
-
-        if not os.path.isabs(img_path):
-            img_path = os.path.join(os.path.dirname(args.csv), img_path)
-        if not os.path.exists(img_path):
-            print(f"[WARN] Image not found, skipping: {img_path}")
+    y_pred_full_res: List[str] = []
+    for r in rows:
+        rec = finished(done, r)
+        if rec is None:
             continue
-
-        try:
-            if args.mode == "full":
-                pred = predict_label_full(img_path)
-            else:
-                pred = predict_label_simple(img_path)
-        except Exception as e:
-            print(f"[ERROR] Failed on {img_path}: {e}")
-            continue
-
-        y_true.append(label)
-        y_pred.append(pred)
+        y_true.append(r["label"])
+        y_pred.append(rec["pred"])
+        if compare:
+            y_pred_full_res.append(rec["pred_full_res"])
 
     if not y_true:
         raise RuntimeError("No valid samples evaluated. Check CSV paths and labels.")
@@ -161,13 +629,26 @@ def main():
         "per_class": per_class,
         "confusion_matrix_counts": cm.tolist(),
         "confusion_matrix_png": os.path.basename(cm_path),
+        "work_max_side": args.work_max_side,
+        "predictions_jsonl": checkpoint_path,
     }
 
+    if compare:
+        acc_full_res = accuracy_score(y_true, y_pred_full_res)
+        report["full_resolution_comparison"] = {
+            "accuracy_full_res": float(acc_full_res),
+            "accuracy_work_res": float(acc),
+            "accuracy_delta": float(acc - acc_full_res),
+            "prediction_agreement": float(np.mean([a == b for a, b in zip(y_pred, y_pred_full_res)])),
+        }
+
     with open(os.path.join(args.out_dir, "metrics.json"), "w", encoding="utf-8") as f:
         json.dump(report, f, indent=2)
 
     # Also print a brief text report
     print(json.dumps(report["overall"], indent=2))
+    if compare:
+        print(json.dumps(report["full_resolution_comparison"], indent=2))
     print("Saved:", cm_path, os.path.join(args.out_dir, "metrics.json"))
 
 
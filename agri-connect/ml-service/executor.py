@@ -0,0 +1,102 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+
+class QueueFullError(RuntimeError):
+    """Raised when the executor already holds as many requests as it is allowed to admit."""
+
+
+class InferenceExecutor:
+    """Bounded worker pool that runs blocking inference off the asyncio event loop.
+
+    At most `workers` jobs run at once and at most `queue_size` more wait for a free worker;
+    anything beyond that is rejected immediately with QueueFullError so callers can shed load
+    instead of piling up requests. Each job is awaited for at most `timeout_s` seconds.
+    """
+
+    def __init__(self, workers: int, queue_size: int, timeout_s: float,
+                 initializer: Optional[Callable[[], None]] = None):
+        self.workers = max(1, workers)
+        self.queue_size = max(0, queue_size)
+        self.timeout_s = timeout_s
+        self._initializer = initializer
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self._admitted = 0
+
+    @property
+    def in_flight(self) -> int:
+        """Number of admitted jobs, running or waiting for a worker."""
+        return self._admitted
+
+    @property
+    def queue_depth(self) -> int:
+        """Number of admitted jobs still waiting for a worker."""
+        return max(0, self._admitted - self.workers)
+
+    def start(self) -> None:
+        """Create the pool and run the initializer on every worker before serving traffic."""
+        if self._pool is not None:
+            return
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="infer",
+                                        initializer=self._initializer)
+        self.run_on_every_worker(lambda: None)
+
+    def run_on_every_worker(self, fn: Callable[[], None]) -> None:
+        """Call fn() once on each worker thread (e.g. a warmup once the models have loaded) and
+        block until every call has returned; raises the first error."""
+        # ThreadPoolExecutor spawns threads lazily; the barrier forces one task onto each worker,
+        # which also runs the initializer there first.
+        barrier = threading.Barrier(self.workers)
+
+        def task() -> None:
+            barrier.wait()
+            fn()
+
+        for f in [self._pool.submit(task) for _ in range(self.workers)]:
+            f.result()
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=True, cancel_futures=True)
+            self._pool = None
+
+    def _release(self, _: Future) -> None:
+        with self._lock:
+            self._admitted -= 1
+
+    async def run(self, fn: Callable[..., Any], *args: Any) -> Any:
+        """Run `fn(*args)` on a worker thread and await its result.
+
+        Raises QueueFullError when the admission queue is full and asyncio.TimeoutError when the
+        job does not finish within `timeout_s`. A timed-out job that has not started yet is
+        dropped; one that is already running finishes in the background and keeps its slot
+        until it does, so the bound on concurrent work always holds.
+        """
+        if self._pool is None:
+            raise RuntimeError("InferenceExecutor.start() has not been called")
+        with self._lock:
+            if self._admitted >= self.workers + self.queue_size:
+                raise QueueFullError("inference queue is full")
+            self._admitted += 1
+        try:
+            fut = self._pool.submit(fn, *args)
+        except BaseException:
+            with self._lock:
+                self._admitted -= 1
+            raise
+        fut.add_done_callback(self._release)
+        return await asyncio.wait_for(asyncio.wrap_future(fut), timeout=self.timeout_s)
+
+
+def executor_from_env(initializer: Optional[Callable[[], None]] = None) -> InferenceExecutor:
+    """Build an executor configured by INFER_WORKERS, INFER_QUEUE_SIZE and INFER_TIMEOUT_S."""
+    return InferenceExecutor(
+        workers=int(os.environ.get("INFER_WORKERS", "2")),
+        queue_size=int(os.environ.get("INFER_QUEUE_SIZE", "16")),
+        timeout_s=float(os.environ.get("INFER_TIMEOUT_S", "120")),
+        initializer=initializer,
+    )
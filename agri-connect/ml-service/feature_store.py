@@ -0,0 +1,458 @@
+"""Per-image feature store and vectorized parameter sweeps for the quality heuristics.
+
+`evaluate.py --mode extract` runs segmentation and CLIP once per image and stores the artifacts
+here as .npy files that are opened memory-mapped. `evaluate.py --mode sweep` then re-scores every
+image for thousands of candidate combine_quality weights and HSV decay cutoffs with plain NumPy,
+without touching the models again.
+
+Decay ratios for candidate HSV cutoffs are recovered from a joint HSV histogram of the cleaned
+foreground, so cutoffs are searched on histogram bin edges (default 4 hue x 8 sat x 8 val units).
+"""
+import json
+import os
+import shutil
+from typing import Optional
+
+import cv2
+import numpy as np
+
+# OpenCV 8-bit HSV value ranges
+HSV_RANGES = (180, 256, 256)
+DEFAULT_HSV_BINS = (45, 32, 32)
+MASK_SIDE = 64
+# Per-image arrays of a store, filled by FeatureStoreWriter.write
+ROW_FIELDS = ("hist", "embeddings", "logits", "mask", "decay", "num_fg")
+
+CLASS_ORDER = ["Good/Fresh", "Rotten/Spoiled", "Completely Bad/Decomposed"]
+
+# combine_quality parameters searched by random_fusion_params, with their sampling ranges
+FUSION_SEARCH_SPACE = {
+    "ai_confident": (0.5, 0.95),
+    "clean_decay": (0.0, 0.2),
+    "w_ai_confident": (0.05, 0.95),
+    "w_ai_clean": (0.05, 0.95),
+    "w_ai_default": (0.05, 0.95),
+    "weak_best_score": (0.34, 0.6),
+    "weak_best_decay": (0.0, 0.3),
+    "low_decay": (0.0, 0.3),
+    "rotten_margin": (-0.2, 0.5),
+}
+
+
+def hsv_histogram(img_rgb: np.ndarray, mask_u8: np.ndarray, bins=DEFAULT_HSV_BINS) -> np.ndarray:
+    """Joint H x S x V pixel counts inside the mask, as uint32."""
+    hsv = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2HSV)
+    hist = cv2.calcHist([hsv], [0, 1, 2], mask_u8, list(bins),
+                        [0, HSV_RANGES[0], 0, HSV_RANGES[1], 0, HSV_RANGES[2]])
+    return np.rint(hist).astype(np.uint32)
+
+
+def mask_thumbnail(mask_u8: np.ndarray, side: int = MASK_SIDE) -> np.ndarray:
+    """Bit-packed side x side thumbnail of a foreground mask."""
+    small = cv2.resize(mask_u8, (side, side), interpolation=cv2.INTER_AREA)
+    return np.packbits(small >= 128)
+
+
+class FeatureStoreWriter:
+    """Fill a feature store row by row; arrays are allocated as .npy memmaps on the first row."""
+
+    def __init__(self, path: str, meta: dict):
+        self.path = path
+        self.meta = dict(meta)
+        self.n = len(meta["image_paths"])
+        self.arrays: dict[str, np.memmap] = {}
+        os.makedirs(path, exist_ok=True)
+
+    def _allocate(self, record: dict) -> None:
+        specs = {
+            "hist": (record["hist"].shape, np.uint32),
+            "embeddings": (record["embeddings"].shape, np.float16),
+            "logits": (record["logits"].shape, np.float32),
+            "mask": (record["mask"].shape, np.uint8),
+        }
+        for name, (shape, dtype) in specs.items():
+            self.arrays[name] = np.lib.format.open_memmap(
+                os.path.join(self.path, f"{name}.npy"), mode="w+", dtype=dtype, shape=(self.n, *shape))
+        for name, dtype in (("decay", np.float64), ("num_fg", np.int64), ("valid", np.bool_)):
+            self.arrays[name] = np.lib.format.open_memmap(
+                os.path.join(self.path, f"{name}.npy"), mode="w+", dtype=dtype, shape=(self.n,))
+
+    def write(self, index: int, record: dict) -> None:
+        if not self.arrays:
+            self._allocate(record)
+        for name in ROW_FIELDS:
+            self.arrays[name][index] = record[name]
+        self.arrays["valid"][index] = True
+
+    def close(self) -> None:
+        for arr in self.arrays.values():
+            arr.flush()
+        # Drop the memmaps so the directory can be moved (see replace_store)
+        self.arrays = {}
+        with open(os.path.join(self.path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(self.meta, f, indent=2)
+
+
+def open_store(path: str) -> tuple[dict, dict[str, np.ndarray]]:
+    """Open a feature store read-only; arrays are memory-mapped."""
+    with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    arrays = {}
+    for name in (*ROW_FIELDS, "valid"):
+        arrays[name] = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+    return meta, arrays
+
+
+def reusable_rows(old_meta: dict, old_valid: np.ndarray, meta: dict) -> dict[int, int]:
+    """Rows of an existing store that a store for `meta` can copy instead of re-extracting: {new: old}.
+
+    Requires the same extraction settings (every meta key but the per-image lists), and a valid old
+    row with the same image path and content hash (meta "sha256", from a manifest CSV).
+    """
+    per_image = ("image_paths", "labels", "sha256")
+    settings = {k: v for k, v in meta.items() if k not in per_image}
+    if any(old_meta.get(k) != v for k, v in settings.items()) or "sha256" not in old_meta:
+        return {}
+    old_rows = {(path, sha): i for i, (path, sha) in enumerate(zip(old_meta["image_paths"], old_meta["sha256"]))
+                if sha is not None and old_valid[i]}
+    reuse = {}
+    for i, key in enumerate(zip(meta["image_paths"], meta.get("sha256", []))):
+        if key in old_rows:
+            reuse[i] = old_rows[key]
+    return reuse
+
+
+def replace_store(tmp_path: str, path: str) -> None:
+    """Move a store written to `tmp_path` over the one at `path`."""
+    old_path = f"{path}.old"
+    shutil.rmtree(old_path, ignore_errors=True)
+    if os.path.exists(path):
+        os.replace(path, old_path)
+    os.replace(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+
+
+def bin_widths(bins) -> tuple[int, int, int]:
+    widths = tuple(r // b for r, b in zip(HSV_RANGES, bins))
+    if any(r % b for r, b in zip(HSV_RANGES, bins)):
+        raise ValueError(f"HSV bins {bins} must evenly divide {HSV_RANGES}")
+    return widths
+
+
+def ranges_to_bins(ranges, bins) -> np.ndarray:
+    """Inclusive HSV value boxes [(lo, hi), ...] -> inclusive bin boxes of shape [n_boxes, 2, 3]."""
+    widths = np.array(bin_widths(bins))
+    limits = np.array(bins) - 1
+    out = []
+    for lo, hi in ranges:
+        lo_bin = np.clip(np.rint(np.asarray(lo, dtype=float) / widths), 0, limits)
+        hi_bin = np.clip(np.rint((np.asarray(hi, dtype=float) + 1) / widths) - 1, 0, limits)
+        out.append([lo_bin, hi_bin])
+    return np.array(out, dtype=np.int64)
+
+
+def bins_to_ranges(boxes: np.ndarray, bins) -> list:
+    """Inverse of ranges_to_bins for one candidate: bin boxes [n_boxes, 2, 3] -> value boxes."""
+    widths = np.array(bin_widths(bins))
+    maxima = np.array(HSV_RANGES) - 1
+    out = []
+    for lo_bin, hi_bin in boxes:
+        lo = lo_bin * widths
+        hi = np.minimum((hi_bin + 1) * widths - 1, maxima)
+        # An upper bound at the top of a channel keeps matching everything above it, as in the
+        # hand-written ranges (e.g. hue 255 for "any hue")
+        hi = np.where(hi_bin == np.array(bins) - 1, 255, hi)
+        out.append([lo.astype(int).tolist(), hi.astype(int).tolist()])
+    return out
+
+
+def summed_area_table(hist: np.ndarray) -> np.ndarray:
+    """Zero-padded 3-D cumulative sums over [I, H, S, V] histograms."""
+    sat = np.zeros((hist.shape[0], hist.shape[1] + 1, hist.shape[2] + 1, hist.shape[3] + 1), dtype=np.int64)
+    sat[:, 1:, 1:, 1:] = np.asarray(hist, dtype=np.int64).cumsum(1).cumsum(2).cumsum(3)
+    return sat
+
+
+def box_counts(sat: np.ndarray, lo: np.ndarray, hi: np.ndarray) -> np.ndarray:
+    """Pixel counts inside inclusive bin boxes for every candidate and image.
+
+    `lo`/`hi` have shape [C, 3]; returns [C, I]. Empty boxes (lo > hi) count zero.
+    """
+    a = lo[:, None, :]
+    b = np.maximum(hi + 1, lo)[:, None, :]
+    img = np.arange(sat.shape[0])[None, :]
+    total = np.zeros((lo.shape[0], sat.shape[0]), dtype=np.int64)
+    for dh in (0, 1):
+        for ds in (0, 1):
+            for dv in (0, 1):
+                # Inclusion-exclusion: corners with an odd number of upper bounds add
+                sign = 1 if (dh + ds + dv) % 2 == 1 else -1
+                h = np.where(dh, b[..., 0], a[..., 0])
+                s = np.where(ds, b[..., 1], a[..., 1])
+                v = np.where(dv, b[..., 2], a[..., 2])
+                total += sign * sat[img, h, s, v]
+    return total
+
+
+def union_counts(sat: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    """Pixels inside the union of three boxes per candidate (inclusion-exclusion); boxes [C, 3, 2, 3]."""
+    if boxes.shape[1] != 3:
+        raise ValueError("union_counts expects exactly three HSV boxes")
+
+    def inter(*idx):
+        lo = np.max(np.stack([boxes[:, i, 0] for i in idx]), axis=0)
+        hi = np.min(np.stack([boxes[:, i, 1] for i in idx]), axis=0)
+        return box_counts(sat, lo, hi)
+
+    return (inter(0) + inter(1) + inter(2)
+            - inter(0, 1) - inter(0, 2) - inter(1, 2)
+            + inter(0, 1, 2))
+
+
+def decay_ratios(sat: np.ndarray, num_fg: np.ndarray, boxes: np.ndarray) -> np.ndarray:
+    """estimate_decay_ratio for every candidate box set and image; returns [C, I]."""
+    counts = union_counts(sat, boxes).astype(np.float64)
+    fg = np.asarray(num_fg, dtype=np.float64)[None, :]
+    return np.where(fg >= 50, counts / np.maximum(fg, 1.0), 0.0)
+
+
+def clip_probs(logits: np.ndarray) -> np.ndarray:
+    """Softmax of augmentation-averaged logits [I, A, P] -> [I, P], as in clip_classify."""
+    avg = np.asarray(logits, dtype=np.float64).mean(axis=1)
+    exps = np.exp(avg - avg.max(axis=1, keepdims=True))
+    return exps / exps.sum(axis=1, keepdims=True)
+
+
+def fuse(decay: np.ndarray, probs: np.ndarray, params: dict) -> np.ndarray:
+    """Vectorized combine_quality: predicted class index (CLASS_ORDER) of shape [C, I].
+
+    `decay` is [C, I] (or broadcastable), `probs` is [I, 3] in CLASS_ORDER and every entry of
+    `params` is an array of shape [C].
+    """
+    p = {k: np.asarray(v, dtype=np.float64)[:, None] for k, v in params.items()}
+    g, r, b = (probs[None, :, k] for k in range(3))
+
+    case1 = (r > p["ai_confident"]) | (b > p["ai_confident"])
+    case2 = ~case1 & (decay < p["clean_decay"])
+    w_ai = np.where(case1, p["w_ai_confident"], np.where(case2, p["w_ai_clean"], p["w_ai_default"]))
+    w_decay = np.where(case1, p["w_decay_confident"], np.where(case2, p["w_decay_clean"], p["w_decay_default"]))
+
+    scores = np.stack([w_ai * g + w_decay * (1.0 - decay), w_ai * r + w_decay * decay, w_ai * b + w_decay * decay])
+    total = scores.sum(axis=0)
+    scores = np.where(total > 0, scores / np.where(total > 0, total, 1.0), scores)
+
+    best = scores.argmax(axis=0)
+    best_score = scores.max(axis=0)
+    prefer_good = ((best_score < p["weak_best_score"]) & (decay < p["weak_best_decay"])) | \
+                  ((decay < p["low_decay"]) & ((r - g) < p["rotten_margin"]))
+    return np.where(prefer_good, 0, best)
+
+
+def heuristic_labels(decay: np.ndarray, params: dict) -> np.ndarray:
+    """Vectorized heuristics.label_from_decay: CLASS_ORDER indices for decay ratios without CLIP."""
+    return np.where(decay >= params["bad_above"], 2, np.where(decay >= params["rotten_above"], 1, 0))
+
+
+def score_predictions(pred: np.ndarray, y: np.ndarray, n_classes: int = 3) -> dict[str, np.ndarray]:
+    """Accuracy and macro F1 per candidate for predictions [C, I] against labels [I]."""
+    accuracy = (pred == y[None, :]).mean(axis=1)
+    f1s = []
+    for k in range(n_classes):
+        tp = ((pred == k) & (y[None, :] == k)).sum(axis=1)
+        fp = ((pred == k) & (y[None, :] != k)).sum(axis=1)
+        fn = ((pred != k) & (y[None, :] == k)).sum(axis=1)
+        denom = 2 * tp + fp + fn
+        f1s.append(np.where(denom > 0, 2 * tp / np.maximum(denom, 1), 0.0))
+    return {"accuracy": accuracy, "f1_macro": np.mean(f1s, axis=0)}
+
+
+def random_fusion_params(rng: np.random.Generator, n: int, base: dict) -> dict[str, np.ndarray]:
+    """`n` candidates drawn from FUSION_SEARCH_SPACE; candidate 0 is `base`."""
+    out = {}
+    for name, (lo, hi) in FUSION_SEARCH_SPACE.items():
+        values = rng.uniform(lo, hi, size=n)
+        values[0] = base[name]
+        out[name] = values
+    for case in ("confident", "clean", "default"):
+        w_decay = 1.0 - out[f"w_ai_{case}"]
+        w_decay[0] = base[f"w_decay_{case}"]
+        out[f"w_decay_{case}"] = w_decay
+    return out
+
+
+def random_hsv_boxes(rng: np.random.Generator, n: int, base_boxes: np.ndarray, bins, jitter: int = 2) -> np.ndarray:
+    """`n` candidate box sets [n, 3, 2, 3] jittering the bounds of `base_boxes`; candidate 0 is the base.
+
+    Bounds pinned to a channel's first or last bin (e.g. "any hue", "s up to 255") stay pinned.
+    """
+    limits = np.array(bins) - 1
+    base = np.broadcast_to(base_boxes, (n, *base_boxes.shape)).copy()
+    pinned = (base == 0) | (base == limits)
+    noise = rng.integers(-jitter, jitter + 1, size=base.shape)
+    noise[0] = 0
+    boxes = np.where(pinned, base, np.clip(base + noise, 0, limits))
+    return boxes
+
+
+def sweep(store_path: str, base_fusion: dict, base_ranges, trials: int = 2000, seed: int = 0,
+          objective: str = "accuracy", search: str = "both", chunk: int = 256,
+          top_k: int = 10) -> dict:
+    """Random-search fusion params and/or HSV decay cutoffs over a feature store.
+
+    Returns a report with the baseline, the best candidate (as a QUALITY_CONFIG-compatible
+    config) and the top_k candidates.
+    """
+    meta, arrays = open_store(store_path)
+    valid = np.asarray(arrays["valid"])
+    labels = np.array(meta["labels"])
+    known = np.isin(labels, CLASS_ORDER)
+    keep = valid & known
+    if not keep.any():
+        raise RuntimeError("Feature store has no valid samples with known labels")
+    y = np.array([CLASS_ORDER.index(l) for l in labels[keep]])
+    bins = tuple(meta["hsv_bins"])
+
+    probs = clip_probs(arrays["logits"][keep])
+    num_fg = np.asarray(arrays["num_fg"])[keep]
+    sat = summed_area_table(arrays["hist"][keep])
+    exact_decay = np.asarray(arrays["decay"])[keep]
+
+    rng = np.random.default_rng(seed)
+    base_boxes = ranges_to_bins(base_ranges, bins)
+    fusion = random_fusion_params(rng, trials, base_fusion)
+    boxes = random_hsv_boxes(rng, trials, base_boxes, bins)
+    if search == "fusion":
+        boxes[:] = base_boxes
+    elif search == "hsv":
+        for k in fusion:
+            fusion[k][:] = fusion[k][0]
+
+    metrics = {"accuracy": np.zeros(trials), "f1_macro": np.zeros(trials)}
+    for start in range(0, trials, chunk):
+        sl = slice(start, min(start + chunk, trials))
+        if search == "fusion":
+            decay = np.broadcast_to(decay_ratios(sat, num_fg, boxes[sl][:1]), (sl.stop - sl.start, len(y)))
+        else:
+            decay = decay_ratios(sat, num_fg, boxes[sl])
+        pred = fuse(decay, probs, {k: v[sl] for k, v in fusion.items()})
+        for name, values in score_predictions(pred, y).items():
+            metrics[name][sl] = values
+
+    baseline_exact = score_predictions(fuse(exact_decay[None, :], probs, {k: v[:1] for k, v in fusion.items()}), y)
+    quantized_decay = decay_ratios(sat, num_fg, base_boxes[None])[0]
+
+    def candidate(i: int) -> dict:
+        return {
+            "fusion": {k: float(v[i]) for k, v in fusion.items()},
+            "decay_hsv_ranges": bins_to_ranges(boxes[i], bins),
+            "accuracy": float(metrics["accuracy"][i]),
+            "f1_macro": float(metrics["f1_macro"][i]),
+        }
+
+    order = np.lexsort((-metrics["f1_macro" if objective == "accuracy" else "accuracy"], -metrics[objective]))
+    return {
+        "num_samples": int(len(y)),
+        "trials": trials,
+        "objective": objective,
+        "search": search,
+        "hsv_bins": list(bins),
+        "baseline": {
+            "accuracy": float(baseline_exact["accuracy"][0]),
+            "f1_macro": float(baseline_exact["f1_macro"][0]),
+            "accuracy_binned_hsv": float(metrics["accuracy"][0]),
+            "decay_binning_mean_abs_error": float(np.mean(np.abs(quantized_decay - exact_decay))),
+        },
+        "best": candidate(int(order[0])),
+        "top": [candidate(int(i)) for i in order[:top_k]],
+    }
+
+
+def cascade_tradeoff(store_path: str, fusion: dict, heuristic: dict, steps: int = 41,
+                     max_accuracy_drop: float = 0.01) -> dict:
+    """Accuracy against CLIP compute of the heuristic-first cascade (INFER_CASCADE) over a feature store.
+
+    Candidates are (good_below, bad_above, tta) with thresholds on quantiles of the stored decay
+    ratios. Images with decay below good_below or above bad_above are labelled from the decay
+    ratio alone with the `heuristic` cutoffs, as main.py answers them; the rest are fused with
+    the stored logits: all augmentations, or only the first one when tta is false.
+    The baseline is the always-CLIP pipeline; the recommended candidate runs the fewest CLIP
+    views per image while losing at most `max_accuracy_drop` accuracy against it. `frontier`
+    lists the candidates that are more accurate than every cheaper one.
+    """
+    meta, arrays = open_store(store_path)
+    labels = np.array(meta["labels"])
+    keep = np.asarray(arrays["valid"]) & np.isin(labels, CLASS_ORDER)
+    if not keep.any():
+        raise RuntimeError("Feature store has no valid samples with known labels")
+    y = np.array([CLASS_ORDER.index(l) for l in labels[keep]])
+    decay = np.asarray(arrays["decay"])[keep]
+    logits = np.asarray(arrays["logits"][keep])
+    n_aug = logits.shape[1]
+
+    params = {k: np.array([v], dtype=np.float64) for k, v in fusion.items()}
+    heuristic = heuristic_labels(decay, heuristic)
+    clip_pred = {tta: fuse(decay[None, :], clip_probs(logits if tta else logits[:, :1]), params)[0]
+                 for tta in (True, False)}
+
+    # 0 never exits as good, 1 never exits as bad: the grid always contains "always CLIP"
+    cuts = np.unique(np.quantile(decay, np.linspace(0.0, 1.0, steps)))
+    good, bad = np.meshgrid(np.unique(np.append(cuts, 0.0)), np.unique(np.append(cuts, 1.0)), indexing="ij")
+    pairs = good <= bad
+    good, bad = good[pairs], bad[pairs]
+    exits = (decay[None, :] < good[:, None]) | (decay[None, :] > bad[:, None])
+
+    candidates = []
+    for tta in (True, False):
+        pred = np.where(exits, heuristic[None, :], clip_pred[tta][None, :])
+        metrics = score_predictions(pred, y)
+        clip_fraction = 1.0 - exits.mean(axis=1)
+        views = clip_fraction * (n_aug if tta else 1)
+        for i in range(len(good)):
+            candidates.append({
+                "good_below": float(good[i]),
+                "bad_above": float(bad[i]),
+                "tta": tta,
+                "accuracy": float(metrics["accuracy"][i]),
+                "f1_macro": float(metrics["f1_macro"][i]),
+                "clip_fraction": float(clip_fraction[i]),
+                "clip_views_per_image": float(views[i]),
+                "clip_compute_saved": float(1.0 - views[i] / n_aug),
+            })
+
+    baseline = score_predictions(clip_pred[True][None, :], y)
+    floor = float(baseline["accuracy"][0]) - max_accuracy_drop
+    by_cost = sorted(candidates, key=lambda c: (c["clip_views_per_image"], -c["accuracy"], -c["f1_macro"]))
+    best = next(c for c in by_cost if c["accuracy"] >= floor - 1e-12)
+    frontier, best_accuracy = [], -1.0
+    for c in by_cost:
+        if c["accuracy"] > best_accuracy:
+            frontier.append(c)
+            best_accuracy = c["accuracy"]
+
+    def summary(pred: np.ndarray, views: float) -> dict:
+        metrics = score_predictions(pred[None, :], y)
+        return {"accuracy": float(metrics["accuracy"][0]), "f1_macro": float(metrics["f1_macro"][0]),
+                "clip_views_per_image": float(views)}
+
+    return {
+        "num_samples": int(len(y)),
+        "augmentations": meta.get("tta"),
+        "max_accuracy_drop": max_accuracy_drop,
+        "always_clip": summary(clip_pred[True], n_aug),
+        "always_clip_single_view": summary(clip_pred[False], 1),
+        "heuristic_only": summary(heuristic, 0),
+        "best": best,
+        "frontier": frontier,
+    }
+
+
+def quality_config(candidate: dict) -> dict:
+    """The QUALITY_CONFIG JSON for a sweep candidate."""
+    return {"fusion": candidate["fusion"], "decay_hsv_ranges": candidate["decay_hsv_ranges"]}
+
+
+def store_meta(image_paths: list, labels: list, hsv_bins, extra: Optional[dict] = None) -> dict:
+    meta = {"image_paths": list(image_paths), "labels": list(labels), "hsv_bins": list(hsv_bins),
+            "mask_side": MASK_SIDE}
+    meta.update(extra or {})
+    return meta
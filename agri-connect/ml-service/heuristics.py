@@ -0,0 +1,284 @@
+"""Torch-free parts of the /infer pipeline, shared by main.py and the lightweight app.py.
+
+The HSV decay rules, their fusion with classifier scores, a fast OpenCV foreground estimate
+that stands in for rembg, and the response projection and mask encodings. Only NumPy and
+OpenCV are imported, so the lightweight tier starts without torch, transformers or rembg.
+"""
+from __future__ import annotations
+
+import base64
+from typing import Optional
+
+import cv2
+import numpy as np
+
+# Inclusive OpenCV HSV boxes (H 0..179, S/V 0..255) whose union marks decayed pixels:
+# - brown/bruised: 8 < h < 28, s > 100, v < 100
+# - mold green:   40 < h < 80, s > 80,  v < 140
+# - dark:         v < 40 with s > 40 (keeps benign dark/background pixels out)
+DECAY_HSV_RANGES = [
+    (np.array([9, 101, 0], dtype=np.uint8), np.array([27, 255, 99], dtype=np.uint8)),
+    (np.array([41, 81, 0], dtype=np.uint8), np.array([79, 255, 139], dtype=np.uint8)),
+    (np.array([0, 41, 0], dtype=np.uint8), np.array([255, 255, 39], dtype=np.uint8)),
+]
+_MASK_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
+
+
+def clean_foreground_mask(fg_mask: np.ndarray) -> np.ndarray:
+    """Denoise a foreground mask into a 0/255 uint8 mask with speckles and small holes removed."""
+    # Normalize to a 0/255 uint8 mask for morphological ops (one allocation, scaled in place)
+    mask_u8 = np.greater(fg_mask, 0).view(np.uint8)
+    mask_u8 *= 255
+
+    # Median blur to remove small speckles
+    try:
+        mask_u8 = cv2.medianBlur(mask_u8, 5)
+    except Exception:
+        # If blur fails (very small mask), skip
+        pass
+
+    # Morphological open/close to remove small holes and isolated pixels; the mask stays 0/255
+    cv2.morphologyEx(mask_u8, cv2.MORPH_OPEN, _MASK_KERNEL, dst=mask_u8)
+    cv2.morphologyEx(mask_u8, cv2.MORPH_CLOSE, _MASK_KERNEL, dst=mask_u8)
+    return mask_u8
+
+
+def estimate_decay_ratio(img_rgb: np.ndarray, fg_mask: np.ndarray) -> float:
+    """Estimate decayed-area ratio inside the foreground mask.
+
+    Steps:
+    - Denoise and morphologically clean the FG mask to remove speckles.
+    - Use slightly stricter HSV thresholds to reduce lighting/background false positives.
+
+    Everything stays in uint8: the HSV rules are evaluated with cv2.inRange, combined in place
+    and counted with cv2.countNonZero.
+    """
+    mask_u8 = clean_foreground_mask(fg_mask)
+
+    # If foreground is tiny, treat as no decay to avoid false positives on tiny crops
+    num_fg = cv2.countNonZero(mask_u8)
+    if num_fg < 50:
+        return 0.0
+
+    # HSV-based decay heuristics (stricter than before)
+    hsv = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2HSV)
+    spoiled = cv2.inRange(hsv, *DECAY_HSV_RANGES[0])
+    rule = np.empty_like(spoiled)
+    for lower, upper in DECAY_HSV_RANGES[1:]:
+        cv2.inRange(hsv, lower, upper, dst=rule)
+        cv2.bitwise_or(spoiled, rule, dst=spoiled)
+    cv2.bitwise_and(spoiled, mask_u8, dst=spoiled)
+
+    return float(cv2.countNonZero(spoiled)) / float(num_fg)
+
+
+# Lab distance from the background colour below which a pixel is never foreground
+_FG_MIN_DISTANCE = 12.0
+_FG_WORK_SIDE = 256
+_FG_CLOSE_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
+
+
+def estimate_foreground(img_rgb: np.ndarray, saturation_threshold: int = 40,
+                        fill_frame_ratio: float = 0.6) -> np.ndarray:
+    """Fast rembg-free foreground mask (0/1 uint8, same size as the image).
+
+    Works on a copy at most 256 px on its longest side. Produce is usually photographed against
+    a plainer background, so the background colour is the median of the image border in Lab and
+    pixels farther from it than an Otsu threshold on the distance map are foreground, with
+    holes filled. When the border is mostly
+    saturated colour the produce fills the frame and a saturation threshold is used instead
+    (as with SEG_FALLBACK=saturation).
+    """
+    h, w = img_rgb.shape[:2]
+    scale = min(1.0, _FG_WORK_SIDE / float(max(h, w)))
+    small = cv2.resize(img_rgb, (max(1, round(w * scale)), max(1, round(h * scale))),
+                       interpolation=cv2.INTER_AREA) if scale < 1.0 else img_rgb
+    sh, sw = small.shape[:2]
+    band = max(1, min(sh, sw) // 25)
+    border = np.ones((sh, sw), dtype=bool)
+    border[band:sh - band, band:sw - band] = False
+
+    sat = cv2.cvtColor(small, cv2.COLOR_RGB2HSV)[:, :, 1]
+    if float(np.mean(sat[border] > saturation_threshold)) >= fill_frame_ratio:
+        mask = (sat > saturation_threshold).view(np.uint8)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, _FG_CLOSE_KERNEL)
+    else:
+        lab = cv2.cvtColor(small, cv2.COLOR_RGB2LAB).astype(np.float32)
+        background = np.median(lab[border], axis=0)
+        dist = np.sqrt(((lab - background) ** 2).sum(axis=2))
+        dist_u8 = np.clip(dist * (255.0 / max(float(dist.max()), 1.0)), 0, 255).astype(np.uint8)
+        otsu, _ = cv2.threshold(dist_u8, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        cutoff = max(_FG_MIN_DISTANCE, otsu * max(float(dist.max()), 1.0) / 255.0,
+                     float(np.percentile(dist[border], 95)))
+        mask = (dist > cutoff).view(np.uint8)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, _FG_CLOSE_KERNEL)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, _MASK_KERNEL)
+        # Fill holes: background is whatever the border reaches through non-foreground pixels
+        flood = mask.copy()
+        reach = np.zeros((sh + 2, sw + 2), np.uint8)
+        for y, x in ((0, 0), (0, sw - 1), (sh - 1, 0), (sh - 1, sw - 1)):
+            if flood[y, x] == 0:
+                cv2.floodFill(flood, reach, (x, y), 2)
+        mask = (flood != 2).view(np.uint8)
+    if (sh, sw) != (h, w):
+        mask = cv2.resize(mask, (w, h), interpolation=cv2.INTER_NEAREST)
+    return mask
+
+
+# Blending weights and thresholds used by combine_quality. evaluate.py --mode sweep searches these
+# (and DECAY_HSV_RANGES) and writes a config that QUALITY_CONFIG=<path> loads at startup.
+FUSION_PARAMS = {
+    "ai_confident": 0.75,
+    "clean_decay": 0.05,
+    "w_ai_confident": 0.8,
+    "w_decay_confident": 0.2,
+    "w_ai_clean": 0.35,
+    "w_decay_clean": 0.65,
+    "w_ai_default": 0.6,
+    "w_decay_default": 0.4,
+    "weak_best_score": 0.45,
+    "weak_best_decay": 0.15,
+    "low_decay": 0.12,
+    "rotten_margin": 0.18,
+}
+
+
+def combine_quality(decay_ratio: float, cls_scores: dict, params: dict | None = None) -> tuple[str, dict[str, float]]:
+    """Combine the decay ratio and classifier probabilities into a final quality label.
+
+    Approach:
+    - Compute a small set of combined scores that blend CLIP softmax probabilities with the
+      decay_ratio signal computed from image segmentation.
+    - Use conservative blending weights so neither signal alone (unless very strong) will
+      dominate and cause obvious misclassifications.
+    """
+    p = FUSION_PARAMS if params is None else params
+    g = float(cls_scores.get("Good/Fresh", 0.0))
+    r = float(cls_scores.get("Rotten/Spoiled", 0.0))
+    b = float(cls_scores.get("Completely Bad/Decomposed", 0.0))
+
+    # Adaptive weighting
+    # Case 1: AI sees clear rot/spoilage. Trust AI to catch texture/color patterns that segmentation missed.
+    if r > p["ai_confident"] or b > p["ai_confident"]:
+        w_ai, w_decay = p["w_ai_confident"], p["w_decay_confident"]
+
+    # Case 2: Low physical decay and AI is not convinced it's rotten. Trust the "clean" segmentation.
+    elif decay_ratio < p["clean_decay"]:
+        w_ai, w_decay = p["w_ai_clean"], p["w_decay_clean"]
+
+    # Case 3: Ambiguous / Normal case. Moderate blend.
+    else:
+        w_ai, w_decay = p["w_ai_default"], p["w_decay_default"]
+
+    scores = {
+        "Good/Fresh": w_ai * g + w_decay * (1.0 - decay_ratio),
+        "Rotten/Spoiled": w_ai * r + w_decay * decay_ratio,
+        "Completely Bad/Decomposed": w_ai * b + w_decay * decay_ratio,
+    }
+
+    # Normalize scores to sum to 1.0 for cleaner probability output
+    total_score = sum(scores.values())
+    if total_score > 0:
+        scores = {k: v / total_score for k, v in scores.items()}
+
+    # Choose best label
+    best_label, best_score = max(scores.items(), key=lambda kv: kv[1])
+
+    # Safety rules to avoid over-triggering Rotten due to classifier-only signal:
+    # - If decay is very low and the best score is weak, prefer Good/Fresh.
+    if best_score < p["weak_best_score"] and decay_ratio < p["weak_best_decay"]:
+        return "Good/Fresh", scores
+
+    # If decay is very low but classifier is close between Good and Rotten, prefer Good
+    if decay_ratio < p["low_decay"] and (r - g) < p["rotten_margin"]:
+        return "Good/Fresh", scores
+
+    return best_label, scores
+
+
+# Decay cutoffs for labelling without classifier scores (the lightweight tier and evaluate.py
+# --mode simple/light): combine_quality is tuned to blend with CLIP and, given the decay ratio
+# alone, only leaves Good/Fresh once more than half of the produce has decayed. softness is the
+# decay width over which the scores cross over at each cutoff.
+HEURISTIC_PARAMS = {
+    "rotten_above": 0.15,
+    "bad_above": 0.5,
+    "softness": 0.05,
+}
+
+
+def label_from_decay(decay_ratio: float, params: dict | None = None) -> str:
+    """Map decay to class without CLIP."""
+    p = HEURISTIC_PARAMS if params is None else params
+    if decay_ratio >= p["bad_above"]:
+        return "Completely Bad/Decomposed"
+    if decay_ratio >= p["rotten_above"]:
+        return "Rotten/Spoiled"
+    return "Good/Fresh"
+
+
+def heuristic_quality(decay_ratio: float, params: dict | None = None) -> tuple[str, dict[str, float]]:
+    """label_from_decay with combine_quality-style scores that sum to 1 and cross over at the cutoffs."""
+    p = HEURISTIC_PARAMS if params is None else params
+    softness = max(p["softness"], 1e-6)
+    good = 1.0 / (1.0 + np.exp((decay_ratio - p["rotten_above"]) / softness))
+    bad = 1.0 / (1.0 + np.exp((p["bad_above"] - decay_ratio) / softness))
+    scores = {
+        "Good/Fresh": float(good),
+        "Rotten/Spoiled": float(max(1.0 - good - bad, 0.0)),
+        "Completely Bad/Decomposed": float(bad),
+    }
+    return label_from_decay(decay_ratio, p), scores
+
+
+def apply_quality_config(config: dict) -> None:
+    """Override FUSION_PARAMS / HEURISTIC_PARAMS / DECAY_HSV_RANGES in place from a QUALITY_CONFIG document."""
+    FUSION_PARAMS.update({k: float(v) for k, v in config.get("fusion", {}).items()})
+    HEURISTIC_PARAMS.update({k: float(v) for k, v in config.get("heuristic", {}).items()})
+    if "decay_hsv_ranges" in config:
+        DECAY_HSV_RANGES[:] = [(np.array(lo, dtype=np.uint8), np.array(hi, dtype=np.uint8))
+                               for lo, hi in config["decay_hsv_ranges"]]
+
+
+DETAIL_LEVELS = ("minimal", "full")
+MASK_FORMATS = ("none", "png", "rle")
+
+
+def parse_projection(detail: str = "minimal", mask: Optional[str] = None, mask_max_side: int = 0) -> dict:
+    """Validate /infer response options. The mask defaults to a PNG with detail=full and is omitted otherwise."""
+    if detail not in DETAIL_LEVELS:
+        raise ValueError(f"detail must be one of {', '.join(DETAIL_LEVELS)}")
+    if mask is None:
+        mask = "png" if detail == "full" else "none"
+    if mask not in MASK_FORMATS:
+        raise ValueError(f"mask must be one of {', '.join(MASK_FORMATS)}")
+    if mask_max_side < 0:
+        raise ValueError("mask_max_side must be >= 0")
+    return {"detail": detail, "mask": mask, "mask_max_side": mask_max_side}
+
+
+def mask_to_png_base64(mask: np.ndarray) -> str:
+    mask_u8 = (mask * 255).astype(np.uint8)
+    success, buf = cv2.imencode(".png", mask_u8)
+    if not success:
+        return ""
+    return base64.b64encode(buf.tobytes()).decode("utf-8")
+
+
+def mask_to_rle(mask: np.ndarray) -> dict:
+    """Row-major run-length encoding of a 0/1 mask; counts alternate background/foreground runs,
+    starting with background (so the first count may be 0)."""
+    flat = mask.ravel() > 0
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    bounds = np.concatenate(([0], changes, [flat.size]))
+    counts = np.diff(bounds).tolist()
+    if flat.size and flat[0]:
+        counts.insert(0, 0)
+    return {"size": [int(mask.shape[0]), int(mask.shape[1])], "counts": counts}
+
+
+def upsample_mask(mask: np.ndarray, size: tuple[int, int]) -> np.ndarray:
+    """Nearest-neighbour resize of a 0/1 mask to `size` (width, height)."""
+    if mask.shape[1] == size[0] and mask.shape[0] == size[1]:
+        return mask
+    return cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST)
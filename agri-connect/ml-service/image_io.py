@@ -0,0 +1,89 @@
+import os
+from io import BytesIO
+
+import numpy as np
+from PIL import ExifTags, Image, ImageOps, UnidentifiedImageError
+
+# Uploads larger than this are rejected before decoding
+MAX_UPLOAD_BYTES = int(float(os.environ.get("INFER_MAX_UPLOAD_MB", "20")) * 1024 * 1024)
+# Images whose header declares more pixels than this are rejected before decoding (decompression bombs)
+MAX_IMAGE_PIXELS = int(os.environ.get("INFER_MAX_IMAGE_PIXELS", "100000000"))
+
+# EXIF orientations that swap width and height
+_TRANSPOSED_ORIENTATIONS = (5, 6, 7, 8)
+
+
+class ImageDecodeError(ValueError):
+    """Raised when an upload is not a decodable image."""
+
+
+class ImageTooLargeError(ImageDecodeError):
+    """Raised when an upload exceeds MAX_UPLOAD_BYTES or MAX_IMAGE_PIXELS."""
+
+
+def fit_to_max_side(size: tuple[int, int], max_side: int) -> tuple[int, int]:
+    """(width, height) scaled down to fit `max_side`; unchanged when it already fits or max_side <= 0."""
+    w, h = size
+    if max_side <= 0 or max(w, h) <= max_side:
+        return size
+    scale = max_side / float(max(w, h))
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+
+def resize_to_max_side(image: Image.Image, max_side: int) -> Image.Image:
+    """Downscale so the longest side is at most `max_side` pixels; 0 or smaller images pass through."""
+    size = fit_to_max_side(image.size, max_side)
+    if size == image.size:
+        return image
+    return image.resize(size, Image.BILINEAR, reducing_gap=3.0)
+
+
+def check_upload_size(num_bytes: int) -> None:
+    if num_bytes > MAX_UPLOAD_BYTES:
+        raise ImageTooLargeError(f"upload is {num_bytes} bytes; the limit is {MAX_UPLOAD_BYTES}")
+
+
+def decode_image(data: bytes, max_side: int = 0) -> tuple[Image.Image, tuple[int, int]]:
+    """Decode an upload to an upright RGB image whose longest side is at most `max_side`.
+
+    JPEGs are decoded with draft() so libjpeg scales by 1/2..1/8 in the DCT domain and never
+    materializes the full-resolution bitmap; the remaining reduction is a bilinear resize.
+    Returns the image and the upright (EXIF-applied) size of the original upload.
+    """
+    check_upload_size(len(data))
+    try:
+        img = Image.open(BytesIO(data))
+    except Image.DecompressionBombError as e:
+        raise ImageTooLargeError(str(e)) from e
+    except (UnidentifiedImageError, OSError) as e:
+        raise ImageDecodeError(f"cannot decode image: {e}") from e
+    w, h = img.size
+    if w * h > MAX_IMAGE_PIXELS:
+        raise ImageTooLargeError(f"image is {w}x{h}; the limit is {MAX_IMAGE_PIXELS} pixels")
+
+    orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+    size = (h, w) if orientation in _TRANSPOSED_ORIENTATIONS else (w, h)
+    try:
+        if max_side > 0 and img.format == "JPEG":
+            img.draft("RGB", fit_to_max_side((w, h), max_side))
+        # Both calls copy even when there is nothing to do, so only make them when needed
+        if orientation != 1:
+            img = ImageOps.exif_transpose(img)
+        if img.mode != "RGB":
+            img = img.convert("RGB")
+        else:
+            img.load()
+    except OSError as e:
+        raise ImageDecodeError(f"cannot decode image: {e}") from e
+    return resize_to_max_side(img, max_side), size
+
+
+def load_image(path: str, max_side: int = 0) -> Image.Image:
+    """decode_image() for a file on disk."""
+    with open(path, "rb") as f:
+        return decode_image(f.read(), max_side)[0]
+
+
+def to_numpy(image: Image.Image) -> np.ndarray:
+    """Read-only array view of a PIL image, without the extra copy np.array() makes."""
+    return np.asarray(image)
@@ -0,0 +1,325 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Optional
+from urllib.parse import unquote, urlsplit
+
+logger = logging.getLogger(__name__)
+
+# Lower runs first: interactive quality checks go ahead of background listing scoring
+PRIORITIES = {"interactive": 0, "background": 1}
+CALLBACK_ATTEMPTS = 3
+
+# handler(data, params) -> (HTTP status, response body on 200 or error message otherwise)
+JobHandler = Callable[[bytes, dict], Awaitable[tuple[int, "bytes | str"]]]
+
+
+class JobQueueFullError(RuntimeError):
+    """Raised when `max_queued` jobs are already waiting."""
+
+
+class JobStore:
+    """Asynchronous /infer jobs: a priority queue worked by `concurrency` asyncio tasks.
+
+    Jobs and their uploads are kept in memory, or in a sqlite file (`db_path`) so that queued
+    and interrupted jobs are picked up again after a restart. Finished jobs are kept for
+    `ttl_s` seconds for polling. When a job has a callback URL, its final state is POSTed
+    there as JSON (the same document GET /jobs/{id} returns), retrying with backoff.
+
+    Several processes (serve.py workers) can share one `db_path`: get() falls back to the file
+    for jobs submitted elsewhere. Each job row records the `owner` of the store that queued it,
+    and a store only restores its own jobs, plus those of owners outside `owners` (e.g. workers
+    that no longer exist) when `adopt_orphans` is set. A respawned worker thereby picks up the
+    jobs its crashed predecessor left queued or running.
+
+    Every method runs on the event loop; sqlite reads and writes are done in a worker thread
+    under a lock, so committing a large upload does not block other requests.
+    """
+
+    def __init__(self, db_path: Optional[str] = None, ttl_s: float = 3600.0, max_queued: int = 1000,
+                 callback_prefixes: tuple[str, ...] = ()):
+        self.ttl_s = ttl_s
+        self.max_queued = max_queued
+        self.callback_prefixes = callback_prefixes
+        self._callback_rules = [self._callback_target(p, "JOBS_CALLBACK_PREFIXES entry") for p in callback_prefixes]
+        # serve.py sets these per worker; the defaults make a single process restore every job
+        self.owner: Optional[str] = None
+        self.owners: tuple[str, ...] = ()
+        self.adopt_orphans = True
+        self._jobs: dict[str, dict] = {}
+        self._data: dict[str, bytes] = {}
+        self._seq = itertools.count()
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._tasks: list[asyncio.Task] = []
+        self._callbacks: set[asyncio.Task] = set()
+        self._last_purge = time.time()
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, job TEXT, data BLOB, result BLOB, "
+                             "owner TEXT)")
+            if "owner" not in [col[1] for col in self._db.execute("PRAGMA table_info(jobs)")]:
+                # Databases written before jobs had owners
+                self._db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+            self._db.commit()
+
+    @staticmethod
+    def _callback_target(url: str, what: str) -> tuple[str, str, int, str]:
+        """(scheme, host, port, path) of an http(s) URL; ValueError for anything else, credentials,
+        whitespace or dot segments (which would step out of a path prefix)."""
+        if any(c.isspace() or ord(c) < 32 for c in url):
+            raise ValueError(f"{what} must not contain whitespace")
+        try:
+            parts = urlsplit(url)
+            port = parts.port
+        except ValueError:
+            raise ValueError(f"{what} is not a valid URL") from None
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise ValueError(f"{what} must be an http(s) URL")
+        if "@" in parts.netloc:
+            raise ValueError(f"{what} must not contain credentials")
+        if any(seg in (".", "..") for seg in unquote(parts.path).split("/")):
+            raise ValueError(f"{what} must not contain . or .. path segments")
+        if port is None:
+            port = 443 if parts.scheme == "https" else 80
+        return parts.scheme, parts.hostname, port, parts.path or "/"
+
+    def check_callback(self, url: Optional[str]) -> None:
+        """Raise ValueError for callback URLs that are not http(s) or outside JOBS_CALLBACK_PREFIXES.
+
+        Prefixes are compared parsed, not as strings: the scheme, host and port must be equal and
+        the path must lie under the prefix's path, so https://hooks.example.com does not admit
+        https://hooks.example.com.evil.net/ or https://hooks.example.com@evil.net/.
+        """
+        if url is None:
+            return
+        scheme, host, port, path = self._callback_target(url, "callback_url")
+        # The service must not POST to arbitrary (e.g. internal) addresses on a client's behalf
+        if not self._callback_rules:
+            raise ValueError("callbacks are disabled; set JOBS_CALLBACK_PREFIXES to allow callback_url")
+        for rule_scheme, rule_host, rule_port, rule_path in self._callback_rules:
+            if (scheme, host, port) != (rule_scheme, rule_host, rule_port):
+                continue
+            base = rule_path.rstrip("/")
+            if path == base or path.startswith(base + "/"):
+                return
+        raise ValueError("callback_url is not allowed by JOBS_CALLBACK_PREFIXES")
+
+    def _execute(self, sql: str, params=(), many: bool = False, fetch: bool = False):
+        with self._db_lock:
+            if many:
+                cur = self._db.executemany(sql, params)
+            else:
+                cur = self._db.execute(sql, params)
+            rows = cur.fetchall() if fetch else None
+            self._db.commit()
+            return rows
+
+    async def _db_call(self, sql: str, params=(), many: bool = False, fetch: bool = False):
+        """Run one statement (and commit) in a worker thread."""
+        return await asyncio.to_thread(self._execute, sql, params, many, fetch)
+
+    async def _save(self, job: dict, data: Optional[bytes] = None, result: Optional[bytes] = None) -> None:
+        if self._db is None:
+            return
+        # Serialized here, on the loop, where the job dict is changed
+        record = json.dumps({k: v for k, v in job.items() if k != "result"})
+        if data is not None:
+            await self._db_call("INSERT OR REPLACE INTO jobs (id, job, data, owner) VALUES (?, ?, ?, ?)",
+                                (job["id"], record, data, self.owner))
+        else:
+            # Drop the upload once it is no longer needed
+            await self._db_call("UPDATE jobs SET job = ?, data = CASE WHEN ? THEN NULL ELSE data END, result = ? "
+                                "WHERE id = ?", (record, job["state"] in ("done", "failed"), result, job["id"]))
+
+    async def submit(self, data: bytes, params: dict, priority: str = "interactive",
+                     callback_url: Optional[str] = None) -> dict:
+        """Queue one image; returns the new job's public state."""
+        if priority not in PRIORITIES:
+            raise ValueError(f"Invalid priority {priority!r}; choose from {', '.join(PRIORITIES)}")
+        self.check_callback(callback_url)
+        await self._purge()
+        if self._queue is None:
+            raise RuntimeError("JobStore.start() has not been called")
+        if self._queue.qsize() >= self.max_queued:
+            raise JobQueueFullError("job queue is full")
+        job = {
+            "id": uuid.uuid4().hex,
+            "state": "queued",
+            "priority": priority,
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "params": params,
+            "callback_url": callback_url,
+        }
+        self._jobs[job["id"]] = job
+        if self._db is not None:
+            await self._save(job, data=data)
+        else:
+            self._data[job["id"]] = data
+        self._queue.put_nowait((PRIORITIES[priority], next(self._seq), job["id"]))
+        return self.public(job)
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        job = self._jobs.get(job_id)
+        if job is None and self._db is not None:
+            # Submitted to another process sharing the database
+            rows = await self._db_call("SELECT job, result FROM jobs WHERE id = ?", (job_id,), fetch=True)
+            if rows:
+                job = json.loads(rows[0][0])
+                if rows[0][1] is not None:
+                    job["result"] = bytes(rows[0][1])
+        return None if job is None else self.public(job)
+
+    def public(self, job: dict) -> dict:
+        """The job as returned by GET /jobs/{id}: the result is included, the upload and params are not."""
+        doc = {k: v for k, v in job.items() if k not in ("params", "result")}
+        if "result" in job:
+            doc["result"] = json.loads(job["result"])
+        return doc
+
+    def _restore(self) -> None:
+        """Reload this store's persisted jobs; queued and interrupted (running) ones go back into the queue."""
+        if self._db is None:
+            return
+        adopted = []
+        # Runs once in start(), before any request is served
+        for job_id, record, result, owner in self._execute("SELECT id, job, result, owner FROM jobs", fetch=True):
+            if owner != self.owner:
+                if not self.adopt_orphans or owner in self.owners:
+                    continue
+                adopted.append((self.owner, job_id))
+            job = json.loads(record)
+            if result is not None:
+                job["result"] = bytes(result)
+            if job["state"] == "running":
+                job["state"] = "queued"
+                job["started_at"] = None
+            self._jobs[job_id] = job
+        requeue = sorted((j for j in self._jobs.values() if j["state"] == "queued"),
+                         key=lambda j: (PRIORITIES[j["priority"]], j["created_at"]))
+        for job in requeue:
+            self._queue.put_nowait((PRIORITIES[job["priority"]], next(self._seq), job["id"]))
+        if adopted:
+            self._execute("UPDATE jobs SET owner = ? WHERE id = ?", adopted, many=True)
+        for job in self._jobs.values():
+            if job["state"] in ("done", "failed") and job.get("callback", {}).get("state") == "pending":
+                self._callback_later(job)
+        if requeue:
+            logger.info("requeued %d persisted jobs", len(requeue))
+
+    async def _purge(self) -> None:
+        """Forget finished jobs older than ttl_s; runs at most once a minute."""
+        now = time.time()
+        if self.ttl_s <= 0 or now - self._last_purge < 60:
+            return
+        self._last_purge = now
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job["finished_at"] is not None and now - job["finished_at"] > self.ttl_s]
+        for job_id in expired:
+            del self._jobs[job_id]
+        if self._db is not None and expired:
+            await self._db_call("DELETE FROM jobs WHERE id = ?", [(job_id,) for job_id in expired], many=True)
+
+    def start(self, handler: JobHandler, concurrency: int) -> None:
+        """Restore persisted jobs and start `concurrency` tasks working the queue with `handler`."""
+        self._queue = asyncio.PriorityQueue()
+        self._restore()
+        self._tasks.extend(asyncio.ensure_future(self._work(handler)) for _ in range(max(1, concurrency)))
+
+    async def shutdown(self) -> None:
+        tasks = self._tasks + list(self._callbacks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _work(self, handler: JobHandler) -> None:
+        while True:
+            _, _, job_id = await self._queue.get()
+            job = self._jobs.get(job_id)
+            if job is None or job["state"] != "queued":
+                continue
+            if self._db is not None:
+                rows = await self._db_call("SELECT data FROM jobs WHERE id = ?", (job_id,), fetch=True)
+                data = bytes(rows[0][0]) if rows and rows[0][0] is not None else b""
+            else:
+                data = self._data.pop(job_id, b"")
+            job["state"], job["started_at"] = "running", time.time()
+            await self._save(job)
+            try:
+                status, outcome = await handler(data, job["params"])
+            except asyncio.CancelledError:
+                # Shutting down: a persisted job is requeued on the next start
+                raise
+            except Exception as e:
+                status, outcome = 500, str(e)
+            job["finished_at"] = time.time()
+            job["status"] = status
+            if status == 200:
+                job["state"], job["result"] = "done", outcome
+            else:
+                job["state"], job["error"] = "failed", outcome
+            if job["callback_url"]:
+                job["callback"] = {"state": "pending", "attempts": 0}
+            await self._save(job, result=job.get("result"))
+            if job["callback_url"]:
+                self._callback_later(job)
+
+    def _callback_later(self, job: dict) -> None:
+        task = asyncio.ensure_future(self._send_callback(job))
+        self._callbacks.add(task)
+        task.add_done_callback(self._callbacks.discard)
+
+    async def _send_callback(self, job: dict) -> None:
+        import httpx
+
+        doc = {k: v for k, v in self.public(job).items() if k != "callback"}
+        async with httpx.AsyncClient(timeout=10.0) as client:
+            while job["callback"]["attempts"] < CALLBACK_ATTEMPTS:
+                job["callback"]["attempts"] += 1
+                try:
+                    r = await client.post(job["callback_url"], json=doc)
+                    if r.status_code < 400:
+                        job["callback"]["state"] = "sent"
+                        break
+                    logger.warning("job %s callback answered %s", job["id"], r.status_code)
+                except httpx.InvalidURL as e:
+                    # Not worth retrying
+                    logger.warning("job %s callback URL is invalid: %s", job["id"], e)
+                    job["callback"]["state"] = "failed"
+                    break
+                except httpx.HTTPError as e:
+                    logger.warning("job %s callback failed: %s", job["id"], e)
+                if job["callback"]["attempts"] < CALLBACK_ATTEMPTS:
+                    await asyncio.sleep(2 ** job["callback"]["attempts"])
+            else:
+                job["callback"]["state"] = "failed"
+        await self._save(job, result=job.get("result"))
+
+    def stats(self) -> dict:
+        states: dict[str, int] = {}
+        for job in self._jobs.values():
+            states[job["state"]] = states.get(job["state"], 0) + 1
+        return {"queued": self._queue.qsize() if self._queue is not None else 0, "states": states,
+                "persistent": self._db is not None}
+
+
+def jobs_from_env() -> JobStore:
+    """Build the job store from JOBS_DB, JOBS_TTL_S, JOBS_MAX_QUEUED and JOBS_CALLBACK_PREFIXES."""
+    prefixes = tuple(p.strip() for p in os.environ.get("JOBS_CALLBACK_PREFIXES", "").split(",") if p.strip())
+    return JobStore(
+        db_path=os.environ.get("JOBS_DB") or None,
+        ttl_s=float(os.environ.get("JOBS_TTL_S", "3600")),
+        max_queued=int(os.environ.get("JOBS_MAX_QUEUED", "1000")),
+        callback_prefixes=prefixes,
+    )
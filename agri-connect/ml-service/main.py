@@ -1,31 +1,71 @@
-from fastapi import FastAPI, File, UploadFile
-from fastapi.responses import JSONResponse
+from __future__ import annotations
+
+from startup import PROCESS_START, Startup, save_snapshot, snapshot_path
+from fastapi import FastAPI, File, Request, UploadFile
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from io import BytesIO
-from PIL import Image
+from PIL import Image, ImageEnhance
 import numpy as np
 import base64
+import hashlib
+import json
+import logging
 import cv2
-import uvicorn
 import os
-import torch
-from transformers import CLIPProcessor, CLIPModel
-from rembg import remove
+import asyncio
+import tarfile
+import zipfile
+import threading
+import time
+from executor import QueueFullError, executor_from_env
+from batching import MicroBatcher
+from result_cache import cache_from_env
+from embedding_index import index_from_env
+from jobs import JobQueueFullError, jobs_from_env
+from segmentation import engine_from_env
+from heuristics import (DECAY_HSV_RANGES, FUSION_PARAMS, HEURISTIC_PARAMS, apply_quality_config, combine_quality,
+                        estimate_decay_ratio, heuristic_quality, mask_to_png_base64, mask_to_rle, parse_projection, upsample_mask)
+from prompt_bank import bank_fingerprint, load_or_build, resolve_crop
+from metrics import (CASCADE_PATHS, CLIP_SECONDS_PER_AUGMENTATION, METRICS_ENABLED, REQUEST_SECONDS, REQUESTS, Gauge,
+                     profiler_from_env, record_stage, registry, request_timings, server_timing_header, stage)
+from image_io import (MAX_UPLOAD_BYTES, ImageDecodeError, ImageTooLargeError, check_upload_size, decode_image,
+                      fit_to_max_side, resize_to_max_side, to_numpy)
 
 from contextlib import asynccontextmanager
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+
+def configure_logging() -> None:
+    """Root logging for the service; called when it starts serving, not on import, so evaluate.py
+    and benchmark.py keep their own logging setup. A no-op once the root logger has handlers."""
+    logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Preload CLIP weights
-    ensure_models()
-    # Warm up rembg by running a tiny pass; this may trigger model download
-    img = Image.new("RGB", (16, 16), (0, 0, 0))
-    try:
-        _ = remove(img)
-    except Exception:
-        # Ignore warmup errors; real requests will be handled with proper images
-        pass
+    configure_logging()
+    # CLIP and the rembg session load in parallel on background threads
+    startup.load("clip", ensure_models)
+    startup.load("segmentation", segmentation_engine.load)
+    inference_executor.start()
+    # Counted as a component, so /readyz (and the lifespan wait below) covers warm workers
+    startup.load("warmup", warm_workers)
+    if clip_batcher is not None:
+        clip_batcher.start()
+    if not HEURISTIC_UNTIL_READY:
+        # Keep the old behaviour: accept connections only once every model is loaded
+        await asyncio.to_thread(startup.wait_all)
+    jobs.start(run_job, JOBS_CONCURRENCY)
     yield
+    await jobs.shutdown()
+    inference_executor.shutdown()
+    if embedding_index is not None:
+        embedding_index.flush()
+    if clip_batcher is not None:
+        clip_batcher.shutdown()
 
 app = FastAPI(lifespan=lifespan)
 app.add_middleware(
@@ -36,8 +76,41 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+CLIP_MODEL_NAME = "openai/clip-vit-base-patch32"
+
 clip_model = None
 clip_processor = None
+# Callable pixel_values -> image embeddings built by clip_backends for CLIP_BACKEND
+image_encoder = None
+clip_logit_scale = None
+# Per-crop prompt ensembles (prompt_bank.PromptBank), scored when a request names a known crop type
+prompt_bank = None
+_model_lock = threading.Lock()
+
+# Background model loading and /readyz state. With INFER_HEURISTIC_UNTIL_READY=1 the app accepts
+# requests as soon as segmentation is loaded and answers from the decay heuristic alone (marked
+# "degraded" and never cached) until CLIP is ready.
+startup = Startup()
+HEURISTIC_UNTIL_READY = os.environ.get("INFER_HEURISTIC_UNTIL_READY", "0") == "1"
+# The first load saves the model and processor here with save_pretrained (safetensors, which later
+# starts memory-map) so restarts skip hub resolution. Set MODEL_SNAPSHOT_DIR= (empty) to disable.
+MODEL_SNAPSHOT_DIR = os.environ.get("MODEL_SNAPSHOT_DIR", os.path.join(os.path.expanduser("~"), ".cache", "agri-connect", "snapshots"))
+
+# CLIP image tower runtime: torch (eager fp32), torch-int8 (dynamic quantization), onnx or onnx-int8
+# (onnxruntime). Exported ONNX graphs are cached in CLIP_ONNX_DIR; CLIP_THREADS > 0 pins the number
+# of intra-op threads. evaluate.py --mode parity checks a backend against torch.
+CLIP_BACKEND = os.environ.get("CLIP_BACKEND", "torch")
+CLIP_ONNX_DIR = os.environ.get("CLIP_ONNX_DIR", os.path.join(os.path.expanduser("~"), ".cache", "agri-connect", "onnx"))
+CLIP_THREADS = int(os.environ.get("CLIP_THREADS", "0"))
+
+# Normalized text features keyed by (model name, prompt tuple). Looking them up by the current
+# contents of label_prompts means edits at runtime transparently build a fresh entry.
+_text_features_cache: dict[tuple[str, tuple[str, ...]], torch.Tensor] = {}
+
+# With INFER_PER_WORKER_MODELS=1 every inference worker thread scores images with its own copy of
+# the CLIP weights instead of sharing clip_model.
+PER_WORKER_MODELS = os.environ.get("INFER_PER_WORKER_MODELS", "0") == "1"
+_worker_state = threading.local()
 
 labels = [
     "Good/Fresh",
@@ -50,18 +123,131 @@ label_prompts = [
     "a photo of completely decomposed bad fruit or vegetable"
 ]
 
+# Test-time augmentations used by clip_classify, in order. Set CLIP_TTA=original to score the
+# image once on latency-sensitive deployments.
+TTA_TRANSFORMS = {
+    "original": lambda base: base,
+    "flip": lambda base: base.transpose(Image.FLIP_LEFT_RIGHT),
+    "brightness": lambda base: ImageEnhance.Brightness(base).enhance(1.07),
+}
+TTA_AUGMENTATIONS = [a.strip() for a in os.environ.get("CLIP_TTA", "original,flip,brightness").split(",") if a.strip()]
+_unknown_tta = set(TTA_AUGMENTATIONS) - set(TTA_TRANSFORMS)
+if _unknown_tta or not TTA_AUGMENTATIONS:
+    raise ValueError(f"Invalid CLIP_TTA={os.environ.get('CLIP_TTA')!r}; choose from {sorted(TTA_TRANSFORMS)}")
+
 
 def ensure_models():
-    global clip_model, clip_processor
-    if clip_model is None:
-        clip_model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-        clip_processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-        clip_model.eval()
+    global clip_model, clip_processor, image_encoder, clip_logit_scale, prompt_bank
+    if clip_model is not None:
+        return
+    with _model_lock:
+        if clip_model is not None:
+            return
+        # Heavy imports are deferred so the app can start (and answer /healthz) before they finish
+        import torch
+        from transformers import CLIPModel, CLIPProcessor
+        from clip_backends import build_image_encoder
+
+        if CLIP_THREADS > 0:
+            torch.set_num_threads(CLIP_THREADS)
+        snapshot = snapshot_path(MODEL_SNAPSHOT_DIR, CLIP_MODEL_NAME)
+        have_snapshot = snapshot is not None and os.path.isdir(snapshot)
+        source = snapshot if have_snapshot else CLIP_MODEL_NAME
+        model = CLIPModel.from_pretrained(source)
+        clip_processor = CLIPProcessor.from_pretrained(source)
+        model.eval()
+        if snapshot is not None and not have_snapshot:
+            try:
+                save_snapshot(snapshot, model, clip_processor)
+            except OSError as e:
+                logger.warning("Could not write model snapshot to %s: %s", snapshot, e)
+        image_encoder = build_image_encoder(CLIP_BACKEND, model, CLIP_MODEL_NAME, CLIP_ONNX_DIR, CLIP_THREADS)
+        with torch.no_grad():
+            clip_logit_scale = model.logit_scale.exp()
+        # Saved next to the model snapshot, so only the first start encodes every crop prompt
+        prompt_bank = load_or_build(MODEL_SNAPSHOT_DIR, CLIP_MODEL_NAME,
+                                    lambda prompts: encode_text(model, prompts).numpy())
+        clip_model = model
+        # Encode the label prompts once up front so requests only run the image tower
+        get_text_features()
+
+
+def current_image_encoder():
+    """The CLIP_BACKEND encoder, or this worker thread's private copy with INFER_PER_WORKER_MODELS=1."""
+    if not PER_WORKER_MODELS:
+        return image_encoder
+    encoder = getattr(_worker_state, "image_encoder", None)
+    if encoder is None:
+        encoder = _worker_state.image_encoder = image_encoder.for_worker()
+    return encoder
+
+
+def encode_text(model, prompts: list[str]) -> torch.Tensor:
+    """L2-normalized CLIP text features of `prompts`, uncached."""
+    import torch
+    from clip_backends import pooled_output
+
+    with torch.no_grad():
+        inputs = clip_processor(text=list(prompts), return_tensors="pt", padding=True, truncation=True)
+        feats = pooled_output(model.get_text_features(**inputs))
+        return feats / feats.norm(dim=-1, keepdim=True)
+
+
+def get_text_features(prompts: list[str] | None = None) -> torch.Tensor:
+    """Return L2-normalized CLIP text features for `prompts` (default: label_prompts), cached."""
+    ensure_models()
+    key = (CLIP_MODEL_NAME, tuple(label_prompts if prompts is None else prompts))
+    feats = _text_features_cache.get(key)
+    if feats is None:
+        feats = _text_features_cache[key] = encode_text(clip_model, key[1])
+    return feats
+
+
+def clip_image_embeddings(images: list[Image.Image], encoder=None) -> torch.Tensor:
+    """L2-normalized CLIP image features of shape [N, embed_dim].
+
+    `encoder` overrides the CLIP_BACKEND image encoder (evaluate.py --mode parity).
+    """
+    import torch
+
+    ensure_models()
+    with torch.no_grad():
+        inputs = clip_processor(images=images, return_tensors="pt")
+        image_feats = (encoder or current_image_encoder())(inputs["pixel_values"])
+        return image_feats / image_feats.norm(dim=-1, keepdim=True)
+
+
+def embeddings_to_logits(image_feats: torch.Tensor, crops: list[Optional[str]] | None = None) -> np.ndarray:
+    """Scaled cosine similarity of normalized image features with the cached prompt features.
+
+    With `crops` (one prompt_bank key or None per row), rows with a crop are scored against that
+    crop's class embeddings instead: every row goes through one matmul against the generic
+    prompts and the whole bank, and each keeps the columns of its own prompt set.
+    """
+    import torch
+
+    text_feats = get_text_features()
+    if not crops or not any(crops):
+        with torch.no_grad():
+            logits = clip_logit_scale * image_feats @ text_feats.T
+        return logits.cpu().numpy()
+    with torch.no_grad():
+        feats = torch.cat([text_feats, torch.from_numpy(prompt_bank.matrix).to(text_feats.dtype)])
+        logits = (clip_logit_scale * image_feats @ feats.T).cpu().numpy()
+    starts = np.array([0 if crop is None else len(text_feats) + prompt_bank.offsets[crop] for crop in crops])
+    return logits[np.arange(len(crops))[:, None], starts[:, None] + np.arange(len(labels))]
+
+
+def clip_image_logits(images: list[Image.Image], crops: list[Optional[str]] | None = None) -> np.ndarray:
+    """Score images against the cached prompt features; returns logits of shape [N, num_prompts].
+
+    Equivalent to `clip_model(...).logits_per_image` but skips the text tower.
+    """
+    return embeddings_to_logits(clip_image_embeddings(images), crops)
 
 
 def pil_to_bgr(image: Image.Image) -> np.ndarray:
-    arr = np.array(image.convert("RGB"))
-    return arr[:, :, ::-1].copy()
+    return cv2.cvtColor(to_numpy(image.convert("RGB")), cv2.COLOR_RGB2BGR)
 
 
 def bgr_to_png_base64(img_bgr: np.ndarray) -> str:
@@ -71,222 +257,714 @@ def bgr_to_png_base64(img_bgr: np.ndarray) -> str:
     return base64.b64encode(buf.tobytes()).decode("utf-8")
 
 
-def mask_to_png_base64(mask: np.ndarray) -> str:
-    mask_u8 = (mask * 255).astype(np.uint8)
-    success, buf = cv2.imencode(".png", mask_u8)
-    if not success:
-        return ""
-    return base64.b64encode(buf.tobytes()).decode("utf-8")
+# rembg session (SEG_MODEL, SEG_THREADS) created once at startup, with the optional OpenCV
+# fallback for frame-filling produce (SEG_FALLBACK, SEG_FILL_FRAME_RATIO)
+segmentation_engine = engine_from_env()
 
 
 def segment_foreground(image: Image.Image) -> tuple[Image.Image, np.ndarray]:
-    cutout = remove(image)
-    cutout_np = np.array(cutout)
-    if cutout_np.shape[2] == 4:
-        alpha = cutout_np[:, :, 3]
-        mask = (alpha > 0).astype(np.uint8)
-    else:
-        mask = np.ones(cutout_np.shape[:2], dtype=np.uint8)
-    return cutout.convert("RGB"), mask
+    cutout, mask, _ = segmentation_engine.segment(image)
+    return cutout, mask
 
 
-def estimate_decay_ratio(img_rgb: np.ndarray, fg_mask: np.ndarray) -> float:
-    """Estimate decayed-area ratio inside the foreground mask.
+def build_augmentations(image: Image.Image, names: list[str] | None = None) -> list[Image.Image]:
+    """Resize to the CLIP input size and apply the configured test-time augmentations."""
+    base = image.resize((224, 224))
+    return [TTA_TRANSFORMS[name](base) for name in (names or TTA_AUGMENTATIONS)]
+
 
-    Steps:
-    - Denoise and morphologically clean the FG mask to remove speckles.
-    - Use slightly stricter HSV thresholds to reduce lighting/background false positives.
+def summarize_logits(logits: np.ndarray, crop: Optional[str] = None) -> dict:
+    """Turn per-augmentation logits [N_aug, num_prompts] into the clip_classify result dict."""
+    logits = np.asarray(logits, dtype=float)
+    # Row-wise softmax gives the per-augmentation probabilities
+    exps = np.exp(logits - logits.max(axis=1, keepdims=True))
+    probs_aug = exps / exps.sum(axis=1, keepdims=True)
+
+    avg_logits = logits.mean(axis=0)
+    exps = np.exp(avg_logits - np.max(avg_logits))
+    probs = exps / np.sum(exps)
+
+    best_idx = int(np.argmax(probs))
+    return {
+        "label": labels[best_idx],
+        "scores": {labels[i]: float(probs[i]) for i in range(len(labels))},
+        "avg_logits": [float(x) for x in avg_logits],
+        "augment_probs": [{labels[i]: float(row[i]) for i in range(len(labels))} for row in probs_aug],
+        "ensemble_count": int(logits.shape[0]),
+        "prompt_set": crop or "generic",
+    }
+
+
+def clip_classify(image: Image.Image, crop: Optional[str] = None, augmentations: list[str] | None = None) -> dict:
+    """Classify image using CLIP with simple test-time augmentation (flip + brightness tweak)
+
+    All augmentations are preprocessed into one pixel batch and scored in a single forward pass.
+    We average logits across augmentations to reduce brittle single-image misclassifications and
+    return per-augment probabilities and averaged logits for debugging/analysis. `crop` (a
+    prompt_bank key, see resolve_crop) scores against that crop's prompt ensemble instead of
+    the generic label_prompts. `augmentations` overrides TTA_AUGMENTATIONS for this image.
     """
-    # Normalize and clean mask (ensure 0/1 uint8)
-    fg_mask = (fg_mask > 0).astype(np.uint8)
-    # Convert mask to 0..255 image for morphological ops
-    mask_u8 = (fg_mask * 255).astype(np.uint8)
+    return clip_classify_batch([image], [crop], [augmentations])[0]
 
-    # Median blur to remove small speckles
+
+def clip_classify_batch(images: list[Image.Image], crops: list[Optional[str]] | None = None,
+                        augmentations: list[list[str] | None] | None = None) -> list[dict]:
+    """clip_classify for several images at once: every augmentation of every image goes through
+    one [sum of N_aug, 3, 224, 224] forward pass."""
+    ensure_models()
+    crops = crops or [None] * len(images)
+    augmentations = augmentations or [None] * len(images)
+
+    with stage("clip_augment"):
+        aug_images = [build_augmentations(image, names) for image, names in zip(images, augmentations)]
+    flat = [img for augs in aug_images for img in augs]
+    flat_crops = [crop for augs, crop in zip(aug_images, crops) for _ in augs]
     try:
-        mask_u8 = cv2.medianBlur(mask_u8, 5)
+        # One forward against the cached prompt features
+        started = time.perf_counter()
+        logits = clip_image_logits(flat, flat_crops)
+        elapsed = time.perf_counter() - started
+        record_stage("clip_forward", elapsed)
+        if METRICS_ENABLED:
+            CLIP_SECONDS_PER_AUGMENTATION.observe(elapsed / len(flat))
     except Exception:
-        # If blur fails (very small mask), skip
-        pass
+        logger.exception("Error processing augmented images")
+        logits = np.zeros((len(flat), len(label_prompts)), dtype=float)
 
-    # Morphological open/close to remove small holes and isolated pixels
-    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (5, 5))
-    mask_u8 = cv2.morphologyEx(mask_u8, cv2.MORPH_OPEN, kernel)
-    mask_u8 = cv2.morphologyEx(mask_u8, cv2.MORPH_CLOSE, kernel)
+    results = []
+    offset = 0
+    for augs, crop in zip(aug_images, crops):
+        results.append(summarize_logits(logits[offset:offset + len(augs)], crop))
+        offset += len(augs)
+    return results
 
-    fg_mask = (mask_u8 > 0).astype(np.uint8)
 
-    # HSV-based decay heuristics (stricter than before)
-    hsv = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2HSV)
-    v = hsv[:, :, 2].astype(int)
-    s = hsv[:, :, 1].astype(int)
-    h = hsv[:, :, 0].astype(int)
+# Coalesce CLIP scoring across concurrent /infer requests when CLIP_BATCH_WINDOW_MS > 0: cutouts
+# wait up to that long (or until CLIP_MAX_BATCH are queued) and share one forward pass.
+CLIP_BATCH_WINDOW_MS = float(os.environ.get("CLIP_BATCH_WINDOW_MS", "0"))
+CLIP_MAX_BATCH = int(os.environ.get("CLIP_MAX_BATCH", "8"))
 
-    dark = (v < 40)
-    brown_like = ((h > 8) & (h < 28) & (s > 100) & (v < 100))
-    mold_green = ((h > 40) & (h < 80) & (s > 80) & (v < 140))
 
-    # Combine rules conservatively to avoid marking benign dark/background pixels
-    spoiled = (brown_like | mold_green) | (dark & (s > 40))
+def _clip_classify_items(items: list[tuple[Image.Image, Optional[str], list[str] | None]]) -> list[dict]:
+    images, crops, augmentations = zip(*items)
+    return clip_classify_batch(list(images), list(crops), list(augmentations))
 
-    spoiled_fg = spoiled * fg_mask
-    num_fg = int(np.sum(fg_mask > 0))
-    num_spoiled = int(np.sum(spoiled_fg > 0))
 
-    # If foreground is tiny, treat as no decay to avoid false positives on tiny crops
-    if num_fg < 50:
-        return 0.0
+clip_batcher = (MicroBatcher(_clip_classify_items, max_batch=CLIP_MAX_BATCH, window_ms=CLIP_BATCH_WINDOW_MS)
+                if CLIP_BATCH_WINDOW_MS > 0 else None)
 
-    if num_fg == 0:
-        return 0.0
 
-    return float(num_spoiled) / float(num_fg)
+def classify_cutout(image: Image.Image, crop: Optional[str] = None, augmentations: list[str] | None = None) -> dict:
+    """clip_classify, routed through the request-coalescing batcher when it is enabled."""
+    if clip_batcher is None:
+        return clip_classify(image, crop, augmentations)
+    return clip_batcher.submit((image, crop, augmentations))
 
 
-def clip_classify(image: Image.Image) -> dict:
-    """Classify image using CLIP with simple test-time augmentation (flip + brightness tweak)
+# Heuristic-first cascade (INFER_CASCADE=1): an image whose decay ratio is below good_below or above
+# bad_above is labelled from the decay ratio alone (heuristic_quality), without running CLIP; in between CLIP runs with
+# TTA_AUGMENTATIONS or, with tta false, on the first augmentation only. The defaults never exit
+# early; evaluate.py --mode cascade calibrates the thresholds into a QUALITY_CONFIG "cascade" section.
+CASCADE_ENABLED = os.environ.get("INFER_CASCADE", "0") == "1"
+CASCADE_PARAMS = {"good_below": 0.0, "bad_above": 1.0, "tta": True}
 
-    We average logits across augmentations to reduce brittle single-image misclassifications and
-    return per-augment probabilities and averaged logits for debugging/analysis.
-    """
-    ensure_models()
 
-    # Build simple augmentations: original, horizontal flip, slight brightness increase
-    aug_images = []
-    base = image.resize((224, 224))
-    aug_images.append(base)
-    aug_images.append(base.transpose(Image.FLIP_LEFT_RIGHT))
-    try:
-        from PIL import ImageEnhance
-        enhancer = ImageEnhance.Brightness(base)
-        aug_images.append(enhancer.enhance(1.07))
-    except Exception:
-        # If ImageEnhance not available for any reason, just skip
-        pass
+def cascade_path(decay_ratio: float) -> str:
+    """Cascade path for an image: "heuristic" (no CLIP), "clip" (with TTA) or "clip-fast" (one view)."""
+    if decay_ratio < CASCADE_PARAMS["good_below"] or decay_ratio > CASCADE_PARAMS["bad_above"]:
+        return "heuristic"
+    return "clip" if CASCADE_PARAMS["tta"] else "clip-fast"
 
-    logits_acc = None
-    per_aug_probs = []
-    with torch.no_grad():
-        for img in aug_images:
-            try:
-                inputs = clip_processor(text=label_prompts, images=img, return_tensors="pt", padding=True, truncation=True)
-                outputs = clip_model(**inputs)
-                # logits_per_image shape: [1, num_prompts]
-                lg = outputs.logits_per_image.cpu().numpy()[0]
-            except Exception as e:
-                print(f"Error processing augmented image: {e}")
-                lg = np.zeros(len(label_prompts), dtype=float)
 
-            # Convert logits to softmax probs for this augmentation
-            exps = np.exp(lg - np.max(lg))
-            probs_aug = (exps / np.sum(exps)).astype(float)
-            per_aug_probs.append({labels[i]: float(probs_aug[i]) for i in range(len(labels))})
+def load_quality_config(path: str) -> None:
+    """Override FUSION_PARAMS / DECAY_HSV_RANGES / CASCADE_PARAMS from a JSON config written by
+    evaluate.py --mode sweep or --mode cascade."""
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    apply_quality_config(config)
+    if "cascade" in config:
+        cascade = config["cascade"]
+        CASCADE_PARAMS.update(good_below=float(cascade["good_below"]), bad_above=float(cascade["bad_above"]),
+                              tta=bool(cascade.get("tta", True)))
 
-            if logits_acc is None:
-                logits_acc = lg
-            else:
-                logits_acc = logits_acc + lg
 
-    if logits_acc is None:
-        probs = np.ones(len(labels)) / len(labels)
-        avg_logits = np.zeros(len(labels), dtype=float)
-    else:
-        avg_logits = (logits_acc / float(len(aug_images))).astype(float)
-        exps = np.exp(avg_logits - np.max(avg_logits))
-        probs = (exps / np.sum(exps)).astype(float)
+if os.environ.get("QUALITY_CONFIG"):
+    load_quality_config(os.environ["QUALITY_CONFIG"])
 
-    best_idx = int(np.argmax(probs))
-    result = {
-        "label": labels[best_idx],
-        "scores": {labels[i]: float(probs[i]) for i in range(len(labels))},
-        "avg_logits": [float(x) for x in avg_logits],
-        "augment_probs": per_aug_probs,
-        "ensemble_count": len(aug_images)
-    }
-    return result
+
+# vit_class keys that are only returned with detail=full
+DEBUG_CLASS_FIELDS = ("avg_logits", "augment_probs", "ensemble_count", "prompt_set")
 
 
-def combine_quality(decay_ratio: float, cls_scores: dict) -> tuple[str, dict[str, float]]:
-    """Combine the decay ratio and classifier probabilities into a final quality label.
+def run_inference(data: bytes, projection: Optional[dict] = None, crop: Optional[str] = None,
+                  digest: Optional[str] = None) -> tuple[dict, dict]:
+    """Full blocking pipeline for one uploaded image; runs on an inference worker thread.
 
-    Approach:
-    - Compute a small set of combined scores that blend CLIP softmax probabilities with the
-      decay_ratio signal computed from image segmentation.
-    - Use conservative blending weights so neither signal alone (unless very strong) will
-      dominate and cause obvious misclassifications.
+    Segmentation, decay scoring and CLIP run at WORK_MAX_SIDE; only the returned mask is scaled
+    back up to the uploaded resolution (or to `mask_max_side`). The mask is encoded, and the CLIP
+    debug fields returned, only when `projection` (see parse_projection) asks for them. `crop`
+    (a prompt_bank key) scores CLIP against that crop's prompt ensemble. With the embedding index
+    enabled, `digest` (the upload's content hash) indexes the image, and a near duplicate of an
+    indexed image is answered with that image's cached response.
+    Returns the response and {"timings": stage durations in ms, "near_duplicate": match if reused}.
     """
-    g = float(cls_scores.get("Good/Fresh", 0.0))
-    r = float(cls_scores.get("Rotten/Spoiled", 0.0))
-    b = float(cls_scores.get("Completely Bad/Decomposed", 0.0))
-
-    scores = {
-        "Good/Fresh": 0.0,
-        "Rotten/Spoiled": 0.0,
-        "Completely Bad/Decomposed": 0.0,
+    projection = projection or parse_projection()
+    info: dict = {"timings": {}}
+    with request_timings(info["timings"]):
+        resp = _run_stages(data, projection, crop, digest, info)
+    return resp, info
+
+
+def _run_stages(data: bytes, projection: dict, crop: Optional[str], digest: Optional[str], info: dict) -> dict:
+    # Decode time is always measured: it is reported in X-Decode-Time-Ms even with METRICS_ENABLED=0
+    started = time.perf_counter()
+    work, upload_size = decode_image(data, WORK_MAX_SIDE)
+    record_stage("decode", time.perf_counter() - started)
+    degraded = HEURISTIC_UNTIL_READY and not startup.is_ready("clip")
+    cascade = CASCADE_ENABLED and not degraded
+    dedup = embedding_index is not None and digest is not None and not degraded
+    embedding = None
+    # The dedup embedding is a CLIP pass: with the cascade it is only taken once the decay ratio
+    # shows the image needs CLIP, so heuristic exits stay CLIP-free
+    if dedup and not cascade:
+        embedding, near = dedup_lookup(work, digest, projection, crop, info)
+        if near is not None:
+            return near
+    with stage("segment"):
+        cutout, mask = segment_foreground(work)
+    with stage("decay"):
+        decay_ratio = estimate_decay_ratio(to_numpy(cutout), mask)
+    path = cascade_path(decay_ratio) if cascade else None
+    if dedup and path in ("clip", "clip-fast"):
+        embedding, near = dedup_lookup(work, digest, projection, crop, info)
+        if near is not None:
+            return near
+    if path is not None:
+        CASCADE_PATHS.inc(path=path)
+    with stage("clip"):
+        if degraded or path == "heuristic":
+            cls = {"label": None, "scores": {}}
+        else:
+            cls = classify_cutout(cutout, crop, TTA_AUGMENTATIONS[:1] if path == "clip-fast" else None)
+    with stage("fuse"):
+        if degraded or path == "heuristic":
+            # Without CLIP scores the decay cutoffs label the image (the ones evaluate.py --mode
+            # cascade calibrated the exits with), as in app.py
+            final_quality, final_scores = heuristic_quality(decay_ratio)
+        else:
+            final_quality, final_scores = combine_quality(decay_ratio, cls.get("scores", {}))
+    if projection["detail"] != "full":
+        cls = {k: v for k, v in cls.items() if k not in DEBUG_CLASS_FIELDS}
+    resp = {
+        "decayed_area_ratio": decay_ratio,
+        "vit_class": cls,
+        "final_quality": final_quality,
+        "final_scores": final_scores,
     }
+    if projection["mask"] != "none":
+        with stage("mask_encode"):
+            out_mask = upsample_mask(mask, fit_to_max_side(upload_size, projection["mask_max_side"]))
+            if projection["mask"] == "png":
+                resp["mask_png_base64"] = mask_to_png_base64(out_mask)
+            else:
+                resp["mask_rle"] = mask_to_rle(out_mask)
+    if degraded:
+        resp["degraded"] = True
+    if path is not None:
+        resp["path"] = path
+    if embedding is not None:
+        embedding_index.add(embedding, digest)
+    return resp
+
+
+# Longest side (pixels) that segmentation and scoring work at; 0 keeps the uploaded resolution.
+# evaluate.py --work-max-side N --compare-full-res reports the accuracy cost of a given value.
+WORK_MAX_SIDE = int(os.environ.get("WORK_MAX_SIDE", "0"))
+
+# Worker pool sized by INFER_WORKERS / INFER_QUEUE_SIZE / INFER_TIMEOUT_S
+inference_executor = executor_from_env()
+
+
+def warm_worker() -> None:
+    """Runs on every inference worker thread once CLIP has loaded: builds the thread's private
+    encoder (INFER_PER_WORKER_MODELS=1) and runs one tiny forward, so no request pays for either."""
+    clip_image_embeddings([Image.new("RGB", (224, 224))])
 
-    # Adaptive weighting
-    # Case 1: AI sees clear rot/spoilage. Trust AI to catch texture/color patterns that segmentation missed.
-    if r > 0.75 or b > 0.75:
-        w_ai = 0.8
-        w_decay = 0.2
-        scores["Good/Fresh"] = w_ai * g + w_decay * (1.0 - decay_ratio)
-        scores["Rotten/Spoiled"] = w_ai * r + w_decay * decay_ratio
-        scores["Completely Bad/Decomposed"] = w_ai * b + w_decay * decay_ratio
-
-    # Case 2: Low physical decay and AI is not convinced it's rotten. Trust the "clean" segmentation.
-    elif decay_ratio < 0.05:
-        w_ai = 0.35
-        w_decay = 0.65
-        scores["Good/Fresh"] = w_ai * g + w_decay * (1.0 - decay_ratio)
-        scores["Rotten/Spoiled"] = w_ai * r + w_decay * decay_ratio
-        scores["Completely Bad/Decomposed"] = w_ai * b + w_decay * decay_ratio
-
-    # Case 3: Ambiguous / Normal case. Moderate blend.
-    else:
-        w_ai = 0.6
-        w_decay = 0.4
-        scores["Good/Fresh"] = w_ai * g + w_decay * (1.0 - decay_ratio)
-        scores["Rotten/Spoiled"] = w_ai * r + w_decay * decay_ratio
-        scores["Completely Bad/Decomposed"] = w_ai * b + w_decay * decay_ratio
 
-    # Normalize scores to sum to 1.0 for cleaner probability output
-    total_score = sum(scores.values())
-    if total_score > 0:
-        scores = {k: v / total_score for k, v in scores.items()}
+def warm_workers() -> None:
+    startup.wait("clip")
+    inference_executor.run_on_every_worker(warm_worker)
+RETRY_AFTER_S = os.environ.get("INFER_RETRY_AFTER_S", "2")
 
-    # Choose best label
-    best_label, best_score = max(scores.items(), key=lambda kv: kv[1])
+# Bump whenever decoding, estimate_decay_ratio or combine_quality rules change so cached results
+# from the old rules are not served.
+PIPELINE_VERSION = "3"
 
-    # Safety rules to avoid over-triggering Rotten due to classifier-only signal:
-    # - If decay is very low and the best score is weak, prefer Good/Fresh.
-    if best_score < 0.45 and decay_ratio < 0.15:
-        return "Good/Fresh", scores
+# Serialized /infer responses keyed by image hash (INFER_CACHE_SIZE / _MAX_MB / _TTL_S / _DB)
+result_cache = cache_from_env()
+
+
+def pipeline_fingerprint() -> str:
+    """Hash of everything besides the image bytes that determines the /infer response."""
+    config = [PIPELINE_VERSION, CLIP_MODEL_NAME, CLIP_BACKEND, labels, label_prompts, TTA_AUGMENTATIONS, WORK_MAX_SIDE,
+              FUSION_PARAMS, [[lo.tolist(), hi.tolist()] for lo, hi in DECAY_HSV_RANGES],
+              segmentation_engine.model_name, segmentation_engine.fallback, segmentation_engine.fill_frame_ratio,
+              segmentation_engine.saturation_threshold]
+    if CASCADE_ENABLED:
+        config.extend([CASCADE_PARAMS, HEURISTIC_PARAMS])
+    return hashlib.sha256(json.dumps(config).encode("utf-8")).hexdigest()[:16]
+
+
+def result_cache_key(digest: str, projection: Optional[dict] = None, crop: Optional[str] = None) -> str:
+    """Cache key of the response for the upload with sha256 `digest`, as shaped by `projection` and `crop`."""
+    projection = projection or parse_projection()
+    view = f"{projection['detail']}:{projection['mask']}:{projection['mask_max_side']}"
+    key = f"{digest}:{pipeline_fingerprint()}:{view}"
+    if crop is not None:
+        key += f":{crop}@{bank_fingerprint(CLIP_MODEL_NAME)}"
+    return key
+
+
+# CLIP embeddings of recent uploads for near-duplicate reuse and /similar (EMBED_INDEX_SIZE / _PATH /
+# _IVF_MIN / _NPROBE). Off by default: indexing costs one extra single-view CLIP pass per new image.
+embedding_index = index_from_env()
+# Cosine similarity at or above which /infer reuses an indexed image's cached response; 0 disables reuse
+DEDUP_THRESHOLD = float(os.environ.get("EMBED_DEDUP_THRESHOLD", "0.97"))
+
+
+def lookup_embedding(image: Image.Image) -> np.ndarray:
+    """Normalized CLIP embedding of the whole work image (clip_classify's "original" view), for the index.
+
+    It is taken before segmentation so a near duplicate can skip the rest of the pipeline (after the
+    decay stage with INFER_CASCADE=1, and only for images that go on to CLIP).
+    """
+    return clip_image_embeddings(build_augmentations(image, ["original"]))[0].cpu().numpy()
+
+
+def dedup_lookup(work: Image.Image, digest: str, projection: dict, crop: Optional[str],
+                 info: dict) -> tuple[np.ndarray, Optional[dict]]:
+    """Index embedding of `work` and the reused near-duplicate response, if any (noted in `info`)."""
+    with stage("dedup"):
+        embedding = lookup_embedding(work)
+        near = find_near_duplicate(embedding, digest, projection, crop)
+    if near is None:
+        return embedding, None
+    info["near_duplicate"] = near[1]
+    return embedding, near[0]
+
+
+def find_near_duplicate(embedding: np.ndarray, digest: str, projection: dict,
+                        crop: Optional[str]) -> Optional[tuple[dict, dict]]:
+    """(response, index match) reusing the most similar other indexed image, when it is similar
+    enough and its response for this projection and crop is still in the result cache.
+
+    Only responses without a mask are reused: a mask (and its size) belongs to the other upload.
+    The reused response is marked with "near_duplicate": {"id", "similarity"}.
+    """
+    if result_cache is None or DEDUP_THRESHOLD <= 0 or projection["mask"] != "none":
+        return None
+    for match in embedding_index.search(embedding, k=2):
+        if match["id"] != digest and match["similarity"] >= DEDUP_THRESHOLD:
+            body = result_cache.get(result_cache_key(match["id"], projection, crop))
+            if body is not None:
+                resp = json.loads(body)
+                resp["near_duplicate"] = {"id": match["id"], "similarity": match["similarity"]}
+                return resp, match
+    return None
+
+
+# cProfile hook: INFER_PROFILE_DIR enables ?profile=1 on /infer, INFER_PROFILE_EVERY=N samples every Nth request
+profiler = profiler_from_env()
+# Add a Server-Timing header with the per-stage durations to uncached /infer responses
+SERVER_TIMING = os.environ.get("INFER_SERVER_TIMING", "0") == "1"
+
+registry.register(Gauge("infer_in_flight", "Admitted /infer jobs, running or queued", lambda: inference_executor.in_flight))
+registry.register(Gauge("infer_queue_depth", "Admitted /infer jobs waiting for a worker", lambda: inference_executor.queue_depth))
+registry.register(Gauge("clip_batch_queue_depth", "Cutouts waiting for the CLIP micro-batcher",
+                        lambda: clip_batcher.queue_depth if clip_batcher is not None else 0))
+registry.register(Gauge("infer_cache_hit_ratio", "Result cache hit ratio since start",
+                        lambda: result_cache.stats()["hit_ratio"] if result_cache is not None else 0.0))
+
+
+async def cache_call(fn, *args):
+    """Run a result_cache method; in a thread when it may block on the sqlite tier."""
+    if result_cache.disk:
+        return await asyncio.to_thread(fn, *args)
+    return fn(*args)
+
+
+def content_digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+async def cached_inference(data: bytes, projection: Optional[dict] = None, crop: Optional[str] = None,
+                           profile: bool = False) -> tuple[bytes, bool, dict]:
+    """Serialized /infer response for one image, whether it came from the result cache, and
+    details of the run: "timings" (stage durations in ms, empty on a hit), "near_duplicate" (the
+    index match whose response was reused, if any) and, for profiled runs, "profile" (path of
+    the dumped cProfile stats). Profiled runs bypass the cache.
+
+    Raises QueueFullError / asyncio.TimeoutError from the inference executor and ImageDecodeError
+    for uploads that are not acceptable images.
+    """
+    check_upload_size(len(data))
+    profile = profiler.should_profile(profile)
+    # Hashing a large upload takes tens of milliseconds; hashlib releases the GIL while it runs
+    digest = await asyncio.to_thread(content_digest, data)
+    cache_key = result_cache_key(digest, projection, crop) if result_cache is not None and not profile else None
+    if cache_key is not None:
+        body = await cache_call(result_cache.get, cache_key)
+        if body is not None:
+            info = {"timings": {}}
+            # A reused near-duplicate response stays reported as one (those bodies carry no mask)
+            if b'"near_duplicate"' in body:
+                info["near_duplicate"] = json.loads(body)["near_duplicate"]
+            return body, True, info
+    if profile:
+        (resp, info), profile_path = await inference_executor.run(profiler.run, run_inference, data, projection,
+                                                                  crop, digest)
+        info["profile"] = profile_path
+    else:
+        resp, info = await inference_executor.run(run_inference, data, projection, crop, digest)
+    body = bytes(JSONResponse(resp).body)
+    if cache_key is not None and not resp.get("degraded"):
+        await cache_call(result_cache.put, cache_key, body)
+    return body, False, info
 
-    # If decay is very low but classifier is close between Good and Rotten, prefer Good
-    if decay_ratio < 0.12 and (r - g) < 0.18:
-        return "Good/Fresh", scores
 
-    return best_label, scores
+def models_loading_response() -> Optional[JSONResponse]:
+    """503 while the models an /infer request needs are still loading (INFER_HEURISTIC_UNTIL_READY=1)."""
+    if startup.is_ready("segmentation"):
+        return None
+    return JSONResponse({"detail": "models are loading, retry later"}, status_code=503,
+                        headers={"Retry-After": RETRY_AFTER_S})
 
 
 @app.post("/infer")
-async def infer(file: UploadFile = File(...)):
+async def infer(file: UploadFile = File(...), detail: str = "minimal", mask: Optional[str] = None,
+                mask_max_side: int = 0, crop_type: Optional[str] = None, profile: bool = False):
+    """Score one image. `detail=full` adds the CLIP debug fields and a mask PNG; `mask=none|png|rle`
+    and `mask_max_side` choose the mask encoding and its resolution independently. `crop_type`
+    scores CLIP against that crop's prompt ensemble (generic prompts for unknown crops)."""
+    started = time.perf_counter()
+    response = await _infer(file, detail, mask, mask_max_side, resolve_crop(crop_type), profile)
+    REQUEST_SECONDS.observe(time.perf_counter() - started)
+    REQUESTS.inc(endpoint="/infer", status=response.status_code)
+    return response
+
+
+async def _infer(file: UploadFile, detail: str, mask: Optional[str], mask_max_side: int, crop: Optional[str],
+                 profile: bool) -> Response:
+    try:
+        projection = parse_projection(detail, mask, mask_max_side)
+    except ValueError as e:
+        return JSONResponse({"detail": str(e)}, status_code=400)
+    loading = models_loading_response()
+    if loading is not None:
+        return loading
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        return JSONResponse({"detail": f"upload exceeds {MAX_UPLOAD_BYTES} bytes"}, status_code=413)
     data = await file.read()
-    image = Image.open(BytesIO(data)).convert("RGB")
-    cutout, mask = segment_foreground(image)
-    decay_ratio = estimate_decay_ratio(np.array(cutout), mask)
-    cls = clip_classify(cutout)
-    final_quality, final_scores = combine_quality(decay_ratio, cls.get("scores", {}))
-    mask_b64 = mask_to_png_base64(mask)
-    resp = {
-        "decayed_area_ratio": decay_ratio,
-        "vit_class": cls,
-        "final_quality": final_quality,
-        "final_scores": final_scores,
-        "mask_png_base64": mask_b64
-    }
-    return JSONResponse(resp)
+    try:
+        body, hit, info = await cached_inference(data, projection, crop, profile)
+    except ImageTooLargeError as e:
+        return JSONResponse({"detail": str(e)}, status_code=413)
+    except ImageDecodeError as e:
+        return JSONResponse({"detail": str(e)}, status_code=400)
+    except QueueFullError:
+        return JSONResponse({"detail": "ML service is busy, retry later"}, status_code=503,
+                            headers={"Retry-After": RETRY_AFTER_S})
+    except asyncio.TimeoutError:
+        return JSONResponse({"detail": "inference timed out"}, status_code=504)
+    headers = {"X-Cache": "HIT" if hit else "MISS"} if result_cache is not None else {}
+    near = info.get("near_duplicate")
+    if near is not None:
+        headers["X-Cache"] = "NEAR"
+        headers["X-Near-Duplicate"] = f"{near['id']};similarity={near['similarity']:.4f}"
+    timings = info["timings"]
+    if "decode" in timings:
+        headers["X-Decode-Time-Ms"] = f"{timings['decode']:.1f}"
+    if SERVER_TIMING and timings:
+        headers["Server-Timing"] = server_timing_header(timings)
+    if info.get("profile"):
+        headers["X-Profile-File"] = os.path.basename(info["profile"])
+    startup.mark_first_response(degraded=not startup.is_ready("clip"))
+    return Response(body, media_type="application/json", headers=headers)
+
+
+# Upper bound on images accepted by one /infer/batch request (after archive expansion)
+BATCH_MAX_IMAGES = int(os.environ.get("INFER_BATCH_MAX_IMAGES", "32"))
+# Upper bound on the bytes one /infer/batch request may unpack from archives
+BATCH_MAX_UNPACKED_BYTES = int(float(os.environ.get("INFER_BATCH_MAX_UNPACKED_MB", "256")) * 1024 * 1024)
+ARCHIVE_IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp", ".bmp", ".tif", ".tiff")
+
+
+def _archive_member_wanted(name: str) -> bool:
+    base = os.path.basename(name)
+    return (not base.startswith(".") and "__MACOSX" not in name
+            and base.lower().endswith(ARCHIVE_IMAGE_EXTENSIONS))
+
+
+class BatchTooLargeError(Exception):
+    """Raised when a /infer/batch upload holds too many images or unpacks to too many bytes."""
+
+
+def _check_member(name: str, size: int, count: int, total: int, max_images: int, max_bytes: int) -> None:
+    if count > max_images:
+        raise BatchTooLargeError(f"at most {BATCH_MAX_IMAGES} images per batch")
+    if size > MAX_UPLOAD_BYTES:
+        raise BatchTooLargeError(f"{name} exceeds {MAX_UPLOAD_BYTES} bytes")
+    if total > max_bytes:
+        raise BatchTooLargeError(f"archives unpack to more than {BATCH_MAX_UNPACKED_BYTES} bytes")
+
+
+def expand_upload(filename: str, data: bytes, max_images: int = BATCH_MAX_IMAGES,
+                  max_bytes: int = BATCH_MAX_UNPACKED_BYTES) -> list[tuple[str, bytes]]:
+    """Split one uploaded blob into (name, image bytes) pairs; zip and tar(.gz) archives are unpacked.
+
+    Member counts and sizes are checked against `max_images`, MAX_UPLOAD_BYTES and `max_bytes`
+    (unpacked bytes) before anything is extracted; BatchTooLargeError is raised past any of them.
+    Blocking: run it off the event loop.
+    """
+    if zipfile.is_zipfile(BytesIO(data)):
+        with zipfile.ZipFile(BytesIO(data)) as zf:
+            wanted = [info for info in zf.infolist() if not info.is_dir() and _archive_member_wanted(info.filename)]
+            total = 0
+            for count, info in enumerate(wanted, 1):
+                total += info.file_size
+                _check_member(info.filename, info.file_size, count, total, max_images, max_bytes)
+            items, total = [], 0
+            for info in wanted:
+                # Never trust the declared sizes: read at most one byte past the limit
+                with zf.open(info) as member:
+                    content = member.read(MAX_UPLOAD_BYTES + 1)
+                total += len(content)
+                _check_member(info.filename, len(content), 0, total, max_images, max_bytes)
+                items.append((info.filename, content))
+            return items
+    try:
+        with tarfile.open(fileobj=BytesIO(data), mode="r:*") as tf:
+            wanted, count, total = [], 0, 0
+            # Walk the headers one by one so a compressed bomb is rejected before it is fully inflated
+            for m in iter(tf.next, None):
+                if not m.isfile():
+                    continue
+                total += m.size
+                if _archive_member_wanted(m.name):
+                    count += 1
+                    wanted.append(m)
+                    _check_member(m.name, m.size, count, total, max_images, max_bytes)
+                elif total > max_bytes:
+                    _check_member(m.name, 0, 0, total, max_images, max_bytes)
+            return [(m.name, tf.extractfile(m).read()) for m in wanted]
+    except tarfile.TarError:
+        return [(filename, data)]
+
+
+def listing_quality(results: list[dict]) -> dict:
+    """Listing-level quality: per-image final_scores averaged with each image's confidence as weight."""
+    totals = {lab: 0.0 for lab in labels}
+    total_w = 0.0
+    for res in results:
+        scores = res.get("final_scores", {})
+        w = max(scores.values(), default=0.0)
+        for lab in labels:
+            totals[lab] += w * scores.get(lab, 0.0)
+        total_w += w
+    if total_w <= 0:
+        return {"final_quality": None, "final_scores": {lab: 0.0 for lab in labels}}
+    final_scores = {lab: totals[lab] / total_w for lab in labels}
+    return {"final_quality": max(final_scores, key=final_scores.get), "final_scores": final_scores}
+
+
+@app.post("/infer/batch")
+async def infer_batch(request: Request, detail: str = "minimal", mask: Optional[str] = None,
+                      mask_max_side: int = 0, crop_type: Optional[str] = None):
+    """Score many images in one request and stream one NDJSON line per image as it finishes.
+
+    Accepts multipart form uploads (any number of file fields; zip/tar parts are unpacked) or a
+    raw zip/tar body. Result lines are {"index", "filename", "cached", "result"} or
+    {"index", "filename", "error", "status"}, in completion order; the last line is
+    {"summary": {...}} with the listing-level quality. `detail`/`mask`/`mask_max_side` shape each
+    result and `crop_type` picks the prompt ensemble, as on /infer.
+    """
+    crop = resolve_crop(crop_type)
+    try:
+        projection = parse_projection(detail, mask, mask_max_side)
+    except ValueError as e:
+        return JSONResponse({"detail": str(e)}, status_code=400)
+    loading = models_loading_response()
+    if loading is not None:
+        return loading
+    items: list[tuple[str, bytes]] = []
+    unpacked = 0
+
+    async def expand(name: str, data: bytes) -> None:
+        nonlocal unpacked
+        parts = await asyncio.to_thread(expand_upload, name, data, BATCH_MAX_IMAGES - len(items),
+                                        BATCH_MAX_UNPACKED_BYTES - unpacked)
+        items.extend(parts)
+        unpacked += sum(len(part) for _, part in parts)
+
+    try:
+        if request.headers.get("content-type", "").startswith("multipart/"):
+            form = await request.form()
+            for _, value in form.multi_items():
+                if hasattr(value, "read"):
+                    data = await value.read()
+                    if data:
+                        await expand(value.filename or "image", data)
+        else:
+            data = await request.body()
+            if data:
+                await expand("image", data)
+    except BatchTooLargeError as e:
+        return JSONResponse({"detail": str(e)}, status_code=413)
+    if not items:
+        return JSONResponse({"detail": "no images in request"}, status_code=400)
+    if len(items) > BATCH_MAX_IMAGES:
+        return JSONResponse({"detail": f"at most {BATCH_MAX_IMAGES} images per batch"}, status_code=413)
+
+    # One in-flight image per worker: the batch keeps every worker busy (and CLIP micro-batches
+    # fill up) without taking admission-queue slots from other clients.
+    slots = asyncio.Semaphore(inference_executor.workers)
+
+    async def score(index: int, name: str, data: bytes) -> dict:
+        line = {"index": index, "filename": name}
+        async with slots:
+            try:
+                body, hit, info = await cached_inference(data, projection, crop)
+            except ImageTooLargeError as e:
+                return {**line, "error": str(e), "status": 413}
+            except ImageDecodeError as e:
+                return {**line, "error": str(e), "status": 400}
+            except QueueFullError:
+                return {**line, "error": "ML service is busy, retry later", "status": 503}
+            except asyncio.TimeoutError:
+                return {**line, "error": "inference timed out", "status": 504}
+            except Exception as e:
+                return {**line, "error": str(e), "status": 500}
+        if "near_duplicate" in info:
+            line["near_duplicate"] = info["near_duplicate"]
+        return {**line, "cached": hit, "result": json.loads(body)}
+
+    async def stream():
+        tasks = [asyncio.ensure_future(score(i, name, data)) for i, (name, data) in enumerate(items)]
+        results = []
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                line = await next_done
+                if "result" in line:
+                    results.append(line["result"])
+                yield json.dumps(line) + "\n"
+            summary = {"images": len(items), "failed": len(items) - len(results), **listing_quality(results)}
+            REQUESTS.inc(endpoint="/infer/batch", status=200)
+            yield json.dumps({"summary": summary}) + "\n"
+            startup.mark_first_response(degraded=not startup.is_ready("clip"))
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+# Asynchronous /jobs (JOBS_DB / _TTL_S / _MAX_QUEUED / _CALLBACK_PREFIXES). JOBS_CONCURRENCY jobs are
+# scored at a time, through the same executor and result cache as /infer.
+jobs = jobs_from_env()
+JOBS_CONCURRENCY = int(os.environ.get("JOBS_CONCURRENCY", str(inference_executor.workers)))
+
+
+async def run_job(data: bytes, params: dict) -> tuple[int, "bytes | str"]:
+    """Score one queued job: (200, /infer response body) or (error status, message)."""
+    # Jobs wait for every model instead of being answered from the heuristic
+    await asyncio.to_thread(startup.wait_all)
+    while True:
+        try:
+            body, _, _ = await cached_inference(data, params["projection"], params["crop"])
+            return 200, body
+        except QueueFullError:
+            # Interactive /infer traffic has the executor; wait for a slot instead of failing the job
+            await asyncio.sleep(float(RETRY_AFTER_S))
+        except ImageTooLargeError as e:
+            return 413, str(e)
+        except ImageDecodeError as e:
+            return 400, str(e)
+        except asyncio.TimeoutError:
+            return 504, "inference timed out"
+
+
+@app.post("/jobs", status_code=202)
+async def submit_job(file: UploadFile = File(...), detail: str = "minimal", mask: Optional[str] = None,
+                     mask_max_side: int = 0, crop_type: Optional[str] = None, priority: str = "interactive",
+                     callback_url: Optional[str] = None):
+    """Queue one image for scoring and return its job id at once. Poll GET /jobs/{id}, or pass
+    `callback_url` to have the finished job POSTed there. `priority=background` jobs run after
+    every queued `interactive` one. Other parameters are as on /infer."""
+    try:
+        projection = parse_projection(detail, mask, mask_max_side)
+    except ValueError as e:
+        return JSONResponse({"detail": str(e)}, status_code=400)
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        return JSONResponse({"detail": f"upload exceeds {MAX_UPLOAD_BYTES} bytes"}, status_code=413)
+    data = await file.read()
+    if not data:
+        return JSONResponse({"detail": "empty upload"}, status_code=400)
+    try:
+        check_upload_size(len(data))
+        job = await jobs.submit(data, {"projection": projection, "crop": resolve_crop(crop_type)}, priority, callback_url)
+    except ImageTooLargeError as e:
+        return JSONResponse({"detail": str(e)}, status_code=413)
+    except ValueError as e:
+        return JSONResponse({"detail": str(e)}, status_code=400)
+    except JobQueueFullError:
+        return JSONResponse({"detail": "job queue is full, retry later"}, status_code=503,
+                            headers={"Retry-After": RETRY_AFTER_S})
+    return JSONResponse(job, status_code=202, headers={"Location": f"/jobs/{job['id']}"})
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    """Job state (queued, running, done or failed); done jobs carry the /infer response as `result`,
+    failed ones `status` and `error`."""
+    # async: the job store is only touched from the event loop
+    job = await jobs.get(job_id)
+    if job is None:
+        return JSONResponse({"detail": "unknown job"}, status_code=404)
+    return job
+
+
+def similar_images(data: bytes, k: int) -> list[dict]:
+    work, _ = decode_image(data, WORK_MAX_SIDE)
+    return embedding_index.search(lookup_embedding(work), k)
+
+
+@app.post("/similar")
+async def similar(file: UploadFile = File(...), k: int = 10):
+    """Indexed uploads most similar to this image, for moderation (reposts, photos reused across
+    listings). Matches are {"id": sha256 of the upload, "similarity", "added_at"}, best first; the
+    image itself is not added to the index."""
+    if embedding_index is None:
+        return JSONResponse({"detail": "the embedding index is disabled (EMBED_INDEX_SIZE=0)"}, status_code=404)
+    if not 1 <= k <= 100:
+        return JSONResponse({"detail": "k must be between 1 and 100"}, status_code=400)
+    if not startup.is_ready("clip"):
+        return JSONResponse({"detail": "models are loading, retry later"}, status_code=503,
+                            headers={"Retry-After": RETRY_AFTER_S})
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        return JSONResponse({"detail": f"upload exceeds {MAX_UPLOAD_BYTES} bytes"}, status_code=413)
+    data = await file.read()
+    try:
+        matches = await inference_executor.run(similar_images, data, k)
+    except ImageTooLargeError as e:
+        return JSONResponse({"detail": str(e)}, status_code=413)
+    except ImageDecodeError as e:
+        return JSONResponse({"detail": str(e)}, status_code=400)
+    except QueueFullError:
+        return JSONResponse({"detail": "ML service is busy, retry later"}, status_code=503,
+                            headers={"Retry-After": RETRY_AFTER_S})
+    except asyncio.TimeoutError:
+        return JSONResponse({"detail": "lookup timed out"}, status_code=504)
+    return {"id": hashlib.sha256(data).hexdigest(), "matches": matches, "index_size": embedding_index.stats()["size"]}
 
 
 @app.get("/")
@@ -294,9 +972,47 @@ def root():
     return {"status": "ok"}
 
 
+@app.get("/metrics")
+def metrics_endpoint():
+    """Prometheus text exposition: stage/request latency histograms, request counts and queue gauges."""
+    return Response(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/healthz")
+def healthz():
+    """Liveness: the process is up and serving HTTP, whether or not the models have loaded."""
+    return {"status": "ok", "uptime_s": round(time.perf_counter() - PROCESS_START, 3)}
+
+
+@app.get("/readyz")
+def readyz():
+    """Readiness: 200 once CLIP and segmentation are loaded, 503 (with per-model state) until then."""
+    status = startup.status()
+    return JSONResponse(status, status_code=200 if status["ready"] else 503)
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "startup": startup.status(),
+        "executor": {
+            "workers": inference_executor.workers,
+            "in_flight": inference_executor.in_flight,
+            "queue_depth": inference_executor.queue_depth,
+        },
+        "clip_batching": clip_batcher.stats() if clip_batcher is not None else None,
+        "result_cache": result_cache.stats() if result_cache is not None else None,
+        "segmentation": segmentation_engine.stats(),
+        "embedding_index": embedding_index.stats() if embedding_index is not None else None,
+        "jobs": jobs.stats(),
+    }
+
+
 
 
 if __name__ == "__main__":
+    import uvicorn
+
     host = os.environ.get("HOST", "0.0.0.0")
     port = int(os.environ.get("PORT", "8000"))
     uvicorn.run(app, host=host, port=port)
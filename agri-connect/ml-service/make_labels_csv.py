@@ -1,13 +1,15 @@
 import argparse
 import csv
+import hashlib
 import os
-from typing import Dict, List
+from typing import Dict, Iterator, List, Tuple
 VALID_EXTS = {".jpg", ".jpeg", ".png", ".bmp", ".webp"}
 DEFAULT_MAP = {
     "Good": "Good/Fresh",
     "Rotten": "Rotten/Spoiled",
     "Bad": "Completely Bad/Decomposed",
 }
+MANIFEST_COLUMNS = ["image_path", "label", "size", "mtime_ns", "sha256"]
 
 
 def build_map(pairs: List[str]) -> Dict[str, str]:
@@ -24,38 +26,147 @@ def build_map(pairs: List[str]) -> Dict[str, str]:
     return mapping
 
 
-def main():
-    parser = argparse.ArgumentParser(description="Create a labels CSV from a class-structured image directory")
-    parser.add_argument("root", help="Root directory containing class subfolders")
-    parser.add_argument("--out", default="labels.csv", help="Output CSV path")
-    parser.add_argument("--map", nargs="*", default=[], help="Override folder-to-label mapping. Example: --map Good=Good/Fresh Rotten=Rotten/Spoiled Bad=Completely Bad/Decomposed")
-    args = parser.parse_args()
-
-    mapping = build_map(args.map)
-
-    rows = []
+def iter_images(root: str, mapping: Dict[str, str], out_dir: str) -> Iterator[Tuple[str, str, str]]:
+    """Yield (file path, POSIX path relative to out_dir, label) per image, in a stable order."""
     for folder, label in mapping.items():
-        dir_path = os.path.join(args.root, folder)
+        dir_path = os.path.join(root, folder)
         if not os.path.isdir(dir_path):
             print(f"[WARN] Skipping missing folder: {dir_path}")
             continue
-        for root, _, files in os.walk(dir_path):
-            for f in files:
+        for walk_root, dirs, files in os.walk(dir_path):
+            dirs.sort()
+            for f in sorted(files):
                 ext = os.path.splitext(f)[1].lower()
                 if ext in VALID_EXTS:
-                    img_path = os.path.join(root, f)
-                    rows.append((os.path.relpath(img_path, start=os.path.dirname(os.path.abspath(args.out))), label))
+                    img_path = os.path.join(walk_root, f)
+                    # POSIX separators so a CSV written on Windows also works on Linux
+                    rel_path = os.path.relpath(img_path, start=out_dir).replace(os.sep, "/")
+                    yield img_path, rel_path, label
 
-    if not rows:
-        raise SystemExit("No images found. Check your directory structure and --map.")
 
-    os.makedirs(os.path.dirname(os.path.abspath(args.out)) or ".", exist_ok=True)
-    with open(args.out, "w", newline="", encoding="utf-8") as f:
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def ends_with_newline(path: str) -> bool:
+    """Whether the file is empty or its last byte is a newline, without reading the rest."""
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() == 0:
+            return True
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+def drop_partial_line(path: str) -> None:
+    """Truncate a half-written last line left by an interrupted run, scanning back from the end."""
+    with open(path, "rb+") as f:
+        pos = f.seek(0, os.SEEK_END)
+        while pos > 0:
+            step = min(1 << 16, pos)
+            f.seek(pos - step)
+            cut = f.read(step).rfind(b"\n")
+            if cut != -1:
+                f.truncate(pos - step + cut + 1)
+                return
+            pos -= step
+        f.truncate(0)
+
+
+def read_manifest(path: str) -> Dict[str, dict]:
+    """Latest manifest entry per image path (later rows win), skipping a half-written last line."""
+    complete = ends_with_newline(path)
+    entries = {}
+    with open(path, "r", newline="", encoding="utf-8") as f:
+        reader = csv.DictReader(f)
+        if reader.fieldnames != MANIFEST_COLUMNS:
+            raise SystemExit(f"{path} is not a manifest (columns {reader.fieldnames}); choose another --out or delete it")
+        pending = None
+        for row in reader:
+            if pending is not None:
+                entries[pending["image_path"]] = pending
+            pending = row
+        # A last row without its newline was cut off mid-write; update_manifest truncates it
+        if pending is not None and complete:
+            entries[pending["image_path"]] = pending
+    return entries
+
+
+def write_labels(root: str, mapping: Dict[str, str], out: str) -> int:
+    """Rewrite a plain image_path,label CSV, streaming rows into a temporary file first."""
+    out_dir = os.path.dirname(os.path.abspath(out))
+    tmp_path = f"{out}.tmp"
+    count = 0
+    with open(tmp_path, "w", newline="", encoding="utf-8") as f:
         w = csv.writer(f)
         w.writerow(["image_path", "label"])
-        w.writerows(rows)
+        for _, rel_path, label in iter_images(root, mapping, out_dir):
+            w.writerow([rel_path, label])
+            count += 1
+    if not count:
+        os.remove(tmp_path)
+        raise SystemExit("No images found. Check your directory structure and --map.")
+    os.replace(tmp_path, out)
+    return count
+
+
+def update_manifest(root: str, mapping: Dict[str, str], out: str) -> Tuple[int, int]:
+    """Append a row for every new or changed image to the manifest at `out`; returns (appended, seen).
+
+    Files whose size and mtime match their latest row are not re-hashed. A file that was only
+    touched (same content and label) still gets a row with its new size and mtime, so the next
+    run skips it again, but is not counted as changed.
+    """
+    out_dir = os.path.dirname(os.path.abspath(out))
+    entries = {}
+    if os.path.exists(out) and os.path.getsize(out):
+        entries = read_manifest(out)
+        if not ends_with_newline(out):
+            drop_partial_line(out)
+    appended = seen = 0
+    with open(out, "a", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        if f.tell() == 0:
+            w.writerow(MANIFEST_COLUMNS)
+        for img_path, rel_path, label in iter_images(root, mapping, out_dir):
+            seen += 1
+            st = os.stat(img_path)
+            old = entries.get(rel_path)
+            if old is not None and old["label"] == label and old["size"] == str(st.st_size) \
+                    and old["mtime_ns"] == str(st.st_mtime_ns):
+                continue
+            sha = file_sha256(img_path)
+            w.writerow([rel_path, label, st.st_size, st.st_mtime_ns, sha])
+            if old is None or old["label"] != label or old["sha256"] != sha:
+                appended += 1
+            # Flush per row so an interrupted run keeps everything hashed so far
+            f.flush()
+    return appended, seen
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Create a labels CSV from a class-structured image directory")
+    parser.add_argument("root", help="Root directory containing class subfolders")
+    parser.add_argument("--out", default="labels.csv", help="Output CSV path")
+    parser.add_argument("--map", nargs="*", default=[], help="Override folder-to-label mapping. Example: --map Good=Good/Fresh Rotten=Rotten/Spoiled Bad=Completely Bad/Decomposed")
+    parser.add_argument("--manifest", action="store_true", help="Write an append-only manifest (image_path,label,size,mtime_ns,sha256): re-runs append only new or changed images, and later rows supersede earlier ones")
+    args = parser.parse_args()
 
-    print(f"Wrote {len(rows)} rows to {args.out}")
+    mapping = build_map(args.map)
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)) or ".", exist_ok=True)
+
+    if not args.manifest:
+        print(f"Wrote {write_labels(args.root, mapping, args.out)} rows to {args.out}")
+        return
+
+    appended, seen = update_manifest(args.root, mapping, args.out)
+    if not seen:
+        raise SystemExit("No images found. Check your directory structure and --map.")
+    print(f"Appended {appended} new or changed of {seen} images to {args.out}")
 
 
 if __name__ == "__main__":
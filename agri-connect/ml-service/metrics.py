@@ -0,0 +1,213 @@
+import bisect
+import contextvars
+import cProfile
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+# Set METRICS_ENABLED=0 to turn the per-stage timers into no-ops (request counts and gauges are still reported)
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") == "1"
+
+# Latency buckets in seconds, from sub-millisecond numpy work up to slow full-resolution requests
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Stage durations (ms) of the request being processed on the current thread, for Server-Timing
+_request_timings: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("request_timings", default=None)
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ""
+    parts = ",".join(f'{k}="{str(v)}"' for k, v in sorted(labels.items()))
+    return "{" + parts + "}"
+
+
+class Histogram:
+    """Prometheus-style cumulative histogram with one series per label set."""
+
+    def __init__(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self._lock = threading.Lock()
+        self._series: dict[tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                # [per-bucket counts (+Inf last), sum, count]
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {k: (list(v[0]), v[1], v[2]) for k, v in self._series.items()}
+        for key, (counts, total, count) in sorted(series.items()):
+            labels = dict(key)
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{self.name}_bucket{_format_labels({**labels, 'le': le})} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(labels)} {count}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._lock = threading.Lock()
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(dict(key))} {value}")
+        return lines
+
+
+class Gauge:
+    """Gauge whose value is read from `fn` at scrape time."""
+
+    def __init__(self, name: str, help_text: str, fn: Callable[[], float]):
+        self.name = name
+        self.help = help_text
+        self.fn = fn
+
+    def render(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {float(self.fn())}"]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: list = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines: list[str] = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+STAGE_SECONDS = registry.register(Histogram("infer_stage_seconds", "Time spent in each inference pipeline stage"))
+REQUEST_SECONDS = registry.register(Histogram("infer_request_seconds", "End-to-end /infer handler latency"))
+REQUESTS = registry.register(Counter("infer_requests_total", "Inference requests by endpoint and status code"))
+CLIP_SECONDS_PER_AUGMENTATION = registry.register(Histogram(
+    "clip_forward_seconds_per_augmentation", "CLIP image forward time divided by the augmented images in the batch"))
+CASCADE_PATHS = registry.register(Counter(
+    "infer_cascade_path_total", "Images by INFER_CASCADE path (heuristic, clip, clip-fast)"))
+
+
+def record_stage(name: str, seconds: float) -> None:
+    """Add a measured stage duration to the histogram and to the current request's timings."""
+    if METRICS_ENABLED:
+        STAGE_SECONDS.observe(seconds, stage=name)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + 1000.0 * seconds
+
+
+@contextmanager
+def _stage(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+class _NoopStage:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NOOP_STAGE = _NoopStage()
+
+
+def stage(name: str):
+    """Context manager timing one pipeline stage into infer_stage_seconds{stage=name}."""
+    return _stage(name) if METRICS_ENABLED else _NOOP_STAGE
+
+
+@contextmanager
+def request_timings(timings: dict):
+    """Collect the stages timed on this thread into `timings` (ms) for the duration of the block."""
+    token = _request_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _request_timings.reset(token)
+
+
+def server_timing_header(timings: dict) -> str:
+    return ", ".join(f"{name};dur={ms:.1f}" for name, ms in timings.items())
+
+
+class Profiler:
+    """cProfile hook for live hot-path investigation.
+
+    Enabled by INFER_PROFILE_DIR. A request is profiled when it asks for it (?profile=1) or,
+    with INFER_PROFILE_EVERY=N, for every Nth request; each profile is dumped as a .prof file
+    (open with `python -m pstats` or snakeviz). cProfile only sees the worker thread, so CLIP
+    work done by the micro-batcher thread shows up as waiting.
+    """
+
+    def __init__(self, out_dir: Optional[str], every: int = 0):
+        self.out_dir = out_dir
+        self.every = max(0, every)
+        self._lock = threading.Lock()
+        # Only one cProfile can be active per process on newer Pythons; concurrent requests run unprofiled
+        self._active = threading.Lock()
+        self._count = 0
+        if out_dir:
+            os.makedirs(out_dir, exist_ok=True)
+
+    def should_profile(self, requested: bool) -> bool:
+        if not self.out_dir:
+            return False
+        with self._lock:
+            self._count += 1
+            sampled = self.every > 0 and self._count % self.every == 0
+        return requested or sampled
+
+    def run(self, fn: Callable, *args):
+        """Run fn(*args) under cProfile; returns (result, path of the dumped profile or None)."""
+        if not self._active.acquire(blocking=False):
+            return fn(*args), None
+        try:
+            profile = cProfile.Profile()
+            result = profile.runcall(fn, *args)
+        finally:
+            self._active.release()
+        path = os.path.join(self.out_dir, f"infer-{time.time_ns()}.prof")
+        profile.dump_stats(path)
+        return result, path
+
+
+def profiler_from_env() -> Profiler:
+    return Profiler(os.environ.get("INFER_PROFILE_DIR") or None, int(os.environ.get("INFER_PROFILE_EVERY", "0")))
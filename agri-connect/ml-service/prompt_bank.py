@@ -0,0 +1,156 @@
+import hashlib
+import json
+import logging
+import os
+from typing import Callable, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Crops with their own prompt ensemble: bank key -> name used in the prompts. Listings use free-text
+# cropType, so CROP_ALIASES maps common spellings and local names onto these keys.
+CROPS = {
+    "apple": "apple",
+    "banana": "banana",
+    "beans": "green beans",
+    "bitter gourd": "bitter gourd",
+    "bottle gourd": "bottle gourd",
+    "brinjal": "brinjal eggplant",
+    "cabbage": "cabbage",
+    "capsicum": "capsicum bell pepper",
+    "carrot": "carrot",
+    "cauliflower": "cauliflower",
+    "chilli": "green chilli",
+    "coriander": "coriander leaves",
+    "cucumber": "cucumber",
+    "garlic": "garlic",
+    "ginger": "ginger",
+    "grape": "grapes",
+    "guava": "guava",
+    "lemon": "lemon",
+    "mango": "mango",
+    "okra": "okra",
+    "onion": "onion",
+    "orange": "orange",
+    "papaya": "papaya",
+    "peas": "green peas",
+    "pomegranate": "pomegranate",
+    "potato": "potato",
+    "pumpkin": "pumpkin",
+    "radish": "radish",
+    "spinach": "spinach leaves",
+    "strawberry": "strawberry",
+    "tomato": "tomato",
+    "watermelon": "watermelon",
+}
+CROP_ALIASES = {
+    "aloo": "potato", "baingan": "brinjal", "bell pepper": "capsicum", "bhindi": "okra",
+    "chili": "chilli", "dhaniya": "coriander", "eggplant": "brinjal", "green beans": "beans",
+    "green chilli": "chilli", "karela": "bitter gourd", "lady finger": "okra", "ladyfinger": "okra",
+    "lauki": "bottle gourd", "mirchi": "chilli", "palak": "spinach", "pyaz": "onion", "tamatar": "tomato",
+}
+
+# Per-class prompt templates, in the order of main.labels. The templates of one class are averaged
+# in embedding space into a single class embedding (CLIP-style prompt ensembling).
+CLASS_TEMPLATES = [
+    [
+        "a photo of a fresh {crop}",
+        "a photo of fresh, good quality {crop}",
+        "a close-up photo of a ripe, healthy {crop}",
+        "a photo of fresh {crop} for sale at a market",
+    ],
+    [
+        "a photo of a partially rotten {crop}",
+        "a photo of a {crop} with spoiled, bruised patches",
+        "a close-up photo of a {crop} starting to go bad",
+        "a photo of an overripe {crop} with soft dark spots",
+    ],
+    [
+        "a photo of a completely rotten {crop}",
+        "a photo of a decomposed, moldy {crop}",
+        "a close-up photo of a {crop} that has decayed and is inedible",
+        "a photo of a mushy, black, rotting {crop}",
+    ],
+]
+
+
+def resolve_crop(crop_type: Optional[str]) -> Optional[str]:
+    """Bank key for a free-text crop type ("Tomatoes", "bhindi"); None when it has no ensemble."""
+    if not crop_type:
+        return None
+    name = " ".join(crop_type.lower().replace("_", " ").replace("-", " ").split())
+    candidates = [name]
+    for suffix in ("es", "s"):
+        if name.endswith(suffix):
+            candidates.append(name[: -len(suffix)])
+    for candidate in candidates:
+        if candidate in CROPS:
+            return candidate
+        if candidate in CROP_ALIASES:
+            return CROP_ALIASES[candidate]
+    return None
+
+
+def bank_prompts() -> list[str]:
+    """Every crop x class x template prompt, crop-major, in bank row order."""
+    return [template.format(crop=name) for name in CROPS.values() for templates in CLASS_TEMPLATES
+            for template in templates]
+
+
+def bank_fingerprint(model_name: str) -> str:
+    """Changes whenever the model or any crop or template changes; part of cache keys and the bank file name."""
+    payload = json.dumps([model_name, CROPS, CLASS_TEMPLATES])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:12]
+
+
+class PromptBank:
+    """Per-crop class embeddings in one matrix of shape [n_crops * n_classes, D].
+
+    Row `offsets[crop] + c` is the normalized mean of the class-c template embeddings for that
+    crop, so scoring any number of crops is one image-embedding x bank matmul.
+    """
+
+    def __init__(self, matrix: np.ndarray, crops: list[str], n_classes: int):
+        self.matrix = matrix
+        self.crops = crops
+        self.n_classes = n_classes
+        self.offsets = {crop: i * n_classes for i, crop in enumerate(crops)}
+
+    @classmethod
+    def build(cls, encode_text: Callable[[list[str]], np.ndarray]) -> "PromptBank":
+        """Build from `encode_text`, which maps prompts to L2-normalized text embeddings [P, D]."""
+        n_classes, n_templates = len(CLASS_TEMPLATES), len(CLASS_TEMPLATES[0])
+        feats = np.asarray(encode_text(bank_prompts()), dtype=np.float32)
+        class_feats = feats.reshape(len(CROPS), n_classes, n_templates, -1).mean(axis=2)
+        class_feats /= np.linalg.norm(class_feats, axis=-1, keepdims=True)
+        return cls(class_feats.reshape(len(CROPS) * n_classes, -1), list(CROPS), n_classes)
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.tmp-{os.getpid()}.npz"
+        np.savez(tmp_path, matrix=self.matrix, crops=np.array(self.crops))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, n_classes: int) -> "PromptBank":
+        with np.load(path) as data:
+            return cls(data["matrix"], [str(c) for c in data["crops"]], n_classes)
+
+
+def load_or_build(cache_dir: Optional[str], model_name: str,
+                  encode_text: Callable[[list[str]], np.ndarray]) -> PromptBank:
+    """Load the bank saved for this model and prompt set from `cache_dir`, building (and saving) it if missing."""
+    path = None
+    if cache_dir:
+        stem = model_name.strip("/").replace("/", "--")
+        path = os.path.join(cache_dir, f"{stem}-prompt-bank-{bank_fingerprint(model_name)}.npz")
+        if os.path.exists(path):
+            return PromptBank.load(path, len(CLASS_TEMPLATES))
+    bank = PromptBank.build(encode_text)
+    if path is not None:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            bank.save(path)
+        except OSError as e:
+            logger.warning("Could not save prompt bank to %s: %s", path, e)
+    return bank
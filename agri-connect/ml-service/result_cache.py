@@ -0,0 +1,111 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+
+class ResultCache:
+    """Two-tier cache of serialized /infer responses keyed by content hash.
+
+    The memory tier is an LRU bounded by entry count and total body bytes. The optional disk tier
+    is a sqlite file that survives restarts; disk hits are promoted back into memory. Entries in
+    both tiers expire `ttl_s` seconds after they were stored; expired rows are deleted from the
+    disk tier at most once a minute.
+
+    With the disk tier, get() and put() block on sqlite, so async callers should run them in a
+    thread (see `disk`).
+    """
+
+    def __init__(self, max_entries: int = 256, max_bytes: int = 64 * 1024 * 1024,
+                 ttl_s: float = 3600.0, db_path: Optional[str] = None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple[float, bytes]]" = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._db: Optional[sqlite3.Connection] = None
+        self._last_purge = 0.0
+        self.disk = bool(db_path)
+        if db_path:
+            os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, created REAL, body BLOB)")
+            self._db.commit()
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl_s > 0 and time.time() - created > self.ttl_s
+
+    def _store_memory(self, key: str, created: float, body: bytes) -> None:
+        if self.max_entries <= 0 or len(body) > self.max_bytes:
+            return
+        old = self._entries.pop(key, None)
+        if old is not None:
+            self._bytes -= len(old[1])
+        self._entries[key] = (created, body)
+        self._bytes += len(body)
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (_, evicted) = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry[0]):
+                del self._entries[key]
+                self._bytes -= len(entry[1])
+                entry = None
+            if entry is None and self._db is not None:
+                row = self._db.execute("SELECT created, body FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None and not self._expired(row[0]):
+                    entry = (row[0], bytes(row[1]))
+                    self._store_memory(key, *entry)
+            if entry is None:
+                self.misses += 1
+                return None
+            if key in self._entries:
+                self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: str, body: bytes) -> None:
+        created = time.time()
+        with self._lock:
+            self._store_memory(key, created, body)
+            if self._db is not None:
+                self._db.execute("INSERT OR REPLACE INTO results (key, created, body) VALUES (?, ?, ?)",
+                                 (key, created, body))
+                if self.ttl_s > 0 and created - self._last_purge >= 60:
+                    self._last_purge = created
+                    self._db.execute("DELETE FROM results WHERE created < ?", (created - self.ttl_s,))
+                self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+                "disk": self.disk,
+            }
+
+
+def cache_from_env() -> Optional[ResultCache]:
+    """Build the /infer result cache from INFER_CACHE_* settings; None when both tiers are off."""
+    max_entries = int(os.environ.get("INFER_CACHE_SIZE", "256"))
+    db_path = os.environ.get("INFER_CACHE_DB") or None
+    if max_entries <= 0 and db_path is None:
+        return None
+    return ResultCache(
+        max_entries=max_entries,
+        max_bytes=int(float(os.environ.get("INFER_CACHE_MAX_MB", "64")) * 1024 * 1024),
+        ttl_s=float(os.environ.get("INFER_CACHE_TTL_S", "3600")),
+        db_path=db_path,
+    )
@@ -0,0 +1,142 @@
+import os
+import threading
+from collections import Counter
+
+import cv2
+import numpy as np
+from PIL import Image
+
+FALLBACKS = ("none", "saturation", "grabcut")
+
+_CLOSE_KERNEL = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (7, 7))
+# GrabCut runs on a copy no larger than this; its mask is scaled back up
+_GRABCUT_MAX_SIDE = 256
+
+
+class SegmentationEngine:
+    """Foreground segmentation with one persistent rembg session.
+
+    The session (model `model_name`, onnxruntime intra-op `threads`) is created once by load().
+    With a `fallback` other than "none", images whose border is mostly saturated colour (the
+    produce fills the frame, so there is no background to remove) skip rembg and are masked
+    with a saturation threshold or GrabCut instead; the same fallback covers rembg failures.
+    """
+
+    def __init__(self, model_name: str = "u2net", threads: int = 0, fallback: str = "none",
+                 fill_frame_ratio: float = 0.6, saturation_threshold: int = 40):
+        if fallback not in FALLBACKS:
+            raise ValueError(f"Invalid segmentation fallback {fallback!r}; choose from {', '.join(FALLBACKS)}")
+        self.model_name = model_name
+        self.threads = threads
+        self.fallback = fallback
+        self.fill_frame_ratio = fill_frame_ratio
+        self.saturation_threshold = saturation_threshold
+        self.session = None
+        self._lock = threading.Lock()
+        self._methods: Counter = Counter()
+
+    def load(self):
+        """Create the rembg session (importing rembg lazily) and warm it up with a tiny pass."""
+        if self.session is not None:
+            return self.session
+        with self._lock:
+            if self.session is None:
+                import onnxruntime as ort
+                from rembg import new_session, remove
+
+                sess_opts = ort.SessionOptions()
+                if self.threads > 0:
+                    sess_opts.intra_op_num_threads = self.threads
+                session = new_session(self.model_name, sess_opts=sess_opts)
+                try:
+                    remove(Image.new("RGB", (16, 16), (0, 0, 0)), session=session)
+                except Exception:
+                    # Ignore warmup errors; real requests will be handled with proper images
+                    pass
+                self.session = session
+        return self.session
+
+    def fills_frame(self, img_rgb: np.ndarray) -> bool:
+        """True when most border pixels are saturated colour rather than a plain background."""
+        sat = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2HSV)[:, :, 1]
+        border = np.concatenate([sat[0], sat[-1], sat[1:-1, 0], sat[1:-1, -1]])
+        return float(np.mean(border > self.saturation_threshold)) >= self.fill_frame_ratio
+
+    def saturation_mask(self, img_rgb: np.ndarray) -> np.ndarray:
+        sat = cv2.cvtColor(img_rgb, cv2.COLOR_RGB2HSV)[:, :, 1]
+        mask = (sat > self.saturation_threshold).astype(np.uint8)
+        return cv2.morphologyEx(mask, cv2.MORPH_CLOSE, _CLOSE_KERNEL)
+
+    def grabcut_mask(self, img_rgb: np.ndarray) -> np.ndarray:
+        h, w = img_rgb.shape[:2]
+        scale = min(1.0, _GRABCUT_MAX_SIDE / float(max(h, w)))
+        small = cv2.resize(img_rgb, (max(1, round(w * scale)), max(1, round(h * scale))),
+                           interpolation=cv2.INTER_AREA) if scale < 1.0 else img_rgb
+        sh, sw = small.shape[:2]
+        margin_x, margin_y = max(1, sw // 20), max(1, sh // 20)
+        rect = (margin_x, margin_y, max(1, sw - 2 * margin_x), max(1, sh - 2 * margin_y))
+        gc = np.zeros((sh, sw), np.uint8)
+        try:
+            cv2.grabCut(cv2.cvtColor(small, cv2.COLOR_RGB2BGR), gc, rect, np.zeros((1, 65), np.float64),
+                        np.zeros((1, 65), np.float64), 3, cv2.GC_INIT_WITH_RECT)
+        except cv2.error:
+            return self.saturation_mask(img_rgb)
+        mask = ((gc == cv2.GC_FGD) | (gc == cv2.GC_PR_FGD)).astype(np.uint8)
+        if (sh, sw) != (h, w):
+            mask = cv2.resize(mask, (w, h), interpolation=cv2.INTER_NEAREST)
+        return mask
+
+    def _fallback_mask(self, img_rgb: np.ndarray) -> np.ndarray:
+        return self.grabcut_mask(img_rgb) if self.fallback == "grabcut" else self.saturation_mask(img_rgb)
+
+    def segment(self, image: Image.Image) -> tuple[Image.Image, np.ndarray, str]:
+        """Return (RGB cutout with the background zeroed, 0/1 uint8 mask, method used)."""
+        img_rgb = None
+        if self.fallback != "none":
+            img_rgb = np.asarray(image.convert("RGB"))
+            if self.fills_frame(img_rgb):
+                return self._cutout(img_rgb, self._fallback_mask(img_rgb), self.fallback)
+        from rembg import remove
+
+        try:
+            cutout = remove(image, session=self.load())
+        except Exception:
+            if self.fallback == "none":
+                raise
+            img_rgb = np.asarray(image.convert("RGB")) if img_rgb is None else img_rgb
+            return self._cutout(img_rgb, self._fallback_mask(img_rgb), self.fallback)
+        cutout_np = np.asarray(cutout)
+        if cutout_np.ndim == 3 and cutout_np.shape[2] == 4:
+            mask = (cutout_np[:, :, 3] > 0).astype(np.uint8)
+        else:
+            mask = np.ones(cutout_np.shape[:2], dtype=np.uint8)
+        self._count("rembg")
+        return cutout.convert("RGB"), mask, "rembg"
+
+    def _cutout(self, img_rgb: np.ndarray, mask: np.ndarray, method: str) -> tuple[Image.Image, np.ndarray, str]:
+        self._count(method)
+        return Image.fromarray(img_rgb * mask[:, :, None]), mask, method
+
+    def _count(self, method: str) -> None:
+        with self._lock:
+            self._methods[method] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"model": self.model_name, "fallback": self.fallback, "methods": dict(self._methods)}
+
+
+def parse_engine_spec(spec: str, threads: int = 0) -> SegmentationEngine:
+    """Engine for a "model[+fallback]" spec, e.g. "u2netp" or "silueta+saturation"."""
+    model_name, _, fallback = spec.partition("+")
+    return SegmentationEngine(model_name=model_name, threads=threads, fallback=fallback or "none")
+
+
+def engine_from_env() -> SegmentationEngine:
+    """Build the segmentation engine from SEG_MODEL, SEG_THREADS, SEG_FALLBACK and SEG_FILL_FRAME_RATIO."""
+    return SegmentationEngine(
+        model_name=os.environ.get("SEG_MODEL", "u2net"),
+        threads=int(os.environ.get("SEG_THREADS", "0")),
+        fallback=os.environ.get("SEG_FALLBACK", "none"),
+        fill_frame_ratio=float(os.environ.get("SEG_FILL_FRAME_RATIO", "0.6")),
+    )
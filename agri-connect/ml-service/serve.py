@@ -0,0 +1,211 @@
+"""Multi-process serving for the ML service: one parent loads CLIP, forked workers share it.
+
+`python main.py` serves from a single process, so only one core runs Python-level work, and
+`uvicorn --workers N` would load CLIP and the rembg model N times. Here the parent loads the
+torch CLIP weights and the prompt bank once, moves the weights into shared memory and forks
+SERVE_WORKERS workers. Each worker creates its own rembg session (onnxruntime sessions are not
+fork-safe), pins its intra-op threads to SERVE_THREADS and listens on its own SO_REUSEPORT
+socket on the same port, so the kernel spreads connections across workers. Workers that die are
+restarted.
+
+    SERVE_WORKERS=4 python serve.py
+"""
+import gc
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+from typing import Optional
+
+logger = logging.getLogger("serve")
+
+# Shorter than this between a worker's start and its exit counts as a crash loop
+_MIN_WORKER_LIFETIME_S = 5.0
+
+
+def preload(pipeline) -> bool:
+    """Load the models workers can share; returns False when each worker has to load its own.
+
+    The parent loads with one intra-op thread so no OpenMP thread pool exists when it forks.
+    """
+    if pipeline.CLIP_BACKEND not in ("torch", "torch-int8"):
+        logger.info("CLIP_BACKEND=%s: every worker loads its own onnxruntime session", pipeline.CLIP_BACKEND)
+        return False
+    import torch
+
+    torch.set_num_threads(1)
+    configured_threads, pipeline.CLIP_THREADS = pipeline.CLIP_THREADS, 0
+    try:
+        pipeline.ensure_models()
+    finally:
+        pipeline.CLIP_THREADS = configured_threads
+    pipeline.clip_model.share_memory()
+    return True
+
+
+def worker_cpus(index: int, threads: int) -> list[int]:
+    """The `threads` CPUs worker `index` is pinned to with SERVE_PIN_CPUS=1."""
+    cpus = sorted(os.sched_getaffinity(0))
+    start = (index * threads) % len(cpus)
+    return [cpus[(start + i) % len(cpus)] for i in range(min(threads, len(cpus)))]
+
+
+def listen_socket(host: str, port: int) -> socket.socket:
+    sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def reopen_process_state(pipeline, index: int, workers: int, adopt_jobs: bool) -> None:
+    """Give a freshly forked worker its own sqlite connections and embedding index.
+
+    sqlite connections must not be used across fork, and a memory-mapped index cannot take
+    writes from several processes, so with EMBED_INDEX_PATH each worker keeps its own under
+    worker-<index>/. Jobs are owned by worker-<index>, so a respawned worker requeues the jobs
+    its predecessor left unfinished in JOBS_DB.
+    """
+    from embedding_index import EmbeddingIndex
+    from jobs import jobs_from_env
+    from result_cache import cache_from_env
+
+    pipeline.result_cache = cache_from_env()
+    pipeline.jobs = jobs_from_env()
+    pipeline.jobs.owner = f"worker-{index}"
+    pipeline.jobs.owners = tuple(f"worker-{i}" for i in range(workers))
+    pipeline.jobs.adopt_orphans = adopt_jobs
+    old = pipeline.embedding_index
+    if old is not None:
+        path = old.path
+        if path and workers > 1:
+            path = os.path.join(path, f"worker-{index}")
+        pipeline.embedding_index = EmbeddingIndex(old.capacity, path, old.ivf_min, old.nprobe)
+
+
+def run_worker(pipeline, sock: Optional[socket.socket], address: tuple[str, int], index: int, workers: int,
+               threads: int, pin: bool, restarted: bool) -> None:
+    """Body of a forked worker: pin threads, reopen per-process state and serve until SIGTERM.
+
+    Without an inherited `sock` the worker binds its own SO_REUSEPORT socket on `address`.
+    """
+    import uvicorn
+
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if pin and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, worker_cpus(index, threads))
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads)
+    if pipeline.CLIP_THREADS <= 0:
+        pipeline.CLIP_THREADS = threads
+    if pipeline.segmentation_engine.threads <= 0:
+        pipeline.segmentation_engine.threads = threads
+    # Every worker requeues its own unfinished jobs; worker 0, when first started, also takes over
+    # those of earlier runs' workers and of single-process runs, so none runs twice
+    reopen_process_state(pipeline, index, workers, adopt_jobs=index == 0 and not restarted)
+    if sock is None:
+        sock = listen_socket(*address)
+    logger.info("worker %d (pid %d) serving with %d threads", index, os.getpid(), threads)
+    config = uvicorn.Config(pipeline.app, log_level=os.environ.get("LOG_LEVEL", "INFO").lower())
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+class Supervisor:
+    """Forks the workers, restarts the ones that die and forwards SIGINT/SIGTERM to all of them."""
+
+    def __init__(self, pipeline, sock: Optional[socket.socket], address: tuple[str, int], workers: int,
+                 threads: int, pin: bool):
+        self.pipeline = pipeline
+        self.sock = sock
+        self.address = address
+        self.workers = workers
+        self.threads = threads
+        self.pin = pin
+        self.children: dict[int, tuple[int, float]] = {}
+        self.stopping = False
+
+    def spawn(self, index: int, restarted: bool = False) -> None:
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                run_worker(self.pipeline, self.sock, self.address, index, self.workers, self.threads, self.pin,
+                           restarted)
+            except BaseException:
+                logger.exception("worker %d failed", index)
+                code = 1
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        self.children[pid] = (index, time.monotonic())
+
+    def stop(self, signum, frame) -> None:
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def run(self) -> None:
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for index in range(self.workers):
+            self.spawn(index)
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            index, started = self.children.pop(pid, (None, 0.0))
+            if index is None or self.stopping:
+                continue
+            logger.warning("worker %d (pid %d) exited with status %d; restarting", index, pid,
+                           os.waitstatus_to_exitcode(status))
+            if time.monotonic() - started < _MIN_WORKER_LIFETIME_S:
+                time.sleep(_MIN_WORKER_LIFETIME_S)
+            self.spawn(index, restarted=True)
+
+
+def main() -> None:
+    # Hugging Face tokenizers warn (and disable themselves) when a process forks after using them
+    os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+    import main as pipeline
+
+    pipeline.configure_logging()
+    workers = max(1, int(os.environ.get("SERVE_WORKERS", "2")))
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+    threads = int(os.environ.get("SERVE_THREADS", "0")) or max(1, cpus // workers)
+    pin = os.environ.get("SERVE_PIN_CPUS", "0") == "1"
+    host = os.environ.get("HOST", "0.0.0.0")
+    port = int(os.environ.get("PORT", "8000"))
+
+    started = time.perf_counter()
+    shared = preload(pipeline)
+    if shared:
+        logger.info("CLIP loaded once in %.2fs and shared with %d workers", time.perf_counter() - started, workers)
+    if hasattr(socket, "SO_REUSEPORT"):
+        # Every worker listens on its own socket and the kernel balances connections across them;
+        # the parent only checks that the port is free
+        listen_socket(host, port).close()
+        sock = None
+    else:
+        sock = listen_socket(host, port)
+    # Keep the objects loaded so far out of the cyclic GC, whose bookkeeping would otherwise
+    # dirty (and un-share) their pages in every worker
+    gc.freeze()
+    logger.info("serving on %s:%d with %d workers x %d threads%s", host, port, workers, threads,
+                " (pinned)" if pin else "")
+    Supervisor(pipeline, sock, (host, port), workers, threads, pin).run()
+
+
+if __name__ == "__main__":
+    main()
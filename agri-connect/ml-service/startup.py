@@ -0,0 +1,107 @@
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Reference point for uptime and time-to-first-response: when the service module was imported
+PROCESS_START = time.perf_counter()
+
+
+class Startup:
+    """Loads named components (models, sessions) on background threads and tracks readiness.
+
+    Each component is loaded by its own thread so slow loads overlap. status() reports the
+    state and load time of every component; mark_first_response() logs, once, how long after
+    process start the first inference response went out.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._components: dict[str, dict] = {}
+        self._done: dict[str, threading.Event] = {}
+        self.first_response_s: Optional[float] = None
+
+    def load(self, name: str, fn: Callable[[], None]) -> None:
+        """Start loading `name` by calling fn() on a background thread."""
+        with self._lock:
+            if name in self._components:
+                return
+            self._components[name] = {"state": "loading"}
+            self._done[name] = threading.Event()
+        threading.Thread(target=self._run, args=(name, fn), name=f"load-{name}", daemon=True).start()
+
+    def _run(self, name: str, fn: Callable[[], None]) -> None:
+        started = time.perf_counter()
+        try:
+            fn()
+            state = {"state": "ready"}
+        except Exception as e:
+            state = {"state": "failed", "error": str(e)}
+        state["load_s"] = round(time.perf_counter() - started, 3)
+        state["ready_after_s"] = round(time.perf_counter() - PROCESS_START, 3)
+        with self._lock:
+            self._components[name] = state
+        logger.info("%s %s in %.2fs (%.2fs after start)%s", name, state["state"], state["load_s"],
+                    state["ready_after_s"], ": " + state["error"] if "error" in state else "")
+        self._done[name].set()
+
+    def is_ready(self, name: str) -> bool:
+        with self._lock:
+            return self._components.get(name, {}).get("state") == "ready"
+
+    def wait(self, name: str) -> None:
+        """Block until `name` has finished loading; raises if it failed."""
+        self._done[name].wait()
+        with self._lock:
+            component = self._components[name]
+        if component["state"] == "failed":
+            raise RuntimeError(f"{name} failed to load: {component.get('error')}")
+
+    def wait_all(self, timeout: Optional[float] = None) -> None:
+        """Block until every component has finished loading; raises if any of them failed."""
+        for event in list(self._done.values()):
+            event.wait(timeout)
+        with self._lock:
+            failed = {name: c.get("error") for name, c in self._components.items() if c["state"] == "failed"}
+        if failed:
+            raise RuntimeError(f"startup failed: {failed}")
+
+    def mark_first_response(self, degraded: bool = False) -> None:
+        with self._lock:
+            if self.first_response_s is not None:
+                return
+            self.first_response_s = time.perf_counter() - PROCESS_START
+        logger.info("first inference response %.2fs after start%s", self.first_response_s,
+                    " (heuristic only, CLIP still loading)" if degraded else "")
+
+    def status(self) -> dict:
+        with self._lock:
+            return {
+                "uptime_s": round(time.perf_counter() - PROCESS_START, 3),
+                "ready": bool(self._components) and all(c["state"] == "ready" for c in self._components.values()),
+                "components": {name: dict(c) for name, c in self._components.items()},
+                "first_response_s": None if self.first_response_s is None else round(self.first_response_s, 3),
+            }
+
+
+def snapshot_path(snapshot_dir: str, model_name: str) -> Optional[str]:
+    """Directory holding the local save_pretrained() snapshot of `model_name`; None when disabled."""
+    if not snapshot_dir:
+        return None
+    return os.path.join(snapshot_dir, model_name.strip("/").replace("/", "--"))
+
+
+def save_snapshot(path: str, *objects) -> None:
+    """save_pretrained() every object into `path` atomically, so a crash never leaves a partial snapshot."""
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    for obj in objects:
+        obj.save_pretrained(tmp_path)
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # Another process finished its snapshot first
+        shutil.rmtree(tmp_path, ignore_errors=True)
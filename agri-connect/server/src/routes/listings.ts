@@ -50,10 +50,11 @@ router.post('/listings',
         const form = new FormData();
         const blob = new Blob([buf], { type: first.mimetype || 'image/jpeg' });
         form.append('file', blob as any, path.basename(abs));
-        const r = await fetch(`${config.mlServiceUrl}/infer`, { method: 'POST', body: form as any } as any);
+        const r = await fetch(`${config.mlServiceUrl}/infer?detail=minimal&crop_type=${encodeURIComponent(String(cropType))}`, { method: 'POST', body: form as any } as any);
         if (r.ok) {
           const data = await r.json() as any;
-          const scores = (data?.vit_class?.scores) as Record<string, number> | undefined;
+          // final_scores is also set by the heuristic-only tier, whose vit_class has no scores
+          const scores = (data?.final_scores || data?.vit_class?.scores) as Record<string, number> | undefined;
           const goodPct = typeof scores?.['Good/Fresh'] === 'number' ? scores['Good/Fresh'] : undefined;
           if (typeof goodPct === 'number') {
             qualityScore = goodPct; // 0..1
@@ -56,7 +56,7 @@ router.post(
 
       form.append('file', blob, file.originalname || 'image.jpg');
 
-      const primary = `${config.mlServiceUrl.replace(/\/$/, '')}/infer`;
+      const primary = `${config.mlServiceUrl.replace(/\/$/, '')}/infer?mask=png`;
       const candidates = [primary];
 
       let lastErr: any = null;